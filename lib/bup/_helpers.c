@@ -582,6 +582,189 @@ static PyObject *bloom_contains(PyObject *self, PyObject *args)
 }
 
 
+static PyObject *bloom_contains_many(PyObject *self, PyObject *args)
+{
+    Py_buffer bloom, sha;
+    int nbits = 0, k = 0;
+    if (!PyArg_ParseTuple(args, wbuf_argf wbuf_argf "ii",
+                          &bloom, &sha, &nbits, &k))
+        return NULL;
+
+    PyObject *result = NULL;
+
+    if (bloom.len < 16+(1<<nbits) || sha.len % 20 != 0)
+        goto clean_and_return;
+    if (!((k == 5 && nbits <= 29) || (k == 4 && nbits <= 37)))
+        goto clean_and_return;
+
+    result = PyBytes_FromStringAndSize(NULL, sha.len / 20);
+    if (!result)
+        goto clean_and_return;
+    char *found = PyBytes_AS_STRING(result);
+    const unsigned char *cur = sha.buf;
+    const unsigned char *end = cur + sha.len;
+    for (; cur < end; cur += 20, found++)
+    {
+        *found = 1;
+        const unsigned char *part;
+        for (part = cur; part < cur + 20; part += 20/k)
+            if (!(k == 5 ? bloom_get_bit5(bloom.buf, part, nbits)
+                  : bloom_get_bit4(bloom.buf, part, nbits)))
+            {
+                *found = 0;
+                break;
+            }
+    }
+
+ clean_and_return:
+    PyBuffer_Release(&bloom);
+    PyBuffer_Release(&sha);
+    return result;
+}
+
+
+// Version 3 (blocked) filters: the table is a sequence of 64 byte
+// (512 bit, i.e. typically one cache line) blocks, the first 64 bits
+// of the SHA select the block, and the following k 16-bit words
+// each select one bit (via their low 9 bits) within that block.
+
+#define BLOOM3_BLOCK_LOG2 6
+#define BLOOM3_MAX_K 6
+
+static uint64_t bloom3_block_offset(const unsigned char *sha, const int nbits)
+{
+    const int block_bits = nbits - BLOOM3_BLOCK_LOG2;
+    if (block_bits == 0)
+        return 0;
+    uint64_t v = 0;
+    int i;
+    for (i = 0; i < 8; i++)
+        v = (v << 8) | sha[i];
+    return (v >> (64 - block_bits)) << BLOOM3_BLOCK_LOG2;
+}
+
+static unsigned int bloom3_block_bit(const unsigned char *sha, const int i)
+{
+    return ((sha[8 + 2 * i] << 8) | sha[9 + 2 * i]) & 0x1ff;
+}
+
+static void bloom3_set_bits(unsigned char *bloom, const unsigned char *sha,
+                            const int nbits, const int k)
+{
+    unsigned char *block = bloom + BLOOM2_HEADERLEN
+        + bloom3_block_offset(sha, nbits);
+    int i;
+    for (i = 0; i < k; i++)
+    {
+        const unsigned int bit = bloom3_block_bit(sha, i);
+        block[bit >> 3] |= 1 << (bit & 0x7);
+    }
+}
+
+static int bloom3_get_bits(const unsigned char *bloom, const unsigned char *sha,
+                           const int nbits, const int k)
+{
+    const unsigned char *block = bloom + BLOOM2_HEADERLEN
+        + bloom3_block_offset(sha, nbits);
+    int i;
+    for (i = 0; i < k; i++)
+    {
+        const unsigned int bit = bloom3_block_bit(sha, i);
+        if (!(block[bit >> 3] & (1 << (bit & 0x7))))
+            return 0;
+    }
+    return 1;
+}
+
+static int bloom3_args_ok(const Py_buffer *bloom, const Py_buffer *sha,
+                          const int nbits, const int k)
+{
+    return nbits >= BLOOM3_BLOCK_LOG2 && nbits < 64 + BLOOM3_BLOCK_LOG2
+        && (uint64_t) bloom->len >= BLOOM2_HEADERLEN + ((uint64_t) 1 << nbits)
+        && k > 0 && k <= BLOOM3_MAX_K
+        && sha->len % 20 == 0;
+}
+
+static PyObject *bloom3_add(PyObject *self, PyObject *args)
+{
+    Py_buffer bloom, sha;
+    int nbits = 0, k = 0;
+    if (!PyArg_ParseTuple(args, wbuf_argf wbuf_argf "ii",
+                          &bloom, &sha, &nbits, &k))
+        return NULL;
+
+    PyObject *result = NULL;
+
+    if (!bloom3_args_ok(&bloom, &sha, nbits, k))
+        goto clean_and_return;
+
+    const unsigned char *cur = sha.buf;
+    const unsigned char *end = cur + sha.len;
+    for (; cur < end; cur += 20)
+        bloom3_set_bits(bloom.buf, cur, nbits, k);
+
+    result = Py_BuildValue("n", sha.len / 20);
+
+ clean_and_return:
+    PyBuffer_Release(&bloom);
+    PyBuffer_Release(&sha);
+    return result;
+}
+
+static PyObject *bloom3_contains(PyObject *self, PyObject *args)
+{
+    Py_buffer bloom, sha;
+    int nbits = 0, k = 0;
+    if (!PyArg_ParseTuple(args, wbuf_argf wbuf_argf "ii",
+                          &bloom, &sha, &nbits, &k))
+        return NULL;
+
+    PyObject *result = NULL;
+
+    if (sha.len != 20 || !bloom3_args_ok(&bloom, &sha, nbits, k))
+        goto clean_and_return;
+
+    // Always one step, i.e. one block
+    if (bloom3_get_bits(bloom.buf, sha.buf, nbits, k))
+        result = Py_BuildValue("ii", 1, 1);
+    else
+        result = Py_BuildValue("Oi", Py_None, 1);
+
+ clean_and_return:
+    PyBuffer_Release(&bloom);
+    PyBuffer_Release(&sha);
+    return result;
+}
+
+static PyObject *bloom3_contains_many(PyObject *self, PyObject *args)
+{
+    Py_buffer bloom, sha;
+    int nbits = 0, k = 0;
+    if (!PyArg_ParseTuple(args, wbuf_argf wbuf_argf "ii",
+                          &bloom, &sha, &nbits, &k))
+        return NULL;
+
+    PyObject *result = NULL;
+
+    if (!bloom3_args_ok(&bloom, &sha, nbits, k))
+        goto clean_and_return;
+
+    result = PyBytes_FromStringAndSize(NULL, sha.len / 20);
+    if (!result)
+        goto clean_and_return;
+    char *found = PyBytes_AS_STRING(result);
+    const unsigned char *cur = sha.buf;
+    const unsigned char *end = cur + sha.len;
+    for (; cur < end; cur += 20)
+        *found++ = bloom3_get_bits(bloom.buf, cur, nbits, k);
+
+ clean_and_return:
+    PyBuffer_Release(&bloom);
+    PyBuffer_Release(&sha);
+    return result;
+}
+
+
 static uint32_t _extract_bits(unsigned char *buf, int nbits)
 {
     uint32_t v, mask;
@@ -1346,12 +1529,14 @@ static unsigned int vuint_encode(long long val, char *buf)
     return len;
 }
 
-static unsigned int vint_encode(long long val, char *buf)
+static unsigned int vint_encode(long long x, char *buf)
 {
     unsigned int len = 1;
     char sign = 0;
+    // Unsigned, so that LLONG_MIN's magnitude is representable
+    unsigned long long val = x;
 
-    if (val < 0) {
+    if (x < 0) {
         sign = 0x40;
         val = -val;
     }
@@ -1376,7 +1561,7 @@ static PyObject *bup_vuint_encode(PyObject *self, PyObject *args)
 {
     long long val;
     // size the buffer appropriately - need 8 bits to encode each 7
-    char buf[(sizeof(val) + 1) / 7 * 8];
+    char buf[(sizeof(val) * 8 + 6) / 7];
 
     if (!PyArg_ParseTuple(args, "L", &val))
 	return NULL;
@@ -1392,7 +1577,7 @@ static PyObject *bup_vint_encode(PyObject *self, PyObject *args)
 {
     long long val;
     // size the buffer appropriately - need 8 bits to encode each 7
-    char buf[(sizeof(val) + 1) / 7 * 8];
+    char buf[(sizeof(val) * 8 + 6) / 7];
 
     if (!PyArg_ParseTuple(args, "L", &val))
 	return NULL;
@@ -1990,6 +2175,663 @@ static PyObject *bup_limited_vint_pack(PyObject *self, PyObject *args)
     return NULL;
 }
 
+// Metadata record codec, matching Metadata.encode() and
+// Metadata.read() in metadata.py, for the fields in the order given
+// by metadata._codec_fields.
+
+enum {
+    META_PATH, META_MODE, META_UID, META_USER, META_GID, META_GROUP,
+    META_RDEV, META_ATIME, META_MTIME, META_CTIME, META_SIZE,
+    META_SYMLINK_TARGET, META_HARDLINK_TARGET, META_POSIX1E_ACL,
+    META_LINUX_ATTR, META_LINUX_XATTR, META_FIELD_COUNT
+};
+
+#define META_TAG_END 0
+#define META_TAG_PATH 1
+#define META_TAG_COMMON_V1 2
+#define META_TAG_SYMLINK_TARGET 3
+#define META_TAG_POSIX1E_ACL_V1 4
+#define META_TAG_LINUX_ATTR 6
+#define META_TAG_LINUX_XATTR 7
+#define META_TAG_HARDLINK_TARGET 8
+#define META_TAG_COMMON_V2 9
+#define META_TAG_COMMON_V3 10
+#define META_TAG_POSIX1E_ACL_V2 11
+
+#define NSEC_PER_SEC 1000000000LL
+
+typedef struct {
+    char *data;
+    size_t len, size;
+} meta_buf_t;
+
+static int meta_reserve(meta_buf_t *b, size_t n)
+{
+    if (b->size - b->len >= n)
+        return 1;
+    size_t size = b->size ? b->size : 256;
+    while (size - b->len < n) {
+        if (!INT_MULTIPLY_OK(size, 2, &size)) {
+            PyErr_NoMemory();
+            return 0;
+        }
+    }
+    char *data = PyMem_Realloc(b->data, size);
+    if (!data) {
+        PyErr_NoMemory();
+        return 0;
+    }
+    b->data = data;
+    b->size = size;
+    return 1;
+}
+
+static int meta_put(meta_buf_t *b, const char *data, size_t n)
+{
+    if (!meta_reserve(b, n))
+        return 0;
+    memcpy(b->data + b->len, data, n);
+    b->len += n;
+    return 1;
+}
+
+static int meta_put_vuint(meta_buf_t *b, long long val)
+{
+    if (!meta_reserve(b, 10))
+        return 0;
+    unsigned int len = vuint_encode(val, b->data + b->len);
+    if (!len)
+        return 0;
+    b->len += len;
+    return 1;
+}
+
+static int meta_long(PyObject *obj, long long *val)
+{
+    *val = PyLong_AsLongLong(obj);
+    return !(*val == -1 && PyErr_Occurred());
+}
+
+static int meta_pack_vuint(meta_buf_t *b, PyObject *obj)
+{
+    long long val;
+    if (!meta_long(obj, &val))
+        return 0;
+    return meta_put_vuint(b, val);
+}
+
+static int meta_put_vint(meta_buf_t *b, long long val)
+{
+    if (!meta_reserve(b, 10))
+        return 0;
+    b->len += vint_encode(val, b->data + b->len);
+    return 1;
+}
+
+static int meta_pack_vint(meta_buf_t *b, PyObject *obj)
+{
+    long long val;
+    if (!meta_long(obj, &val))
+        return 0;
+    return meta_put_vint(b, val);
+}
+
+static int meta_pack_bytes(meta_buf_t *b, PyObject *obj)
+{
+    if (!PyBytes_Check(obj)) {
+        PyErr_Format(PyExc_TypeError, "expected bytes, not %s",
+                     Py_TYPE(obj)->tp_name);
+        return 0;
+    }
+    Py_ssize_t n = PyBytes_GET_SIZE(obj);
+    return meta_put_vuint(b, n) && meta_put(b, PyBytes_AS_STRING(obj), n);
+}
+
+static int meta_pack_time(meta_buf_t *b, PyObject *obj)
+{
+    long long ns;
+    if (!meta_long(obj, &ns))
+        return 0;
+    long long secs = ns / NSEC_PER_SEC, rem = ns % NSEC_PER_SEC;
+    if (rem < 0) {
+        rem += NSEC_PER_SEC;
+        secs -= 1;
+    }
+    return meta_put_vint(b, secs) && meta_put_vuint(b, rem);
+}
+
+// Append the tag and the (length prefixed) record, unless it's empty
+static int meta_put_record(meta_buf_t *b, int tag, const meta_buf_t *rec)
+{
+    if (!rec->len)
+        return 1;
+    return meta_put_vuint(b, tag) && meta_put_vuint(b, rec->len)
+        && meta_put(b, rec->data, rec->len);
+}
+
+static int meta_encode_common(meta_buf_t *rec, PyObject **f)
+{
+    int ok = meta_pack_vint(rec, f[META_MODE])
+        && meta_pack_vint(rec, f[META_UID])
+        && meta_pack_bytes(rec, f[META_USER])
+        && meta_pack_vint(rec, f[META_GID])
+        && meta_pack_bytes(rec, f[META_GROUP])
+        && meta_pack_vint(rec, f[META_RDEV])
+        && meta_pack_time(rec, f[META_ATIME])
+        && meta_pack_time(rec, f[META_MTIME])
+        && meta_pack_time(rec, f[META_CTIME]);
+    if (!ok)
+        return 0;
+    if (f[META_SIZE] == Py_None)
+        return meta_put_vint(rec, -1);
+    return meta_pack_vint(rec, f[META_SIZE]);
+}
+
+static int meta_encode_acl(meta_buf_t *rec, PyObject *acl)
+{
+    PyObject *seq = PySequence_Fast(acl, "ACL must be a sequence");
+    if (!seq)
+        return 0;
+    Py_ssize_t n = PySequence_Fast_GET_SIZE(seq);
+    int ok = 0;
+    if (n == 2) {
+        ok = meta_pack_bytes(rec, PySequence_Fast_GET_ITEM(seq, 0))
+            && meta_pack_bytes(rec, PySequence_Fast_GET_ITEM(seq, 1))
+            && meta_put_vuint(rec, 0) && meta_put_vuint(rec, 0);
+    } else if (n < 4) {
+        PyErr_SetString(PyExc_IndexError, "tuple index out of range");
+    } else {
+        ok = 1;
+        for (Py_ssize_t i = 0; ok && i < 4; i++)
+            ok = meta_pack_bytes(rec, PySequence_Fast_GET_ITEM(seq, i));
+    }
+    Py_DECREF(seq);
+    return ok;
+}
+
+static int meta_encode_xattr(meta_buf_t *rec, PyObject *xattrs)
+{
+    PyObject *seq = PySequence_Fast(xattrs, "xattrs must be a sequence");
+    if (!seq)
+        return 0;
+    Py_ssize_t n = PySequence_Fast_GET_SIZE(seq);
+    int ok = meta_put_vuint(rec, n);
+    for (Py_ssize_t i = 0; ok && i < n; i++) {
+        PyObject *pair = PySequence_Fast(PySequence_Fast_GET_ITEM(seq, i),
+                                         "xattr must be a (name, value) pair");
+        if (!pair) {
+            ok = 0;
+            break;
+        }
+        if (PySequence_Fast_GET_SIZE(pair) != 2) {
+            PyErr_SetString(PyExc_ValueError, "xattr must be a (name, value) pair");
+            ok = 0;
+        } else
+            ok = meta_pack_bytes(rec, PySequence_Fast_GET_ITEM(pair, 0))
+                && meta_pack_bytes(rec, PySequence_Fast_GET_ITEM(pair, 1));
+        Py_DECREF(pair);
+    }
+    Py_DECREF(seq);
+    return ok;
+}
+
+static int meta_encode_raw(meta_buf_t *rec, PyObject *obj)
+{
+    if (!PyBytes_Check(obj)) {
+        PyErr_Format(PyExc_TypeError, "expected bytes, not %s",
+                     Py_TYPE(obj)->tp_name);
+        return 0;
+    }
+    return meta_put(rec, PyBytes_AS_STRING(obj), PyBytes_GET_SIZE(obj));
+}
+
+static PyObject *bup_metadata_encode(PyObject *self, PyObject *args)
+{
+    PyObject *fields;
+    if (!PyArg_ParseTuple(args, "O!", &PyTuple_Type, &fields))
+        return NULL;
+    if (PyTuple_GET_SIZE(fields) != META_FIELD_COUNT)
+        return PyErr_Format(PyExc_ValueError, "expected %d metadata fields",
+                            META_FIELD_COUNT);
+    PyObject **f = &PyTuple_GET_ITEM(fields, 0);
+
+    meta_buf_t out = { NULL, 0, 0 }, rec = { NULL, 0, 0 };
+    PyObject *result = NULL;
+    int truth;
+
+#define META_TRUTH(field) \
+    if ((truth = PyObject_IsTrue(f[field])) < 0) goto done;
+
+    META_TRUTH(META_PATH);
+    if (truth) {
+        rec.len = 0;
+        if (!meta_pack_bytes(&rec, f[META_PATH])
+            || !meta_put_record(&out, META_TAG_PATH, &rec))
+            goto done;
+    }
+    META_TRUTH(META_MODE);
+    if (truth) {
+        rec.len = 0;
+        if (!meta_encode_common(&rec, f)
+            || !meta_put_record(&out, META_TAG_COMMON_V3, &rec))
+            goto done;
+    }
+    static const int raw_fields[][2] = {
+        { META_SYMLINK_TARGET, META_TAG_SYMLINK_TARGET },
+        { META_HARDLINK_TARGET, META_TAG_HARDLINK_TARGET }
+    };
+    for (size_t i = 0; i < sizeof(raw_fields) / sizeof(raw_fields[0]); i++) {
+        META_TRUTH(raw_fields[i][0]);
+        if (truth) {
+            rec.len = 0;
+            if (!meta_encode_raw(&rec, f[raw_fields[i][0]])
+                || !meta_put_record(&out, raw_fields[i][1], &rec))
+                goto done;
+        }
+    }
+    META_TRUTH(META_POSIX1E_ACL);
+    if (truth) {
+        rec.len = 0;
+        if (!meta_encode_acl(&rec, f[META_POSIX1E_ACL])
+            || !meta_put_record(&out, META_TAG_POSIX1E_ACL_V2, &rec))
+            goto done;
+    }
+    META_TRUTH(META_LINUX_ATTR);
+    if (truth) {
+        rec.len = 0;
+        if (!meta_pack_vuint(&rec, f[META_LINUX_ATTR])
+            || !meta_put_record(&out, META_TAG_LINUX_ATTR, &rec))
+            goto done;
+    }
+    META_TRUTH(META_LINUX_XATTR);
+    if (truth) {
+        rec.len = 0;
+        if (!meta_encode_xattr(&rec, f[META_LINUX_XATTR])
+            || !meta_put_record(&out, META_TAG_LINUX_XATTR, &rec))
+            goto done;
+    }
+#undef META_TRUTH
+    if (!meta_put_vuint(&out, META_TAG_END))
+        goto done;
+    result = PyBytes_FromStringAndSize(out.data, out.len);
+ done:
+    PyMem_Free(out.data);
+    PyMem_Free(rec.data);
+    return result;
+}
+
+// Decoding: the meta_get_* functions return 1 on success, 0 if the
+// data can't be handled here (e.g. it's truncated, or a value is too
+// large), in which case the caller should defer to the Python code,
+// and -1 on error (with an exception set).
+
+static int meta_get_vuint(const unsigned char **p, const unsigned char *end,
+                          unsigned long long *val)
+{
+    unsigned long long result = 0;
+    int shift = 0;
+    while (*p < end) {
+        unsigned char c = *(*p)++;
+        if (shift > 63 || (shift == 63 && (c & 0x7e)))
+            return 0;
+        result |= (unsigned long long) (c & 0x7f) << shift;
+        if (!(c & 0x80)) {
+            *val = result;
+            return 1;
+        }
+        shift += 7;
+    }
+    return 0;
+}
+
+static int meta_get_vint(const unsigned char **p, const unsigned char *end,
+                         long long *val)
+{
+    if (*p >= end)
+        return 0;
+    unsigned char c = *(*p)++;
+    int negative = c & 0x40;
+    unsigned long long result = c & 0x3f;
+    if (c & 0x80) {
+        unsigned long long rest;
+        if (!meta_get_vuint(p, end, &rest))
+            return 0;
+        if (rest > (LLONG_MAX >> 6))
+            return 0;
+        result |= rest << 6;
+    }
+    *val = negative ? -(long long) result : (long long) result;
+    return 1;
+}
+
+static int meta_get_bytes(const unsigned char **p, const unsigned char *end,
+                          PyObject **val)
+{
+    unsigned long long n;
+    if (!meta_get_vuint(p, end, &n))
+        return 0;
+    if (n > (unsigned long long) (end - *p))
+        return 0;
+    PyObject *result = PyBytes_FromStringAndSize((const char *) *p, n);
+    if (!result)
+        return -1;
+    *p += n;
+    Py_XDECREF(*val);
+    *val = result;
+    return 1;
+}
+
+static int meta_set(PyObject **field, PyObject *val)
+{
+    if (!val)
+        return -1;
+    Py_XDECREF(*field);
+    *field = val;
+    return 1;
+}
+
+static int meta_get_ns(const unsigned char **p, const unsigned char *end,
+                       PyObject **field)
+{
+    long long secs, ns;
+    unsigned long long ns_part;
+    if (!meta_get_vint(p, end, &secs) || !meta_get_vuint(p, end, &ns_part))
+        return 0;
+    if (!INT_MULTIPLY_OK(secs, NSEC_PER_SEC, &ns)
+        || !INT_ADD_OK(ns, ns_part, &ns))
+        return 0;
+    return meta_set(field, PyLong_FromLongLong(ns));
+}
+
+// Decode a common record, where the mode, uid, gid, and rdev are
+// vuints in version 1, and vints afterward.
+static int meta_decode_common(const unsigned char *p, const unsigned char *end,
+                              int version, PyObject **f)
+{
+    static const int ids[] = { META_MODE, META_UID, META_GID, META_RDEV };
+    int rc;
+    for (size_t i = 0; i < sizeof(ids) / sizeof(ids[0]); i++) {
+        PyObject *val;
+        if (version == 1) {
+            unsigned long long v;
+            if (!meta_get_vuint(&p, end, &v))
+                return 0;
+            val = PyLong_FromUnsignedLongLong(v);
+        } else {
+            long long v;
+            if (!meta_get_vint(&p, end, &v))
+                return 0;
+            val = PyLong_FromLongLong(v);
+        }
+        if ((rc = meta_set(&f[ids[i]], val)) != 1)
+            return rc;
+        if (ids[i] == META_UID || ids[i] == META_GID) {
+            int name = ids[i] == META_UID ? META_USER : META_GROUP;
+            if ((rc = meta_get_bytes(&p, end, &f[name])) != 1)
+                return rc;
+        }
+    }
+    if ((rc = meta_get_ns(&p, end, &f[META_ATIME])) != 1
+        || (rc = meta_get_ns(&p, end, &f[META_MTIME])) != 1
+        || (rc = meta_get_ns(&p, end, &f[META_CTIME])) != 1)
+        return rc;
+    if (version == 3) {
+        long long size;
+        if (!meta_get_vint(&p, end, &size))
+            return 0;
+        if (size >= 0)
+            return meta_set(&f[META_SIZE], PyLong_FromLongLong(size));
+    }
+    return 1;
+}
+
+static int meta_decode_acl(const unsigned char *p, const unsigned char *end,
+                           PyObject **f)
+{
+    PyObject *acl[4] = { NULL, NULL, NULL, NULL };
+    int rc = 1;
+    for (int i = 0; rc == 1 && i < 4; i++)
+        rc = meta_get_bytes(&p, end, &acl[i]);
+    if (rc == 1) {
+        if (PyBytes_GET_SIZE(acl[2]) == 0)
+            rc = meta_set(&f[META_POSIX1E_ACL],
+                          PyTuple_Pack(2, acl[0], acl[1]));
+        else
+            rc = meta_set(&f[META_POSIX1E_ACL],
+                          PyTuple_Pack(4, acl[0], acl[1], acl[2], acl[3]));
+    }
+    for (int i = 0; i < 4; i++)
+        Py_XDECREF(acl[i]);
+    return rc;
+}
+
+static int meta_decode_xattr(const unsigned char *p, const unsigned char *end,
+                             PyObject **f)
+{
+    unsigned long long n;
+    if (!meta_get_vuint(&p, end, &n))
+        return 0;
+    // Each xattr requires at least two bytes
+    if (n > (unsigned long long) (end - p) / 2)
+        return 0;
+    PyObject *result = PyList_New(n);
+    if (!result)
+        return -1;
+    int rc = 1;
+    for (Py_ssize_t i = 0; rc == 1 && i < (Py_ssize_t) n; i++) {
+        PyObject *name = NULL, *value = NULL;
+        if ((rc = meta_get_bytes(&p, end, &name)) == 1
+            && (rc = meta_get_bytes(&p, end, &value)) == 1) {
+            PyObject *pair = PyTuple_Pack(2, name, value);
+            if (pair)
+                PyList_SET_ITEM(result, i, pair);
+            else
+                rc = -1;
+        }
+        Py_XDECREF(name);
+        Py_XDECREF(value);
+    }
+    if (rc != 1) {
+        Py_DECREF(result);
+        return rc;
+    }
+    return meta_set(&f[META_LINUX_XATTR], result);
+}
+
+// Decode the records in [*p, end) up to and including the end tag
+static int meta_decode_records(const unsigned char **p,
+                               const unsigned char *end, PyObject **f)
+{
+    for (;;) {
+        unsigned long long tag, n;
+        if (!meta_get_vuint(p, end, &tag))
+            return 0;
+        if (tag == META_TAG_END)
+            return 1;
+        if (!meta_get_vuint(p, end, &n) || n > (unsigned long long) (end - *p))
+            return 0;
+        const unsigned char *rec = *p, *rec_end = *p + n;
+        *p = rec_end;
+        int rc = 1;
+        switch (tag) {
+        case META_TAG_PATH:
+            rc = meta_get_bytes(&rec, rec_end, &f[META_PATH]);
+            break;
+        case META_TAG_COMMON_V1:
+            rc = meta_decode_common(rec, rec_end, 1, f);
+            break;
+        case META_TAG_COMMON_V2:
+            rc = meta_decode_common(rec, rec_end, 2, f);
+            break;
+        case META_TAG_COMMON_V3:
+            rc = meta_decode_common(rec, rec_end, 3, f);
+            break;
+        case META_TAG_SYMLINK_TARGET:
+            if (f[META_SIZE] == Py_None) {
+                rc = meta_set(&f[META_SIZE], PyLong_FromSsize_t(n));
+            } else {
+                long long size = PyLong_AsLongLong(f[META_SIZE]);
+                if (size == -1 && PyErr_Occurred())
+                    return -1;
+                if ((unsigned long long) size != n)
+                    return 0; // the Python code will complain
+            }
+            if (rc == 1)
+                rc = meta_set(&f[META_SYMLINK_TARGET],
+                              PyBytes_FromStringAndSize((const char *) rec, n));
+            break;
+        case META_TAG_HARDLINK_TARGET:
+            rc = meta_set(&f[META_HARDLINK_TARGET],
+                          PyBytes_FromStringAndSize((const char *) rec, n));
+            break;
+        case META_TAG_POSIX1E_ACL_V2:
+            rc = meta_decode_acl(rec, rec_end, f);
+            break;
+        case META_TAG_POSIX1E_ACL_V1:
+            return 0; // requires delimiter repair
+        case META_TAG_LINUX_ATTR: {
+            unsigned long long attr;
+            if (!meta_get_vuint(&rec, rec_end, &attr))
+                return 0;
+            rc = meta_set(&f[META_LINUX_ATTR],
+                          PyLong_FromUnsignedLongLong(attr));
+            break;
+        }
+        case META_TAG_LINUX_XATTR:
+            rc = meta_decode_xattr(rec, rec_end, f);
+            break;
+        default: // unknown record, skip it
+            if (n == 0)
+                return 0; // the Python code rejects these
+        }
+        if (rc != 1)
+            return rc;
+    }
+}
+
+// Return NULL on error, NotImplemented if the Python code must handle
+// the entry, None if there's no entry at p, and otherwise (fields,
+// end) where fields is None for an empty entry (just an end tag).
+static PyObject *meta_decode_one(const unsigned char *start,
+                                 const unsigned char *p,
+                                 const unsigned char *end)
+{
+    if (p >= end)
+        Py_RETURN_NONE;
+    if (*p == META_TAG_END)
+        return Py_BuildValue("(On)", Py_None, p + 1 - start);
+
+    PyObject *f[META_FIELD_COUNT];
+    for (int i = 0; i < META_FIELD_COUNT; i++) {
+        Py_INCREF(Py_None);
+        f[i] = Py_None;
+    }
+    PyObject *result = NULL;
+    int rc = meta_decode_records(&p, end, f);
+    if (rc == 0)
+        {
+        Py_INCREF(Py_NotImplemented);
+        result = Py_NotImplemented;
+    }
+    else if (rc == 1) {
+        PyObject *fields = PyTuple_New(META_FIELD_COUNT);
+        if (fields) {
+            for (int i = 0; i < META_FIELD_COUNT; i++) {
+                PyTuple_SET_ITEM(fields, i, f[i]);
+                f[i] = NULL;
+            }
+            result = Py_BuildValue("(Nn)", fields, p - start);
+        }
+    }
+    for (int i = 0; i < META_FIELD_COUNT; i++)
+        Py_XDECREF(f[i]);
+    return result;
+}
+
+static PyObject *bup_metadata_decode(PyObject *self, PyObject *args)
+{
+    Py_buffer buf;
+    Py_ssize_t ofs;
+    if (!PyArg_ParseTuple(args, "y*" "n", &buf, &ofs))
+        return NULL;
+    PyObject *result;
+    if (ofs < 0 || ofs > buf.len)
+        result = PyErr_Format(PyExc_ValueError, "invalid offset %zd", ofs);
+    else
+        result = meta_decode_one(buf.buf, (unsigned char *) buf.buf + ofs,
+                                 (unsigned char *) buf.buf + buf.len);
+    PyBuffer_Release(&buf);
+    return result;
+}
+
+static PyObject *bup_metadata_decode_all(PyObject *self, PyObject *args)
+{
+    Py_buffer buf;
+    if (!PyArg_ParseTuple(args, "y*", &buf))
+        return NULL;
+    const unsigned char *start = buf.buf, *end = start + buf.len;
+    PyObject *result = PyList_New(0);
+    Py_ssize_t ofs = 0;
+    while (result && ofs < buf.len) {
+        PyObject *entry = meta_decode_one(start, start + ofs, end);
+        if (!entry || entry == Py_NotImplemented) {
+            Py_CLEAR(result);
+            result = entry;
+            break;
+        }
+        ofs = PyLong_AsSsize_t(PyTuple_GET_ITEM(entry, 1));
+        int rc = PyList_Append(result, PyTuple_GET_ITEM(entry, 0));
+        Py_DECREF(entry);
+        if (rc)
+            Py_CLEAR(result);
+    }
+    PyBuffer_Release(&buf);
+    return result;
+}
+
+// Return a list of the (still encoded) metadata entries in the buffer,
+// without decoding the records.
+static PyObject *bup_metadata_split(PyObject *self, PyObject *args)
+{
+    Py_buffer buf;
+    if (!PyArg_ParseTuple(args, "y*", &buf))
+        return NULL;
+    const unsigned char *start = buf.buf, *p = start, *end = start + buf.len;
+    PyObject *result = PyList_New(0);
+    while (result && p < end) {
+        const unsigned char *entry = p;
+        for (;;) {
+            // The tag, which may be unknown (and so arbitrarily large)
+            int more, nonzero = 0;
+            do {
+                if (p >= end)
+                    goto eof;
+                more = *p & 0x80;
+                nonzero |= *p++ & 0x7f;
+            } while (more);
+            if (!nonzero)
+                break;
+            unsigned long long n;
+            if (!meta_get_vuint(&p, end, &n)
+                || n > (unsigned long long) (end - p))
+                goto eof;
+            p += n;
+        }
+        PyObject *encoded =
+            PyBytes_FromStringAndSize((const char *) entry, p - entry);
+        if (!encoded || PyList_Append(result, encoded))
+            Py_CLEAR(result);
+        Py_XDECREF(encoded);
+    }
+    PyBuffer_Release(&buf);
+    return result;
+ eof:
+    Py_DECREF(result);
+    PyBuffer_Release(&buf);
+    PyErr_SetString(PyExc_EOFError, "EOF within Metadata entry");
+    return NULL;
+}
+
 static PyObject *pos_inf;
 static PyObject *neg_inf;
 
@@ -2028,6 +2870,17 @@ static PyMethodDef helper_methods[] = {
 	"Check if a bloom filter of 2^nbits bytes contains an object" },
     { "bloom_add", bloom_add, METH_VARARGS,
 	"Add an object to a bloom filter of 2^nbits bytes" },
+    { "bloom_contains_many", bloom_contains_many, METH_VARARGS,
+	"Return bytes indicating whether a bloom filter of 2^nbits bytes"
+        " contains each of the concatenated objects" },
+    { "bloom3_contains", bloom3_contains, METH_VARARGS,
+	"Check if a blocked bloom filter of 2^nbits bytes contains an object" },
+    { "bloom3_contains_many", bloom3_contains_many, METH_VARARGS,
+	"Return bytes indicating whether a blocked bloom filter of 2^nbits"
+        " bytes contains each of the concatenated objects" },
+    { "bloom3_add", bloom3_add, METH_VARARGS,
+	"Add the concatenated objects to a blocked bloom filter of"
+        " 2^nbits bytes" },
     { "extract_bits", extract_bits, METH_VARARGS,
 	"Take the first 'nbits' bits from 'buf' and return them as an int." },
     { "merge_into", merge_into, METH_VARARGS,
@@ -2106,6 +2959,14 @@ static PyMethodDef helper_methods[] = {
     { "vint_encode", bup_vint_encode, METH_VARARGS, "encode an int to vint" },
     { "limited_vint_pack", bup_limited_vint_pack, METH_VARARGS,
       "Try to pack vint/vuint/str, throwing OverflowError when unable." },
+    { "metadata_encode", bup_metadata_encode, METH_VARARGS,
+      "Return the encoding of the metadata fields tuple." },
+    { "metadata_decode", bup_metadata_decode, METH_VARARGS,
+      "Decode the metadata entry at the buffer offset." },
+    { "metadata_decode_all", bup_metadata_decode_all, METH_VARARGS,
+      "Decode all of the metadata entries in the buffer." },
+    { "metadata_split", bup_metadata_split, METH_VARARGS,
+      "Return a list of the encoded metadata entries in the buffer." },
     { "strtoimax", bup_strtoimax, METH_VARARGS,
       "Return value and index of first byte after value as per strtoimax(1)" },
     { NULL, NULL, 0, NULL },  // sentinel
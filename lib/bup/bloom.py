@@ -78,11 +78,33 @@ table with k=5 can represent the repository.
 None of this tells us what max_pfalse_positive to choose.
 
 Brandon Low <lostlogic@lostlogicx.com> 2011-02-04
+
+Version 3 filters use a "blocked" layout instead: the table is a
+sequence of 64 byte (512 bit) blocks, the first 64 bits of the SHA
+select a block, and the next k 16-bit words of the SHA each select a
+bit within it (via their low 9 bits).  That means a lookup only
+touches one cache line (and one page) instead of k, which matters
+when the filter is far larger than the CPU caches, at the cost of a
+slightly higher false positive rate for the same size, since the
+blocks aren't evenly loaded (see pfalse_positive()).  The SHA also no
+longer limits the size of the filter, so k=5 can always be used.
+Version 2 filters remain readable and updatable, but new filters are
+version 3.
+
+Since a filter can't grow, when adding new entries would push a filter
+past MAX_PFALSE_POSITIVE, bup bloom adds a new, larger filter segment
+(e.g. bup.1.bloom after bup.bloom; see segment_path()) instead of
+regenerating the whole filter from every idx, and SegmentedBloomReader
+consults all of the segments.  Each new segment is sized for at least
+twice the entries of the previous one, so the number of segments
+(and the combined false positive rate, roughly the sum of the
+segments' rates) only grows logarithmically with the repository, and
+adding new entries only ever modifies the newest segment.
 """
 
 from contextlib import ExitStack
 from tempfile import mkstemp
-import builtins, os, math, struct
+import builtins, glob, os, math, re, struct
 
 from bup import _helpers
 from bup.helpers import \
@@ -98,16 +120,56 @@ from bup.helpers import \
 from bup.io import initial_umask, path_msg as pm
 
 
-BLOOM_VERSION = 2
+BLOOM_VERSION = 3 # for new filters
+READABLE_VERSIONS = (2, 3)
 MAX_BITS_EACH = 32 # Kinda arbitrary, but 4 bytes per entry is pretty big
-MAX_BLOOM_BITS = {4: 37, 5: 29} # 160/k-log2(8)
+MAX_BLOOM_BITS = {4: 37, 5: 29} # 160/k-log2(8), for version 2
+MAX_BLOCKED_BLOOM_BITS = 40 # 1TiB, for version 3 (the SHA allows 70)
 MAX_PFALSE_POSITIVE = 1. # Totally arbitrary, needs benchmarking
 
 _total_searches = 0
 _total_steps = 0
 
 bloom_contains = _helpers.bloom_contains
+bloom_contains_many = _helpers.bloom_contains_many
 bloom_add = _helpers.bloom_add
+bloom3_contains = _helpers.bloom3_contains
+bloom3_contains_many = _helpers.bloom3_contains_many
+bloom3_add = _helpers.bloom3_add
+
+_contains = {2: bloom_contains, 3: bloom3_contains}
+_contains_many = {2: bloom_contains_many, 3: bloom3_contains_many}
+_add = {2: bloom_add, 3: bloom3_add}
+
+
+def max_bits(version, k):
+    """Return the largest table size (log2 bytes) supported for a
+    filter of the given version and k."""
+    if version == 2:
+        return MAX_BLOOM_BITS[k]
+    assert version == 3, version
+    return MAX_BLOCKED_BLOOM_BITS
+
+
+def pfalse_positive(version, bits, k, entries):
+    """Return the percentage chance of a false positive for a filter
+    of the given version and size (log2 bytes) with entries added."""
+    if version == 2:
+        m = 8*2**bits
+        return 100*(1-math.exp(-k*float(entries)/m))**k
+    assert version == 3, version
+    # The number of entries in each block is approximately Poisson
+    # distributed, and a block with i entries has had k*i of its 512
+    # bits set at random.
+    load = float(entries) / 2**(bits - 6)
+    if load == 0:
+        return 0.
+    spread = 10 * math.sqrt(load) + 10
+    result = 0.
+    for i in range(max(0, int(load - spread)), int(load + spread) + 1):
+        p_i = math.exp(i * math.log(load) - load - math.lgamma(i + 1))
+        result += p_i * (1 - (1 - 1/512)**(k*i))**k
+    return min(100., 100*result) # the sum may round up past 1
 
 
 class _BloomBase:
@@ -132,10 +194,8 @@ class _BloomBase:
 
     def pfalse_positive(self, additional=0):
         assert self.map
-        n = self.entries + additional
-        m = 8*2**self.bits
-        k = self.k
-        return 100*(1-math.exp(-k*float(n)/m))**k
+        return pfalse_positive(self.version, self.bits, self.k,
+                               self.entries + additional)
 
     def exists(self, sha):
         """Return nonempty if the object probably exists in the bloom filter.
@@ -149,10 +209,18 @@ class _BloomBase:
         _total_searches += 1
         if not self.map:
             return None
-        found, steps = bloom_contains(self.map, sha, self.bits, self.k)
+        found, steps = _contains[self.version](self.map, sha, self.bits,
+                                               self.k)
         _total_steps += steps
         return found
 
+    def exists_many(self, shas):
+        """Return bytes containing a 1 for each of the concatenated
+        shas that probably exists in the filter, and 0 otherwise."""
+        assert self.map
+        return _contains_many[self.version](self.map, shas, self.bits,
+                                            self.k)
+
     def __len__(self):
         assert self.map
         return self.entries
@@ -167,11 +235,13 @@ def _validate_and_get_info(path, data):
     if got != b'BLOM':
         raise BloomInvalid(f'invalid BLOM header ({pm(got)}) in {pm(path)}')
     ver = struct.unpack('!I', data[4:8])[0]
-    if ver < BLOOM_VERSION:
+    if ver < READABLE_VERSIONS[0]:
         raise BloomInvalid(f'old-style (v{ver}) bloom {pm(path)}')
-    if ver > BLOOM_VERSION:
+    if ver > READABLE_VERSIONS[-1]:
         raise BloomInvalid(f'too-new (v{ver}) bloom {pm(path)}')
     bits, k, entries = struct.unpack('!HHI', data[8:16])
+    if ver == 3 and not (6 <= bits <= 69 and 0 < k <= 6):
+        raise BloomInvalid(f'invalid v3 bits {bits} or k {k} in {pm(path)}')
     idxnames = data[16 + 2**bits:]
     idxnames = idxnames.split(b'\0') if idxnames else []
     return ver, bits, k, entries, idxnames
@@ -203,14 +273,19 @@ class BloomReader(_BloomBase):
     def __exit__(self, type, value, traceback): self.close()
 
 
-def _create(path, expected, k):
+def _create(path, expected, k, version):
     with ExitStack() as ctx:
         bits = int(math.floor(math.log(expected * MAX_BITS_EACH // 8, 2)))
-        k = k or ((bits <= MAX_BLOOM_BITS[5]) and 5 or 4)
-        if bits > MAX_BLOOM_BITS[k]:
+        if version == 2:
+            k = k or ((bits <= MAX_BLOOM_BITS[5]) and 5 or 4)
+        else:
+            bits = max(6, bits) # at least one block
+            k = k or 5
+        if bits > max_bits(version, k):
             log('bloom: warning, max bits exceeded, non-optimal\n')
-            bits = MAX_BLOOM_BITS[k]
-        debug1(f'bloom: using 2^{bits:d} bytes and {k:d} hash functions\n')
+            bits = max_bits(version, k)
+        debug1(f'bloom: using v{version} 2^{bits:d} bytes'
+               f' and {k:d} hash functions\n')
         dir, name = os.path.split(path)
         fd, tmp = mkstemp(dir=dir or os.getcwdb(), prefix=(name + b'-'))
         with ExitStack() as ctx:
@@ -219,7 +294,7 @@ def _create(path, expected, k):
             os.close(fd)
             tmp_file = ctx.enter_context(builtins.open(tmp, 'w+b'))
             tmp_file.write(b'BLOM')
-            tmp_file.write(struct.pack('!IHHI', BLOOM_VERSION, bits, k, 0))
+            tmp_file.write(struct.pack('!IHHI', version, bits, k, 0))
             assert tmp_file.tell() == 16
             # Assume POSIX truncate(), which requires zero-fill
             tmp_file.truncate(16+2**bits)
@@ -260,10 +335,12 @@ class BloomWriter(_BloomBase):
     __slots__ = ('_delaywrite', '_file', '_tmp_file_path')
 
     # pylint: disable-next=super-init-not-called
-    def __init__(self, path, mode, expected, *, delaywrite=None, k=None):
+    def __init__(self, path, mode, expected, *, delaywrite=None, k=None,
+                 version=BLOOM_VERSION):
         """Open (mode='r+b') an existing, or create (mode='w+b') a new
         bloom filter for updates.  The filter will not exist at path
-        until the instance is successfully closed.
+        until the instance is successfully closed.  The version only
+        affects new filters.
 
         """
         assert path.endswith(b'.bloom'), path
@@ -303,8 +380,9 @@ class BloomWriter(_BloomBase):
         assert expected > 0, expected
         self.entries = 0
         self.idxnames = []
-        self.version = BLOOM_VERSION
-        self._file, self.bits, self.k = _create(path, expected, k)
+        assert version in READABLE_VERSIONS, version
+        self.version = version
+        self._file, self.bits, self.k = _create(path, expected, k, version)
         self._tmp_file_path = self._file.name
         with ExitStack() as ctx:
             ctx.enter_context(finalized(self._tmp_file_path, unlink))
@@ -348,7 +426,7 @@ class BloomWriter(_BloomBase):
         """Add the hashes in ids (packed binary 20-bytes) to the filter."""
         if not self.map:
             raise Exception("Cannot add to closed bloom")
-        self.entries += bloom_add(self.map, ids, self.bits, self.k)
+        self.entries += _add[self.version](self.map, ids, self.bits, self.k)
 
     def add_idx(self, ix):
         """Add the object to the filter."""
@@ -357,5 +435,112 @@ class BloomWriter(_BloomBase):
         self.idxnames.append(os.path.basename(ix.name))
 
 
+def segment_path(path, n):
+    """Return the path of segment n of the bloom filter at path,
+    i.e. the path itself for segment 0, and then for example
+    bup.1.bloom, bup.2.bloom, ... for bup.bloom.
+
+    """
+    assert path.endswith(b'.bloom'), path
+    if n == 0:
+        return path
+    return b'%s.%d.bloom' % (path[:-len(b'.bloom')], n)
+
+
+def _later_segment_paths(path):
+    """Return the paths of all of the segments of the bloom filter at
+    path, other than segment 0, whether or not they're contiguous.
+
+    """
+    assert path.endswith(b'.bloom'), path
+    base = path[:-len(b'.bloom')]
+    seg_rx = re.compile(re.escape(base) + br'\.[0-9]+\.bloom')
+    return [x for x in glob.glob(glob.escape(base) + b'.*.bloom')
+            if seg_rx.fullmatch(x)]
+
+
+def remove_later_segments(path):
+    """Remove any segments of the bloom filter at path other than the
+    first, i.e. path itself."""
+    for seg in _later_segment_paths(path):
+        unlink(seg)
+
+
+class SegmentedBloomReader:
+    """A read-only view of all of the segments of the bloom filter at
+    path (see segment_path()), which must include path itself.  Stops
+    at the first segment that doesn't exist.
+
+    """
+    __slots__ = 'entries', 'idxnames', 'path', 'segments'
+
+    def __init__(self, path):
+        self.path = path
+        self.segments = []
+        with ExitStack() as ctx:
+            seg = BloomReader(path)
+            while True:
+                ctx.enter_context(seg)
+                self.segments.append(seg)
+                try:
+                    seg = BloomReader(segment_path(path, len(self.segments)))
+                except BloomNotFound:
+                    break
+            ctx.pop_all()
+        self.entries = sum(seg.entries for seg in self.segments)
+        self.idxnames = [name for seg in self.segments for name in seg.idxnames]
+
+    def close(self):
+        segments, self.segments = self.segments, None
+        if segments:
+            with ExitStack() as ctx:
+                for seg in segments:
+                    ctx.enter_context(seg)
+
+    def __del__(self): assert not self.segments, self.path
+    def __enter__(self): return self
+    def __exit__(self, type, value, traceback): self.close()
+
+    def __len__(self):
+        assert self.segments
+        return self.entries
+
+    def pfalse_positive(self):
+        """Return the percentage chance of a false positive across all
+        of the segments."""
+        assert self.segments
+        ptrue_negative = 1.
+        for seg in self.segments:
+            ptrue_negative *= 1 - seg.pfalse_positive() / 100
+        return 100 * (1 - ptrue_negative)
+
+    def exists(self, sha):
+        """Return nonempty if the object probably exists in one of
+        the segments (see _BloomBase.exists())."""
+        assert self.segments
+        global _total_searches, _total_steps
+        _total_searches += 1
+        for seg in self.segments:
+            found, steps = _contains[seg.version](seg.map, sha, seg.bits, seg.k)
+            _total_steps += steps
+            if found:
+                return found
+        return None
+
+    def exists_many(self, shas):
+        """Return bytes containing a 1 for each of the concatenated
+        shas that probably exists in one of the segments, and 0
+        otherwise."""
+        assert self.segments
+        result = None
+        for seg in self.segments:
+            found = seg.exists_many(shas)
+            result = found if result is None \
+                else bytes(a | b for a, b in zip(result, found))
+        return result
+
+
 def clear_bloom(dir):
-    unlink(os.path.join(dir, b'bup.bloom'))
+    path = os.path.join(dir, b'bup.bloom')
+    remove_later_segments(path)
+    unlink(path)
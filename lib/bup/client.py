@@ -10,7 +10,8 @@ from bup import git, ssh, vint, protocol
 from bup.compat import dataclass
 from bup.git import PackWriter
 from bup.helpers import \
-    (Conn,
+    (CompressedConn,
+     Conn,
      atomically_replaced_file,
      chunkyreader,
      debug1,
@@ -28,7 +29,7 @@ from bup.helpers import \
 from bup.io import path_msg as pm
 from bup.path import index_cache
 from bup.url import URL
-from bup.vint import read_vint, read_vuint, read_bvec, write_bvec
+from bup.vint import read_vint, read_vuint, read_bvec, write_bvec, write_vuint
 
 
 bwlimit = None
@@ -178,13 +179,13 @@ class Client:
                 self._out = ctx.enter_context(os.fdopen(3, 'rb'))
                 self._in = ctx.enter_context(os.fdopen(4, 'wb'))
                 self.conn = ctx.enter_context(Conn(self._out, self._in))
-                self.check_ok = self.conn.check_ok
                 sys.stdin.close()
                 ctx.pop_all()
             self._closed = False
         def __enter__(self): return self
         def __del__(self): assert self._closed
         def __exit__(self, type, value, traceback): self.close()
+        def check_ok(self, conn=None): return (conn or self.conn).check_ok()
         def close(self):
             if self._closed:
                 return
@@ -229,12 +230,12 @@ class Client:
                  closing(self.conn), \
                  closing(self._proc.stdin):
                 pass
-        def check_ok(self):
+        def check_ok(self, conn=None):
             rv = self._proc.poll()
             if rv is not None:
                 raise ClientError(f'server exited unexpectedly with code {rv}')
             try:
-                return self.conn.check_ok()
+                return (conn or self.conn).check_ok()
             except Exception as e:
                 raise ClientError(e) from e
 
@@ -255,12 +256,12 @@ class Client:
                 ctx.enter_context(closing(self._sockw))
                 self.conn = DemuxConn(self._sock.fileno(), self._sockw)
                 ctx.enter_context(closing(self.conn))
-                self.check_ok = self.conn.check_ok
                 ctx.pop_all()
             self._closed = False
         def __enter__(self): return self
         def __del__(self): assert self._closed
         def __exit__(self, type, value, traceback): self.close()
+        def check_ok(self, conn=None): return (conn or self.conn).check_ok()
         def close(self):
             if self._closed:
                 return
@@ -325,6 +326,7 @@ class Client:
                 raise ClientError(f'unrecognized URL {url}')
             ctx.enter_context(self._transport)
             self.conn = self._transport.conn
+            self._compressed_conn = None
             self._available_commands = self._get_available_commands()
             if self.path and (invalid := re.search(br'[\r\n]', self.path)):
                 bad_c = pm(invalid.group())
@@ -338,6 +340,10 @@ class Client:
                 self._require_command(b'set-dir')
                 self.conn.write(b'set-dir %s\n' % self.path)
                 self.check_ok()
+            if b'compress' in self._available_commands:
+                self._negotiate_compression()
+                if self._compressed_conn:
+                    ctx.enter_context(self._compressed_conn)
             if url.scheme == b'bup-rev':
                 legacy_id = _legacy_cache_id_for_remote(url.host, True)
             elif self.remote:
@@ -345,6 +351,13 @@ class Client:
             else: # use the decoded path
                 legacy_id = _legacy_cache_id_for_host_path(url.host, self.path)
             self.cachedir = self._prep_cache(legacy_id)
+            # When the server asks for it, check for objects via
+            # have-oids rather than by mirroring the server's indexes.
+            self._query_oids = False
+            if b'have-oids' in self._available_commands \
+               and b'config-get' in self._available_commands:
+                self._query_oids = \
+                    bool(self.config_get(b'bup.server.have-oids', opttype='bool'))
             ctx.pop_all()
         self.closed = False
 
@@ -358,10 +371,21 @@ class Client:
         self.closed = True
         if not self._busy:
             self.conn.write(b'quit\n')
-        with closing(self._transport):
+        with closing(self._transport), \
+             nullcontext_if_not(self._compressed_conn):
             self._transport = None # not necessary
 
-    def check_ok(self): return self._transport.check_ok()
+    def check_ok(self): return self._transport.check_ok(self.conn)
+
+    def _negotiate_compression(self):
+        with self._call('compress'):
+            level = self.conn.readline()
+            if not level.endswith(b'\n'):
+                raise ClientError('EOF while reading compression level')
+            level = int(level)
+        if level:
+            debug1(f'client: compressing connection (level {level})\n')
+            self._compressed_conn = self.conn = CompressedConn(self.conn, level)
 
     def check_busy(self):
         if self._busy:
@@ -431,6 +455,9 @@ class Client:
         for idx in extra:
             os.unlink(os.path.join(self.cachedir, idx))
         debug1('client: server requested load of: %s\n' % needed)
+        if self._query_oids:
+            debug1('client: querying server (have-oids) instead of loading\n')
+            needed = set()
         for idx in needed:
             self.sync_index(idx)
         git.auto_midx(self.cachedir)
@@ -461,11 +488,7 @@ class Client:
         with atomically_replaced_file(fn, 'wb') as f:
             self.send_index(name, f, lambda size: None)
 
-    def _suggest_packs(self):
-        ob = self._busy
-        if ob:
-            assert(ob == b'receive-objects-v2')
-            self.conn.write(b'\xff\xff\xff\xff')  # suspend receive-objects-v2
+    def _read_suggestions(self):
         suggested = []
         for line in linereader(self.conn):
             if not line:
@@ -482,16 +505,67 @@ class Client:
                        % git.shorten_hash(line).decode('ascii'))
                 suggested.append(line)
         self.check_ok()
-        if ob:
-            self._busy = None
-        idx = None
+        return suggested
+
+    def _load_suggestions(self, suggested):
+        if self._query_oids:
+            debug1('client: not loading suggested indexes: %s\n' % suggested)
+            return
         for idx in suggested:
             self.sync_index(idx)
         git.auto_midx(self.cachedir)
+
+    def _suggest_packs(self):
+        ob = self._busy
+        if ob:
+            assert(ob == b'receive-objects-v2')
+            self.conn.write(b'\xff\xff\xff\xff')  # suspend receive-objects-v2
+        suggested = self._read_suggestions()
+        if ob:
+            self._busy = None
+        self._load_suggestions(suggested)
         if ob:
             self._busy = ob
             self.conn.write(b'%s\n' % ob)
-        return idx
+        return suggested[-1] if suggested else None
+
+    def have_oids(self, oids):
+        """Return a list of booleans indicating whether or not the
+        server has each of the (binary) oids.  If objects are
+        currently being sent, suspend the transfer for the duration of
+        the query.
+
+        """
+        ob = self._busy
+        if ob:
+            assert(ob == b'receive-objects-v2')
+            self.conn.write(b'\xff\xff\xff\xff')  # suspend receive-objects-v2
+            self._busy = None
+        conn = self.conn
+        suggested = None
+        result = []
+        # The server limits the number of oids per request
+        batch_max = protocol.max_have_oids
+        for start in range(0, max(1, len(oids)), batch_max):
+            batch = oids[start:start + batch_max]
+            with self._call('have-oids'):
+                write_vuint(conn, len(batch))
+                for oid in batch:
+                    assert len(oid) == 20, oid
+                    conn.write(oid)
+                if ob and not start: # suspension response comes first
+                    suggested = self._read_suggestions()
+                bitmap = conn.read((len(batch) + 7) // 8)
+                if len(bitmap) != (len(batch) + 7) // 8:
+                    raise EOFError('EOF while reading have-oids bitmap')
+            result.extend(bool(bitmap[i >> 3] & (1 << (i & 7)))
+                          for i in range(len(batch)))
+        if suggested:
+            self._load_suggestions(suggested)
+        if ob:
+            self._busy = ob
+            conn.write(b'%s\n' % ob)
+        return result
 
     def new_packwriter(self, compression_level=None,
                        max_pack_size=None, max_pack_objects=None):
@@ -505,6 +579,7 @@ class Client:
             self._busy = None
         store = RemotePackStore(self.conn,
                                 cache=self.cachedir,
+                                have_oids=self.have_oids if self._query_oids else None,
                                 suggest_packs=self._suggest_packs,
                                 onopen=set_busy,
                                 onclose=unset_busy,
@@ -512,7 +587,9 @@ class Client:
         return PackWriter(store=store,
                           compression_level=compression_level,
                           max_pack_size=max_pack_size,
-                          max_pack_objects=max_pack_objects)
+                          max_pack_objects=max_pack_objects,
+                          check_batch=(protocol.max_have_oids
+                                       if self._query_oids else None))
 
     def read_ref(self, refname):
         with self._call('read-ref', refname):
@@ -561,6 +638,41 @@ class Client:
                 if detritus:
                     raise ClientError('unexpected leftover data ' + repr(detritus))
 
+    def fetch_tree(self, oidx, exclude=()):
+        """Yield (oidx, type, data) for oidx and everything reachable
+        from it as described by RepoProtocol fetch_tree, via a single
+        request.  The iteration must be finished before making any
+        other calls.
+
+        """
+        assert len(oidx) == 40, oidx
+        conn = self.conn
+        with self._call('fetch-tree', oidx):
+            for x in exclude:
+                assert len(x) == 40, x
+                conn.write(x)
+                conn.write(b'\n')
+            conn.write(b'\n')
+            while True:
+                info = conn.readline()
+                if not (info and info.endswith(b'\n')):
+                    raise ClientError('Hit EOF while looking for object info: %r'
+                                      % info)
+                if info == b'\n':
+                    break
+                info = info[:-1].split(b' ')
+                if len(info) == 2 and info[1] == b'missing':
+                    yield info[0], None, None
+                    continue
+                if len(info) != 3:
+                    raise ClientError('Invalid object info %r' % info)
+                oidx, kind, size = info
+                size = int(size)
+                data = conn.read(size)
+                if len(data) != size:
+                    raise ClientError('Hit EOF while reading %s' % oidx.decode('ascii'))
+                yield oidx, kind, data
+
     def refs(self, patterns=None, limit_to_heads=False, limit_to_tags=False):
         args = b'%d %d\n' % (1 if limit_to_heads else 0,
                              1 if limit_to_tags else 0)
@@ -663,15 +775,44 @@ class Client:
             raise TypeError(f'Unrecognized result type {kind}')
 
 
+class _RecentOids:
+    """A size-bounded set of oids that forgets the least recently
+    used oid when full."""
+    def __init__(self, max_items):
+        assert max_items > 0
+        self._max_items = max_items
+        self._oids = {}
+    def __contains__(self, oid):
+        oids = self._oids
+        if oid not in oids:
+            return False
+        del oids[oid] # move to the end (most recent)
+        oids[oid] = True
+        return True
+    def add(self, oid):
+        oids = self._oids
+        oids.pop(oid, None)
+        if len(oids) >= self._max_items:
+            del oids[next(iter(oids))]
+        oids[oid] = True
+
+
 class RemotePackStore:
     def __init__(self, conn, *, cache, suggest_packs, onopen, onclose,
-                 ensure_busy):
+                 ensure_busy, have_oids=None):
+        """When have_oids is not None, it must be a function like
+        Client.have_oids, and it will be used instead of the local
+        index cache to check for existing objects.
+
+        """
         self._closed = False
         self._bwcount = 0
         self._bwtime = time.time()
         self._cache = cache
         self._conn = conn
         self._ensure_busy = ensure_busy
+        self._have_oids = have_oids
+        self._known_oids = _RecentOids(100_000) if have_oids else None
         self._objcache = None
         self._onclose = onclose
         self._onopen = onopen
@@ -688,7 +829,41 @@ class RemotePackStore:
         """
         if self._objcache is None:
             self._objcache = git.PackIdxList(self._cache)
-        return self._objcache.exists(oid, want_source=want_source)
+        result = self._objcache.exists(oid, want_source=want_source)
+        if result or not self._have_oids:
+            return result
+        if oid in self._known_oids:
+            return True
+        if self._have_oids((oid,))[0]:
+            self._known_oids.add(oid)
+            return True
+        return None
+
+    def exists_many(self, oids):
+        """Return a list of booleans indicating whether or not each
+        of the oids exists, asking the server (via have_oids) about
+        all of the oids that aren't known locally at once.
+
+        """
+        if self._objcache is None:
+            self._objcache = git.PackIdxList(self._cache)
+        result = [bool(self._objcache.exists(oid)) for oid in oids]
+        if not self._have_oids:
+            return result
+        unknown = []
+        for i, oid in enumerate(oids):
+            if not result[i]:
+                if oid in self._known_oids:
+                    result[i] = True
+                else:
+                    unknown.append(i)
+        if unknown:
+            answers = self._have_oids([oids[i] for i in unknown])
+            for i, found in zip(unknown, answers):
+                if found:
+                    self._known_oids.add(oids[i])
+                    result[i] = True
+        return result
 
     def _open(self):
         if not self._packopen:
@@ -1,8 +1,15 @@
 
+from itertools import islice
 import os, glob
 
 from bup import bloom, options, git
-from bup.bloom import BloomInvalid, BloomNotFound, BloomReader, BloomWriter
+from bup.bloom import \
+    (BloomInvalid,
+     BloomNotFound,
+     BloomWriter,
+     SegmentedBloomReader,
+     remove_later_segments,
+     segment_path)
 from bup.compat import argv_bytes
 from bup.helpers \
     import (EXIT_FAILURE,
@@ -31,8 +38,11 @@ c,check=   check given *.idx or *.midx file against the bloom filter
 
 def ruin_bloom(bloomfilename):
     try:
-        with BloomWriter(bloomfilename, 'wb', expected=1) as b:
-            b.map[16 : 16 + 2**b.bits] = b'\0' * 2**b.bits
+        with SegmentedBloomReader(bloomfilename) as b:
+            paths = [seg.path for seg in b.segments]
+        for path in paths:
+            with BloomWriter(path, 'wb', expected=1) as b:
+                b.map[16 : 16 + 2**b.bits] = b'\0' * 2**b.bits
     except BloomInvalid as ex:
         log(f'error: {str(ex)}\n')
         return EXIT_FAILURE
@@ -46,7 +56,7 @@ def check_bloom(path, bloomfilename, idx):
     rbloomfilename = git.repo_rel(bloomfilename)
     ridx = git.repo_rel(idx)
     try:
-        b = BloomReader(bloomfilename)
+        b = SegmentedBloomReader(bloomfilename)
     except BloomInvalid as ex:
         log(f'error: {str(ex)}\n')
         return EXIT_FALSE
@@ -68,10 +78,13 @@ def check_bloom(path, bloomfilename, idx):
             return EXIT_FAILURE
         rc = EXIT_SUCCESS
         with oids:
-            for oid in oids:
-                if not b.exists(oid):
-                    log('bloom: ERROR: object %s missing\n' % oid.hex())
-                    rc = EXIT_FALSE
+            oids = iter(oids)
+            while batch := list(islice(oids, 4096)):
+                found = b.exists_many(b''.join(batch))
+                for oid, present in zip(batch, found):
+                    if not present:
+                        log('bloom: ERROR: object %s missing\n' % oid.hex())
+                        rc = EXIT_FALSE
         return rc
 
 
@@ -83,7 +96,7 @@ def do_bloom(path, outfilename, k, force):
     try:
         if not force:
             try:
-                b = BloomReader(outfilename)
+                b = SegmentedBloomReader(outfilename)
             except BloomNotFound:
                 pass
             except BloomInvalid as ex:
@@ -108,35 +121,39 @@ def do_bloom(path, outfilename, k, force):
             debug1("bloom: nothing to do.\n")
             return
 
+        segment = None # the path of the segment to add to or create
+        new_segment = False
         if b is not None:
+            last = b.segments[-1]
             if len(b) != rest_count:
                 debug1("bloom: size %d != idx total %d, regenerating\n"
                        % (len(b), rest_count))
-                b, b_tmp = None, b
-                b_tmp.close()
-            elif k is not None and k != b.k:
+            elif k is not None and k != last.k:
                 debug1("bloom: new k %d != existing k %d, regenerating\n"
-                       % (k, b.k))
-                b, b_tmp = None, b
-                b_tmp.close()
-            elif (b.bits < bloom.MAX_BLOOM_BITS[b.k] and
-                  b.pfalse_positive(add_count) > bloom.MAX_PFALSE_POSITIVE):
-                debug1("bloom: regenerating: adding %d entries gives "
+                       % (k, last.k))
+            elif last.pfalse_positive(add_count) > bloom.MAX_PFALSE_POSITIVE:
+                # Leave the existing segments alone, and start a new
+                # one that can hold at least twice as many entries as
+                # the last (or as many as possible, if the last is
+                # already at the maximum size).
+                segment = segment_path(outfilename, len(b.segments))
+                new_segment = True
+                expected = max(add_count, 2 * len(last))
+                debug1("bloom: adding segment %s: adding %d entries gives "
                        "%.2f%% false positives.\n"
-                       % (add_count, b.pfalse_positive(add_count)))
-                b, b_tmp = None, b
-                b_tmp.close()
+                       % (path_msg(segment), add_count,
+                          last.pfalse_positive(add_count)))
             else:
-                b, b_tmp = None, b
-                b_tmp.close()
-                b = BloomWriter(outfilename, mode='w+b', expected=add_count)
-        if b is None: # Need all idxs to build from scratch
+                segment = last.path
+            b, b_tmp = None, b
+            b_tmp.close()
+        if segment is None: # Need all idxs to build from scratch
             add += rest
             add_count += rest_count
         del rest
         del rest_count
 
-        msg = 'creating from' if b is None else 'adding'
+        msg = 'creating from' if segment is None else 'adding'
         if not _first: _first = path
         dirprefix = (_first != path) and git.repo_rel(path) + b': ' or b''
         progress('bloom: %s%s %d file%s (%d object%s).\r'
@@ -145,9 +162,13 @@ def do_bloom(path, outfilename, k, force):
                add_count, add_count!=1 and 's' or ''))
 
         tfname = None
-        if b is None:
+        if segment is None:
             tfname = os.path.join(path, b'bup.tmp.bloom')
             b = BloomWriter(tfname, 'w+b', expected=add_count, k=k)
+        elif new_segment:
+            b = BloomWriter(segment, 'w+b', expected=expected, k=k)
+        else:
+            b = BloomWriter(segment, 'wb', expected=add_count)
         count = 0
         icount = 0
         for name in add:
@@ -165,6 +186,7 @@ def do_bloom(path, outfilename, k, force):
 
     if tfname:
         os.rename(tfname, outfilename)
+        remove_later_segments(outfilename)
 
 
 def main(argv):
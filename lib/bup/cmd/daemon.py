@@ -3,10 +3,16 @@
 # pylint: disable-next=deprecated-module
 import getopt
 
-import fcntl, os, socket, subprocess, sys, select
+from contextlib import closing
+from threading import Thread
+import fcntl, os, socket, subprocess, sys, select, traceback
 
-from bup import options, path
-from bup.helpers import EXIT_FAILURE, log, debug1
+from bup import git, options, path, protocol
+from bup.helpers import \
+    EXIT_FAILURE, Conn, MuxOutput, log, debug1, nullcontext_if_not
+from bup.io import path_msg as pm
+from bup.protocol import CommandDenied
+from bup.repo import LocalRepo
 
 
 optspec = """
@@ -14,11 +20,54 @@ bup daemon [options...] -- [bup-server options...]
 --
 l,listen  ip address to listen on, defaults to *
 p,port    port to listen on, defaults to 1982
+threads   serve connections from threads sharing one view of the repository
 """
 
+
+def serve_session(sock, src, repo_dir, objcache):
+    """Serve the connection sock as bup server would, but for
+    repo_dir only, with objcache as the pack index view."""
+    def vet_dir(repo_, path):
+        if not os.path.samefile(path, repo_dir):
+            raise CommandDenied(f'disallowing unexpected repository {pm(path)}')
+
+    class ServerRepo(LocalRepo):
+        def __init__(self, repo_dir_, server):
+            self.closed = True # subclass' __del__ can run before its init
+            LocalRepo.__init__(self, repo_dir, server=server,
+                               objcache=objcache)
+            # The shared catpipe can't be used by more than one thread
+            self._cp = git.CatPipe(repo_dir)
+        def close(self):
+            with closing(self._cp):
+                super().close()
+
+    try:
+        with closing(sock), \
+             sock.makefile('rb') as inp, \
+             sock.makefile('wb') as outf, \
+             closing(MuxOutput(outf)) as out:
+            try:
+                with Conn(inp, out) as conn, \
+                     protocol.Server(conn, ServerRepo,
+                                     vet_init_dir=vet_dir,
+                                     vet_set_dir=vet_dir) as server:
+                    server.handle()
+            except Exception:
+                out.write_stderr(traceback.format_exc().encode(errors='backslashreplace'))
+                raise
+    except Exception:
+        log(f'bup daemon: session for {src} failed\n{traceback.format_exc()}')
+    debug1(f'bup daemon: session for {src} done\n')
+
 def main(argv):
     o = options.Options(optspec, optfunc=getopt.getopt)
     opt, flags_, extra = o.parse_bytes(argv[1:])
+    if opt.threads:
+        if extra:
+            o.fatal('bup-server options are not allowed with --threads')
+        git.check_repo_or_die()
+        repo_dir = os.path.realpath(git.repo())
 
     host = opt.listen
     port = int(opt.port) if opt.port else 1982
@@ -49,11 +98,21 @@ def main(argv):
         log('bup daemon: listen socket: %s\n' % e.args[1])
         sys.exit(EXIT_FAILURE)
 
+    objcache = None
+    if opt.threads:
+        objcache = git.SharedPackIdxList(git.repo(b'objects/pack',
+                                                  repo_dir=repo_dir))
     try:
         while True:
             rl = select.select(socks, [], [], 60)[0]
             for l in rl:
                 s, src = l.accept()
+                if opt.threads:
+                    log("Socket accepted connection from %s\n" % (src,))
+                    Thread(target=serve_session,
+                           args=(s, src, repo_dir, objcache),
+                           daemon=True).start()
+                    continue
                 try:
                     log("Socket accepted connection from %s\n" % (src,))
                     fd1 = os.dup(s.fileno())
@@ -67,8 +126,9 @@ def main(argv):
                     os.close(fd1)
                     os.close(fd2)
     finally:
-        for l in socks:
-            l.shutdown(socket.SHUT_RDWR)
-            l.close()
+        with nullcontext_if_not(objcache):
+            for l in socks:
+                l.shutdown(socket.SHUT_RDWR)
+                l.close()
 
     debug1("bup daemon: done")
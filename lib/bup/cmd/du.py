@@ -0,0 +1,87 @@
+
+from binascii import hexlify, unhexlify
+from contextlib import ExitStack
+import sys
+
+from bup import du, git, options
+from bup.compat import argv_bytes
+from bup.du import SpaceUsage, UsageCache
+from bup.git import PackedSizes, PackIdxList
+from bup.helpers import die_if_errors, format_filesize, log, note_error
+from bup.io import byte_stream, path_msg
+from bup.vfs import save_names_for_commit_utcs
+
+
+optspec = """
+bup du [--dirs] [--human-readable] [--no-cache] [BRANCH...]
+--
+d,dirs          also report each save's top-level directories
+human-readable  print sizes in human readable format (e.g. 1.5M)
+no-cache        don't use (or update) the cache of save and directory totals
+"""
+
+def main(argv):
+    o = options.Options(optspec)
+    opt, flags_, extra = o.parse_bytes(argv[1:])
+    requested = [argv_bytes(x) for x in extra]
+    patterns = [b'refs/heads/' + x for x in requested]
+
+    git.check_repo_or_die()
+
+    refs = list(git.list_refs(patterns=patterns or None, limit_to_heads=True))
+    found = set(ref[11:] for ref, oid in refs)
+    for name in requested:
+        if name not in found:
+            note_error(f'error: no branch named {path_msg(name)}\n')
+    die_if_errors()
+
+    def parse_info(f):
+        author_secs, tree = f.readline().split()
+        return int(author_secs), unhexlify(tree)
+
+    if opt.human_readable:
+        def fmt(size): return format_filesize(size).encode('ascii')
+    else:
+        def fmt(size): return b'%d' % size
+
+    sys.stdout.flush()
+    out = byte_stream(sys.stdout)
+
+    with ExitStack() as ctx:
+        idxs = ctx.enter_context(PackIdxList(git.repo(b'objects/pack')))
+        sizes = ctx.enter_context(PackedSizes(idxs))
+        cache = None
+        if not opt.no_cache:
+            cache = ctx.enter_context(UsageCache(du.cache_path(git.repo())))
+        usage = SpaceUsage(sizes, git.catpipe().get, cache)
+        branches = []
+        for ref, oid in refs:
+            revs = list(git.rev_list(hexlify(oid), format=b'%at %T',
+                                     parse=parse_info))
+            names = save_names_for_commit_utcs(utc for _, (utc, _) in revs)
+            saves = [(name, usage.add_save(unhexlify(oidx), tree))
+                     for name, (oidx, (_, tree)) in zip(names, revs)]
+            branches.append((ref[11:], reversed(saves)))
+
+        # Exclusivity depends on all of the saves, so report at the end
+        for branch, saves in branches:
+            for name, save in saves:
+                path = branch + b'/' + name
+                exclusive = usage.exclusive(save).size
+                out.write(b'%s\t%s\t%s\n'
+                          % (fmt(exclusive), fmt(save.total.size - exclusive),
+                             path))
+                if opt.dirs:
+                    for d in save.dirs:
+                        exclusive = usage.exclusive(save, d).size
+                        out.write(b'%s\t%s\t%s/%s\n'
+                                  % (fmt(exclusive),
+                                     fmt(d.total.size - exclusive),
+                                     path, d.name))
+        shared = usage.shared().size
+        out.write(b'%s\t%s\ttotal\n'
+                  % (fmt(usage.unique().size - shared), fmt(shared)))
+        out.flush()
+        if usage.unpacked:
+            log(f'warning: {len(usage.unpacked)} objects are not in any pack'
+                ' and were not counted\n')
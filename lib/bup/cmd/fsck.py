@@ -1,16 +1,23 @@
 
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, as_completed
+from contextlib import ExitStack, nullcontext
+from multiprocessing import get_context
 from os import SEEK_END
 from os.path import join
 from shutil import copy2, rmtree
 from subprocess import DEVNULL, PIPE, run
 from tempfile import mkdtemp
-import errno, glob, os, re, sys
+import errno, glob, os, re, sys, time
 
 from bup import options, git
 from bup.compat import argv_bytes
+from bup.fsck \
+    import (Ledger, ledger_path, pack_fingerprint, packs_to_verify,
+            verify_pack)
 from bup.helpers \
     import (EXIT_FAILURE, EXIT_FALSE, EXIT_TRUE, EXIT_SUCCESS,
-            Sha1, chunkyreader, istty2, log, progress, temp_dir)
+            Sha1, chunkyreader, format_filesize, istty2, log, progress,
+            temp_dir)
 from bup.io import byte_stream, path_msg
 
 
@@ -48,6 +55,7 @@ def par2_setup():
                  check=False)
     except (FileNotFoundError, NotADirectoryError):
         log('fsck: warning: par2 not found; disabling recovery features.\n')
+        return
     if sp.returncode == 0:
         par2_ok = 1
         return
@@ -212,23 +220,23 @@ def trailing_and_actual_checksum(path):
         return trailing, actual.digest()
 
 
+# Totals for the packs verified by this process, i.e. a worker's
+# totals are the differences across a call to do_pack().
+_verified_objects = 0
+_verified_bytes = 0
+
 def git_verify(stem, *, quick=False):
-    if not quick:
+    global _verified_objects, _verified_bytes
+    result = verify_pack(stem, quick=quick)
+    if result is None: # an index version we can't check in-process
         rc = run([b'git', b'verify-pack', b'--', stem]).returncode
         if rc == 0:
             return True
         log(f'error: git verify-pack failed ({rc}) {path_msg(stem)}\n')
         return False
-    result = True
-    for path in (stem + b'.idx', stem + b'.pack'):
-        exp, act = trailing_and_actual_checksum(path)
-        if act is None:
-            log(f'error: missing {path_msg(path)}\n')
-            result = False
-        elif exp != act:
-            log(f'error: expected {exp.hex()}, got {act.hex()}\n')
-            result = False
-    return result
+    _verified_objects += result.objects
+    _verified_bytes += result.size
+    return result.ok
 
 
 def attempt_repair(stem, base, par2_exists, out, *, verbose=False):
@@ -301,16 +309,35 @@ def do_pack(mode, stem, par2_exists, out):
 
 
 
+def check_pack(mode, stem, par2_status):
+    """Return do_pack()'s exit status, and the number of objects and
+    bytes verified.  May be run in a worker process."""
+    assert par2_status is not False
+    objects, size = _verified_objects, _verified_bytes
+    out = byte_stream(sys.stdout)
+    try:
+        rc = do_pack(mode, stem, par2_status, out)
+    # pylint: disable-next=broad-exception-caught
+    except Exception as e:
+        log(f'exception: {e}\n')
+        rc = 99
+    finally:
+        out.flush()
+    return rc, _verified_objects - objects, _verified_bytes - size
+
+
 optspec = """
 bup fsck [options...] [packfile...]
 --
 r,repair    attempt to repair errors using par2 (dangerous!)
 g,generate  generate auto-repair information using par2
 v,verbose   increase verbosity (can be used more than once)
-quick       just check pack sha1sum, don't use git verify-pack
-j,jobs=     run 'n' jobs in parallel
+quick       just check the pack and index checksums, not the objects
+j,jobs=     verify 'n' packs in parallel (worker processes)
 par2-ok     immediately return 0 if par2 is ok, 1 if not
 disable-par2  ignore par2 even if it is available
+incremental  only verify packs not (successfully) verified recently
+max-age=    with --incremental, verify every pack at least every n days [30]
 """
 
 
@@ -344,6 +371,12 @@ def main(argv):
     if not par2_ok and (opt.generate or opt.repair):
         log('error: cannot --generate or --repair without par2\n')
         sys.exit(EXIT_FAILURE)
+    if opt.incremental:
+        if opt.quick or opt.generate or opt.repair:
+            o.fatal('--incremental is incompatible with'
+                    ' --quick, --generate, and --repair')
+        if opt.max_age < 1:
+            o.fatal(f'--max-age must be at least 1, not {opt.max_age}')
 
     if extra:
         pack_stems = [argv_bytes(x) for x in extra]
@@ -358,60 +391,80 @@ def main(argv):
         report_stray_pack_related_files(git.repo(), pack_files)
         pack_stems = [x[:-5] for x in pack_files]
 
-    sys.stdout.flush()
-    out = byte_stream(sys.stdout)
+    with ExitStack() as ctx:
+        ledger = None
+        if opt.incremental:
+            git.check_repo_or_die()
+            ledger = ctx.enter_context(Ledger(ledger_path(git.repo())))
+        sys.exit(check_packs(pack_stems, ledger, all_packs=not extra))
+
+
+def check_packs(pack_stems, ledger, *, all_packs):
     mode = 'repair' if opt.repair else 'generate' if opt.generate else 'verify'
     code = EXIT_SUCCESS
     count = 0
-    outstanding = {}
-    for stem in pack_stems:
-        base = os.path.basename(stem)
-        par2_status = par2_recovery_file_status(stem)
-        if par2_status is False:
-            if code == EXIT_SUCCESS:
-                code = EXIT_FAILURE
-            continue
-        sys.stdout.flush()  # Not sure we still need this, but it'll flush out too
-        debug('fsck: checking %r (%s)\n'
-              % (base, par2_ok and par2_status and 'par2' or 'git'))
-        if not opt.verbose:
-            progress('fsck (%d/%d)\r' % (count, len(pack_stems)))
-
-        if not opt.jobs:
-            assert par2_status is not False
-            code = merge_exits(code, do_pack(mode, stem, par2_status, out))
-            count += 1
-        else:
-            while len(outstanding) >= opt.jobs:
-                (pid,nc) = os.wait()
-                nc >>= 8
-                if pid in outstanding:
-                    del outstanding[pid]
-                    code = merge_exits(code, nc)
-                    count += 1
-            pid = os.fork()
-            if pid:  # parent
-                outstanding[pid] = 1
-            else: # child
-                try:
-                    assert par2_status is not False
-                    sys.exit(do_pack(mode, stem, par2_status, out))
-                # pylint: disable-next=broad-exception-caught
-                except Exception as e:
-                    log(f'exception: {e}\n')
-                    sys.exit(99)
-
-    while len(outstanding):
-        (pid,nc) = os.wait()
-        nc >>= 8
-        if pid in outstanding:
-            del outstanding[pid]
-            code = code or nc
-            count += 1
+    verified_objects = verified_bytes = 0
+    start = time.time()
+    all_stems = pack_stems
+    fingerprints = {}
+    if ledger:
+        pack_stems = packs_to_verify(ledger, pack_stems, start, opt.max_age)
+        if opt.verbose:
+            log(f'fsck: verifying {len(pack_stems)} of {len(all_stems)}'
+                ' packs (others verified recently)\n')
+
+    def finish(stem, result):
+        nonlocal code, count, verified_objects, verified_bytes
+        rc, objects, size = result
+        code = merge_exits(code, rc)
+        count += 1
+        verified_objects += objects
+        verified_bytes += size
+        fingerprint = fingerprints.pop(stem, None)
+        if rc == EXIT_SUCCESS and fingerprint:
+            ledger.record(stem, fingerprint, time.time())
         if not opt.verbose:
-            progress('fsck (%d/%d)\r' % (count, len(pack_stems)))
+            rate = verified_bytes / max(time.time() - start, 0.001)
+            progress(f'fsck ({count}/{len(pack_stems)},'
+                     f' {format_filesize(rate)}B/s)\r')
+
+    pool = None
+    if opt.jobs:
+        pool = ProcessPoolExecutor(max_workers=opt.jobs,
+                                   mp_context=get_context('fork'))
+    sys.stdout.flush()
+    with pool or nullcontext():
+        futures = {}
+        for stem in pack_stems:
+            base = os.path.basename(stem)
+            par2_status = par2_recovery_file_status(stem)
+            if par2_status is False:
+                if code == EXIT_SUCCESS:
+                    code = EXIT_FAILURE
+                continue
+            debug('fsck: checking %r (%s)\n'
+                  % (base, par2_ok and par2_status and 'par2' or 'git'))
+            if ledger:
+                fingerprints[stem] = pack_fingerprint(stem)
+            if pool:
+                future = pool.submit(check_pack, mode, stem, par2_status)
+                futures[future] = stem
+            else:
+                finish(stem, check_pack(mode, stem, par2_status))
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except BrokenExecutor as ex:
+                log(f'error: fsck worker failed: {ex}\n')
+                result = 99, 0, 0
+            finish(futures[future], result)
     if istty2:
         debug('fsck done.           \n')
+    if opt.verbose and verified_bytes:
+        elapsed = time.time() - start
+        log(f'fsck: verified {format_filesize(verified_bytes)}B'
+            f' ({verified_objects} objects) in {elapsed:.1f}s,'
+            f' {format_filesize(verified_bytes / max(elapsed, 0.001))}B/s\n')
 
     # double-check (e.g. for (unlikely) problems with generate tmpdir renames)
     for stem in pack_stems:
@@ -419,4 +472,8 @@ def main(argv):
             if code == EXIT_SUCCESS:
                 code = EXIT_FAILURE
 
-    sys.exit(code)
+    if ledger:
+        if all_packs:
+            ledger.forget_except(all_stems)
+        ledger.set_last_run(start)
+    return code
@@ -1,5 +1,6 @@
 
 from os import fsdecode
+from threading import Lock
 import errno, os, sys
 
 try:
@@ -34,7 +35,7 @@ if len(fuse_ver) < 3 or fuse_ver_maj < 1:
 # pylint: disable=wrong-import-position
 from bup import options, git, vfs, xstat
 from bup.compat import argv_bytes
-from bup.helpers import log
+from bup.helpers import log, parse_num
 from bup.repo import LocalRepo
 # pylint: enable=wrong-import-position
 
@@ -44,10 +45,20 @@ from bup.repo import LocalRepo
 # The path handling is just wrong, but the current fuse module can't
 # handle bytes paths.
 
+class _OpenFile:
+    """The state for an open file, i.e. a reader that keeps its
+    position (and current chunk) between read() calls."""
+    __slots__ = 'reader', 'lock'
+    def __init__(self, reader):
+        self.reader = reader
+        self.lock = Lock() # reads may arrive from multiple threads
+
 class BupFs(fuse.Fuse):
     def __init__(self, repo, verbose=0, fake_metadata=False):
+        """Since requests are handled by multiple threads, the repo
+        must be thread safe, e.g. LocalRepo(thread_safe=True)."""
         fuse.Fuse.__init__(self)
-        self.multithreaded = False
+        self.multithreaded = True
         self.repo = repo
         self.verbose = verbose
         self.fake_metadata = fake_metadata
@@ -112,22 +123,30 @@ class BupFs(fuse.Fuse):
         accmode = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
         if (flags & accmode) != os.O_RDONLY:
             return -errno.EACCES
-        # Return None since read doesn't need the file atm...
-        # If we *do* return the file, it'll show up as the last argument
-        #return vfs.fopen(repo, item)
-        return None
+        # The handle will be passed to read() and release()
+        return _OpenFile(vfs.fopen(self.repo, item))
 
-    def read(self, path, size, offset):
-        path = argv_bytes(path)
+    def read(self, path, size, offset, fh=None):
         if self.verbose > 0:
-            log('--read(%r)\n' % path)
-        res = vfs.resolve(self.repo, path, follow=False)
-        item = res[-1][1]
-        if not item:
-            return -errno.ENOENT
-        with vfs.fopen(self.repo, item) as f:
-            f.seek(offset)
-            return f.read(size)
+            log('--read(%r)\n' % argv_bytes(path))
+        if fh is None: # shouldn't happen, since open() returns a handle
+            fh = self.open(path, os.O_RDONLY)
+            if not isinstance(fh, _OpenFile):
+                return fh
+            try:
+                return self.read(path, size, offset, fh)
+            finally:
+                self.release(path, os.O_RDONLY, fh)
+        with fh.lock:
+            fh.reader.seek(offset)
+            return fh.reader.read(size)
+
+    def release(self, path, flags, fh=None):
+        if self.verbose > 0:
+            log('--release(%r)\n' % argv_bytes(path))
+        if fh is not None:
+            with fh.lock:
+                fh.reader.close()
 
 
 optspec = """
@@ -137,6 +156,7 @@ f,foreground  run in foreground
 d,debug       run in the foreground and display FUSE debug information
 o,allow-other allow other users to access the filesystem
 meta          report original metadata for paths when available
+cache-size=   limit the total size of the VFS cache (e.g. 64M)
 v,verbose     increase log output (can be used more than once)
 """
 
@@ -154,9 +174,11 @@ def main(argv):
 
     if len(extra) != 1:
         o.fatal('only one mount point argument expected')
+    if opt.cache_size:
+        vfs.set_cache_limits(parse_num(opt.cache_size))
 
     git.check_repo_or_die()
-    with LocalRepo() as repo:
+    with LocalRepo(thread_safe=True) as repo:
         f = BupFs(repo=repo, verbose=opt.verbose, fake_metadata=(not opt.meta))
 
         # This is likely wrong, but the fuse module doesn't currently accept bytes
@@ -168,4 +190,7 @@ def main(argv):
             f.fuse_args.setmod('foreground')
         if opt.allow_other:
             f.fuse_args.add('allow_other')
-        f.main()
+        try:
+            f.main()
+        finally:
+            vfs.log_cache_stats()
@@ -1,18 +1,21 @@
 
 from binascii import hexlify, unhexlify
 from collections import namedtuple
+from contextlib import ExitStack, closing, contextmanager
 from dataclasses import field, replace as dcreplace
+from queue import LifoQueue
 from re import Pattern
 from stat import S_ISDIR
 from textwrap import fill
+from threading import Event, Lock, Thread
 from typing import NoReturn, Optional, Union
 from uuid import uuid4
 import os, re, sys, textwrap, time
 
 from bup import client, compat, git, hashsplit, vfs
-from bup.commit import commit_message
+from bup.commit import commit_message, parse_commit
 from bup.compat import dataclass, dataclass_frozen_for_testing, get_argvb
-from bup.git import MissingObject, get_commit_items, walk_object
+from bup.git import MissingObject, get_commit_items, tree_iter, walk_object
 from bup.helpers import \
     (EXIT_FAILURE,
      EXIT_RECOVERED,
@@ -71,6 +74,7 @@ argspec = (
       ('--exclude-rx-from PATH', 'skip --exclude-rx patterns in PATH (may be repeated)'),
       ('--no-excludes', 'forget any preceeding exclude options'),
       ('--bwlimit BWLIMIT', 'maximum bytes/sec to transmit to server'),
+      ('-j N, --jobs N', 'read from the source with N threads (default: 1)'),
       ('--[no-]ignore-missing', 'ignore missing objects (*dangerous*)'),
       ('-0, -1, -2, -3, -4, -5, -6, -7, -8, -9, --compress LEVEL',
        'set compression LEVEL (default: 1)'))),
@@ -165,6 +169,7 @@ def parse_args(args):
         print_tags: bool = False
         bwlimit: Optional[int] = None
         compress: Optional[int] = None
+        jobs: int = 1
         source: Optional[bytes] = None
         remote: Optional[bytes] = None
         source_loc: URL = URL(scheme=b'file')
@@ -288,6 +293,14 @@ def parse_args(args):
         elif arg == b'--compress':
             (opt.compress,), remaining = require_n_args_or_die(1, remaining)
             opt.compress = int(opt.compress)
+        elif arg in (b'-j', b'--jobs'):
+            (opt.jobs,), remaining = require_n_args_or_die(1, remaining)
+            try:
+                opt.jobs = int(opt.jobs)
+            except ValueError:
+                misuse(f'invalid --jobs value {path_msg(opt.jobs)}')
+            if opt.jobs < 1:
+                misuse('--jobs must be at least 1')
         elif arg == b'--bwlimit':
             (opt.bwlimit,), remaining = require_n_args_or_die(1, remaining)
             try:
@@ -313,9 +326,166 @@ def parse_args(args):
 
 # FIXME: client error handling (remote exceptions, etc.)
 
+@contextmanager
+def source_readers(n, src_loc, src_repo):
+    """Provide a list of n independent source readers (functions like
+    RepoProtocol cat) for src_repo, each of which may be used by a
+    single thread, and all of which remain valid while the context is
+    active."""
+    with ExitStack() as ctx:
+        if isinstance(src_repo, LocalRepo):
+            # The repo's catpipe is shared, so create new ones
+            readers = [ctx.enter_context(closing(git.CatPipe(src_repo.repo_dir))).get
+                       for _ in range(n)]
+        else:
+            readers = [ctx.enter_context(repo_for_url(src_loc)).cat
+                       for _ in range(n)]
+        yield readers
+
+
+class _PendingObject:
+    __slots__ = 'oid', 'type', 'data', 'pending', 'parents'
+    def __init__(self, oid, type, parent):
+        self.oid, self.type = oid, type
+        self.parents = [parent] if parent else []
+        self.data = None
+        self.pending = 0
+
+def get_random_item_in_parallel(hash, readers, dest_repo, ignore_missing):
+    """Transfer everything reachable from hash that's missing from
+    dest_repo, like get_random_item, but via a thread for each of
+    the source readers.  Serialize all the dest_repo operations, and
+    only write an object once everything it refers to has been
+    written."""
+    # The lock covers dest_repo, seen, in_flight, failures, and all
+    # the _PendingObject fields.
+    lock = Lock()
+    seen = set() # oids that have been written or were already present
+    in_flight = {} # oid -> _PendingObject, until it's written
+    failures = []
+    work = LifoQueue() # depth first, to limit the data held for parents
+    finished = Event()
+
+    def pending_ref(oid, kind, parent):
+        # lock must be held; return (obj, new) where obj is the oid's
+        # _PendingObject (with parent added to its waiters), and new
+        # indicates that it must be retrieved, or (None, False) if the
+        # oid is already in dest_repo.
+        obj = in_flight.get(oid)
+        if obj:
+            obj.parents.append(parent)
+            return obj, False
+        if oid in seen:
+            return None, False
+        if dest_repo.exists(oid):
+            seen.add(oid)
+            return None, False
+        obj = in_flight[oid] = _PendingObject(oid, kind, parent)
+        return obj, True
+
+    def finish(obj):
+        # lock must be held; write obj and any parents it completes
+        done = [obj]
+        while done:
+            obj = done.pop()
+            if obj.data is not None:
+                # See the related comments in get_random_item
+                if isinstance(dest_repo, LocalRepo) or obj.type == b'blob' \
+                   or not dest_repo.exists(obj.oid):
+                    dest_repo.just_write(obj.oid, obj.type, obj.data)
+                obj.data = None
+            del in_flight[obj.oid]
+            seen.add(obj.oid)
+            if not obj.parents:
+                finished.set()
+            for parent in obj.parents:
+                parent.pending -= 1
+                if not parent.pending:
+                    done.append(parent)
+            obj.parents = None
+
+    def transfer(obj, cat):
+        oidx, kind, _, it = cat(hexlify(obj.oid))
+        if not oidx:
+            if not ignore_missing:
+                raise MissingObject(obj.oid)
+            note_error(f'skipping missing source object {obj.oid.hex()}\n')
+            with lock:
+                finish(obj)
+            return
+        data = b''.join(it)
+        if kind not in (b'blob', b'commit', b'tree'):
+            raise Exception('unexpected repository object type %r' % kind)
+        if obj.type and kind != obj.type:
+            raise Exception(f'{obj.oid.hex()} object type {kind} != {obj.type}')
+        if kind == b'tree':
+            refs = [(hexlify(oid), b'tree' if S_ISDIR(mode) else b'blob')
+                    for mode, name_, oid in tree_iter(data)]
+        elif kind == b'commit':
+            commit = parse_commit(data)
+            refs = [(commit.tree, b'tree'),
+                    *((pid, b'commit') for pid in commit.parents)]
+        else:
+            refs = ()
+        with lock:
+            # A ref that's already in flight (e.g. a subtree shared
+            # with another tree) is still pending for this obj until
+            # it's written, but only the first request retrieves it.
+            new = []
+            for ref, ref_kind in refs:
+                ref_obj, is_new = pending_ref(unhexlify(ref), ref_kind, obj)
+                if ref_obj:
+                    obj.pending += 1
+                    if is_new:
+                        new.append(ref_obj)
+            obj.type, obj.data = kind, data
+            if not obj.pending:
+                finish(obj)
+        for ref in new:
+            work.put(ref)
+
+    def run(cat):
+        while True:
+            obj = work.get()
+            if obj is None:
+                return
+            if failures:
+                continue
+            try:
+                transfer(obj, cat)
+            except BaseException as ex:
+                with lock:
+                    failures.append(ex)
+                finished.set()
+
+    with lock:
+        root, _ = pending_ref(unhexlify(hash), None, None)
+    if not root:
+        return
+    threads = [Thread(target=run, args=(cat,)) for cat in readers]
+    for t in threads:
+        t.start()
+    try:
+        work.put(root)
+        finished.wait()
+    finally:
+        for _ in threads:
+            work.put(None)
+        for t in threads:
+            t.join()
+    if failures:
+        raise failures[0]
+
+
 # FIXME: walk_object in in git.py doesn't support opt.verbose.  Do we
 # need to adjust for that here?
-def get_random_item(hash, src_repo, dest_repo, ignore_missing):
+def get_random_item(hash, src_repo, dest_repo, ignore_missing, readers=None):
+    """Copy hash and everything reachable from it from src_repo to
+    dest_repo.  If readers (see source_readers()) is not None, read
+    from the source with one thread per reader."""
+    if readers:
+        get_random_item_in_parallel(hash, readers, dest_repo, ignore_missing)
+        return
     def already_seen(oid):
         return dest_repo.exists(unhexlify(oid))
     def get_ref(oidx, include_data=False):
@@ -360,13 +530,15 @@ class GetResult:
     repairs: int = 0
 
 
-def transfer_commit(hash, parent, src_repo, dest_repo, ignore_missing):
+def transfer_commit(hash, parent, src_repo, dest_repo, ignore_missing,
+                    readers=None):
     now = time.time()
     items = get_commit_items(hash, src_repo.cat)
     tree = unhexlify(items.tree)
     author = b'%s <%s>' % (items.author_name, items.author_mail)
     committer = b'%s <%s@%s>' % (userfullname(), username(), hostname())
-    get_random_item(hexlify(tree), src_repo, dest_repo, ignore_missing)
+    get_random_item(hexlify(tree), src_repo, dest_repo, ignore_missing,
+                    readers)
     c = dest_repo.write_commit(tree, parent,
                                author, items.author_sec, items.author_offset,
                                committer, now, None,
@@ -375,12 +547,12 @@ def transfer_commit(hash, parent, src_repo, dest_repo, ignore_missing):
 
 
 def append_commit(src_loc, parent, src_repo, dest_repo, rewriter, excludes,
-                  repair_info, ignore_missing):
+                  repair_info, ignore_missing, readers=None):
     if not rewriter:
         assert isinstance(src_loc, (bytes, Loc)), src_loc
         oidx = src_loc if isinstance(src_loc, bytes) else hexlify(src_loc.hash)
         return transfer_commit(oidx, parent, src_repo, dest_repo,
-                               ignore_missing)
+                               ignore_missing, readers)
 
     # Friendlier checking was done during resolve_*
     assert isinstance(src_loc, Loc), src_loc
@@ -395,14 +567,14 @@ def append_commit(src_loc, parent, src_repo, dest_repo, rewriter, excludes,
     return GetResult(save_oid, tree_oid, repairs.repair_count())
 
 def append_commits(src_loc, dest_hash, src_repo, dest_repo, rewriter, excludes,
-                   repair_info, ignore_missing):
+                   repair_info, ignore_missing, readers=None):
     if not rewriter:
         commits = list(src_repo.rev_list(hexlify(src_loc.hash)))
         commits.reverse()
         last_c, tree = dest_hash, None
         for commit in commits:
             res = append_commit(commit, last_c, src_repo, dest_repo, rewriter,
-                                excludes, repair_info, ignore_missing)
+                                excludes, repair_info, ignore_missing, readers)
             last_c = res.oid
             tree = res.tree
             assert res.repairs == 0
@@ -605,14 +777,15 @@ def resolve_ff(spec, src_repo, dest_repo):
     return Target(spec=spec, src=src, dest=dest)
 
 
-def handle_ff(item, src_repo, dest_repo):
+def handle_ff(item, src_repo, dest_repo, readers):
     assert item.spec.method == 'ff'
     assert item.src.type in ('branch', 'save', 'commit')
     src_oidx = hexlify(item.src.hash)
     dest_oidx = hexlify(item.dest.hash) if item.dest.hash else None
     if not dest_oidx or dest_oidx in src_repo.rev_list(src_oidx):
         # Can fast forward.
-        get_random_item(src_oidx, src_repo, dest_repo, item.spec.ignore_missing)
+        get_random_item(src_oidx, src_repo, dest_repo, item.spec.ignore_missing,
+                        readers)
         commit_items = get_commit_items(src_oidx, src_repo.cat)
         return GetResult(item.src.hash, unhexlify(commit_items.tree))
     misuse('destination is not an ancestor of source for %s'
@@ -640,7 +813,7 @@ def resolve_append(spec, src_repo, dest_repo):
     return Target(spec=spec, src=src, dest=dest)
 
 
-def handle_append(item, src_repo, dest_repo):
+def handle_append(item, src_repo, dest_repo, readers):
     assert item.spec.method == 'append'
     assert item.src.type in ('branch', 'save', 'commit', 'tree')
     assert item.dest.type == 'branch' or not item.dest.type
@@ -648,7 +821,8 @@ def handle_append(item, src_repo, dest_repo):
         src_oidx = hexlify(item.src.hash)
         if item.spec.rewriter:
             misuse(f'rewrite cannot yet promote tree to commit for {spec_msg(item.spec)}')
-        get_random_item(src_oidx, src_repo, dest_repo, item.spec.ignore_missing)
+        get_random_item(src_oidx, src_repo, dest_repo, item.spec.ignore_missing,
+                        readers)
         parent = item.dest.hash
         msg = commit_message(b'bup get', compat.get_argvb())
         userline = b'%s <%s@%s>' % (userfullname(), username(), hostname())
@@ -661,7 +835,8 @@ def handle_append(item, src_repo, dest_repo):
         assert item.dest.type in ('branch', 'commit', 'save'), item.dest
     return append_commits(item.src, item.dest.hash, src_repo, dest_repo,
                           item.spec.rewriter, item.spec.excludes,
-                          item.spec.repair_info, item.spec.ignore_missing)
+                          item.spec.repair_info, item.spec.ignore_missing,
+                          readers)
 
 
 def resolve_pick(spec, src_repo, dest_repo):
@@ -698,7 +873,7 @@ def resolve_pick(spec, src_repo, dest_repo):
     return Target(spec=spec, src=src, dest=dest)
 
 
-def handle_pick(item, src_repo, dest_repo):
+def handle_pick(item, src_repo, dest_repo, readers):
     assert item.spec.method in ('pick', 'force-pick')
     assert item.src.type in ('save', 'commit')
     if item.dest.hash:
@@ -706,13 +881,15 @@ def handle_pick(item, src_repo, dest_repo):
         if item.dest.type in ('branch', 'commit', 'save'):
             return append_commit(item.src, item.dest.hash, src_repo, dest_repo,
                                  item.spec.rewriter, item.spec.excludes,
-                                 item.spec.repair_info, item.spec.ignore_missing)
+                                 item.spec.repair_info, item.spec.ignore_missing,
+                                 readers)
         assert item.dest.path.startswith(b'/.tag/'), item.dest
     # no parent; either dest is a non-commit tag and we should clobber
     # it, or dest doesn't exist.
     return append_commit(item.src, None, src_repo, dest_repo,
                          item.spec.rewriter, item.spec.excludes,
-                         item.spec.repair_info, item.spec.ignore_missing)
+                         item.spec.repair_info, item.spec.ignore_missing,
+                         readers)
 
 
 def resolve_new_tag(spec, src_repo, dest_repo):
@@ -735,11 +912,11 @@ def resolve_new_tag(spec, src_repo, dest_repo):
     return Target(spec=spec, src=src, dest=dest)
 
 
-def handle_new_tag(item, src_repo, dest_repo):
+def handle_new_tag(item, src_repo, dest_repo, readers):
     assert item.spec.method == 'new-tag'
     assert item.dest.path.startswith(b'/.tag/')
     get_random_item(hexlify(item.src.hash), src_repo, dest_repo,
-                    item.spec.ignore_missing)
+                    item.spec.ignore_missing, readers)
     return GetResult(item.src.hash)
 
 
@@ -767,15 +944,16 @@ def resolve_replace(spec, src_repo, dest_repo):
     return Target(spec=spec, src=src, dest=dest)
 
 
-def handle_replace(item, src_repo, dest_repo):
+def handle_replace(item, src_repo, dest_repo, readers):
     assert(item.spec.method == 'replace')
     if item.dest.path.startswith(b'/.tag/'):
         get_random_item(hexlify(item.src.hash), src_repo, dest_repo,
-                        item.spec.ignore_missing)
+                        item.spec.ignore_missing, readers)
         return GetResult(item.src.hash)
     assert(item.dest.type == 'branch' or not item.dest.type)
     src_oidx = hexlify(item.src.hash)
-    get_random_item(src_oidx, src_repo, dest_repo, item.spec.ignore_missing)
+    get_random_item(src_oidx, src_repo, dest_repo, item.spec.ignore_missing,
+                    readers)
     commit_items = get_commit_items(src_oidx, src_repo.cat)
     return GetResult(item.src.hash, unhexlify(commit_items.tree))
 
@@ -790,9 +968,9 @@ def resolve_unnamed(spec, src_repo, dest_repo_):
     return None
 
 
-def handle_unnamed(item, src_repo, dest_repo):
+def handle_unnamed(item, src_repo, dest_repo, readers):
     get_random_item(hexlify(item.src.hash), src_repo, dest_repo,
-                    item.spec.ignore_missing)
+                    item.spec.ignore_missing, readers)
     return GetResult()
 
 
@@ -856,7 +1034,9 @@ def log_item(name, type, opt, tree=None, commit=None, tag=None):
 def get_everything(opt):
     repair_count = 0
     with repo_for_url(opt.source_loc) as src_repo, \
-         repo_for_location(opt.dst_loc, compression_level=opt.compress) as dest_repo:
+         repo_for_location(opt.dst_loc, compression_level=opt.compress) as dest_repo, \
+         (source_readers(opt.jobs, opt.source_loc, src_repo) if opt.jobs > 1
+          else nullctx) as readers:
 
         src_split_cfg = hashsplit.configuration(src_repo.config_get)
         dest_split_cfg = hashsplit.configuration(dest_repo.config_get)
@@ -921,7 +1101,7 @@ def get_everything(opt):
                 cur_ref = cur_ref or dest_hash
 
                 handler = handlers[item.spec.method]
-                get_res = handler(item, src_repo, dest_repo)
+                get_res = handler(item, src_repo, dest_repo, readers)
                 repair_count += get_res.repairs
 
                 if not dest_ref:
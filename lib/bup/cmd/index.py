@@ -120,7 +120,7 @@ def update_index(top, excluded_paths, exclude_rxs, fsindex,
                     rig.cur.set_deleted()
                     rig.cur.repack()
                     if rig.cur.nlink > 1 and not stat.S_ISDIR(rig.cur.mode):
-                        hlinks.del_path(rig.cur.name)
+                        hlinks.del_path(rig.cur.name, rig.cur.dev, rig.cur.ino)
                 rig.next()
 
             if rig.cur and rig.cur.name == path:    # paths that already existed
@@ -133,7 +133,7 @@ def update_index(top, excluded_paths, exclude_rxs, fsindex,
                         rig.next()
                         continue
                     if not stat.S_ISDIR(rig.cur.mode) and rig.cur.nlink > 1:
-                        hlinks.del_path(rig.cur.name)
+                        hlinks.del_path(rig.cur.name, rig.cur.dev, rig.cur.ino)
                     if not stat.S_ISDIR(pst.st_mode) and pst.st_nlink > 1:
                         hlinks.add_path(path, pst.st_dev, pst.st_ino)
                     # Clear these so they don't bloat the store -- they're
@@ -96,6 +96,7 @@ def save_or_split_server_config(argv, opt_parser):
         if prev_kind and hexlify(prev_oid) not in info.parents:
             raise cd(f'{cmd}: {pm(ref)} update {new_oid.hex()} is not child of {prev_oid.hex()}')
     return {'commands': (b'config-get',
+                         b'have-oids',
                          b'read-ref',
                          b'receive-objects-v2',
                          b'update-ref'),
@@ -121,7 +122,8 @@ def main(argv):
         check_repo_or_die()
         if cmd == b'restore':
             srv_config = {'commands': (b'cat-batch', b'config-get',
-                                       b'list-indexes', b'resolve'),
+                                       b'fetch-tree', b'list-indexes',
+                                       b'resolve'),
                           **restricted_repo_config()}
         elif cmd == b'get':
             srv_config = {'commands': 'all', **restricted_repo_config()}
@@ -1,6 +1,7 @@
 
 from binascii import hexlify, unhexlify
 from collections import defaultdict
+from contextlib import ExitStack
 from itertools import groupby
 from time import localtime, strftime, time
 import sys
@@ -8,10 +9,11 @@ import sys
 from bup import git, options
 from bup.compat import argv_bytes
 from bup.gc import bup_gc
-from bup.helpers import die_if_errors, log, partition, period_as_secs
+from bup.git import PackedSizes, PackIdxList, walk_object
+from bup.helpers \
+    import die_if_errors, format_filesize, log, partition, period_as_secs
 from bup.io import byte_stream, path_msg
-from bup.repo import LocalRepo
-from bup.rm import bup_rm
+from bup.rm import rm_commits
 from bup.vfs import save_names_for_commit_utcs
 
 
@@ -56,6 +58,58 @@ def classify_saves(saves, period_start):
         yield False, save
 
 
+class ReclaimEstimate:
+    """Estimate the space that removing saves from a branch would
+    reclaim, i.e. the packed size of the objects reachable from each
+    removed save that aren't reachable from the nearest kept save on
+    either side of it, or counted for another removed save.  Sharing
+    with saves further away, or on other branches, isn't considered.
+    Only the kept saves adjacent to a removed save are walked.  Call
+    kept() or removed() for each save, newest first."""
+    def __init__(self, sizes, get_ref):
+        self.total = 0
+        self._sizes = sizes
+        self._get_ref = get_ref
+        self._kept_tree = None # the newest kept save older than the rest
+        self._kept = None # everything reachable from _kept_tree, once walked
+        self._counted = {} # oid -> size
+        self._after_removed = False
+
+    def _reachable(self, tree):
+        seen = set()
+        for item in walk_object(self._get_ref, hexlify(tree),
+                                stop_at=lambda x: unhexlify(x) in seen,
+                                result='item'):
+            seen.add(item.oid)
+        return seen
+
+    def kept(self, tree):
+        self._kept_tree = tree
+        self._kept = None
+        if self._after_removed:
+            self._after_removed = False
+            self._kept = self._reachable(tree)
+            for oid in self._kept.intersection(self._counted):
+                self.total -= self._counted.pop(oid)
+
+    def removed(self, tree):
+        self._after_removed = True
+        if self._kept is None:
+            self._kept = frozenset() if self._kept_tree is None \
+                else self._reachable(self._kept_tree)
+        kept, counted = self._kept, self._counted
+        def stop_at(oidx):
+            oid = unhexlify(oidx)
+            return oid in kept or oid in counted
+        for item in walk_object(self._get_ref, hexlify(tree), stop_at=stop_at,
+                                result='item'):
+            if item.data is False: # missing
+                continue
+            size = self._sizes.size(item.oid) or 0
+            counted[item.oid] = size
+            self.total += size
+
+
 optspec = """
 bup prune-older [options...] [BRANCH...]
 --
@@ -65,6 +119,7 @@ keep-monthlies-for= retain the newest save per month within the PERIOD
 keep-yearlies-for=  retain the newest save per year within the PERIOD
 wrt=                end all periods at this number of seconds since the epoch
 pretend       don't prune, just report intended actions to standard output
+estimate      with --pretend, estimate the space the removals would reclaim
 gc            collect garbage after removals [1]
 gc-threshold= only rewrite a packfile if it's over this percent garbage [10]
 #,compress=   set compression level to # (0-9, 9 is highest) [1]
@@ -100,6 +155,9 @@ def main(argv):
     if not period_start:
         o.fatal('at least one keep argument is required')
 
+    if opt.estimate and not opt.pretend:
+        o.fatal('--estimate requires --pretend')
+
     period_start = defaultdict(lambda: float('inf'), period_start)
 
     if opt.verbose:
@@ -128,39 +186,60 @@ def main(argv):
 
     git.check_repo_or_die()
 
-    # This could be more efficient, but for now just build the whole list
-    # in memory and let bup_rm() do some redundant work.
-
     def parse_info(f):
-        author_secs = f.readline().strip()
-        return int(author_secs)
+        author_secs, tree = f.readline().split()
+        return int(author_secs), unhexlify(tree)
 
     sys.stdout.flush()
     out = byte_stream(sys.stdout)
 
-    removals = []
-    for branch, branch_id in branches(roots):
-        die_if_errors()
-        # At the moment, oids are irrelevant; the save name is crucial
-        revs = list(git.rev_list(branch_id, format=b'%at', parse=parse_info))
-        saves = ((utc, unhexlify(oidx), save_name) \
-                 for ((oidx, utc), save_name) \
-                 in zip(revs, save_names_for_commit_utcs(x[1] for x in revs)))
-        for keep_save, (utc, oid_, save_name) \
-                in classify_saves(saves, period_start):
-            assert(keep_save in (False, True))
-            # FIXME: base removals on hashes
+    with ExitStack() as ctx:
+        sizes = None
+        if opt.estimate:
+            idxs = ctx.enter_context(PackIdxList(git.repo(b'objects/pack')))
+            sizes = ctx.enter_context(PackedSizes(idxs))
+        removals = {} # branch -> (tip, set of oids)
+        reclaimable = 0
+        for branch, branch_id in branches(roots):
+            die_if_errors()
+            # Stream the history, newest first, so that the memory
+            # needed to classify the saves doesn't depend on their
+            # number, except that the --pretend save names depend on
+            # the whole history (see save_names_for_commit_utcs()).
+            revs = git.rev_list(branch_id, format=b'%at %T', parse=parse_info)
+            names = None
             if opt.pretend:
-                out.write(b'%s %s/%s\n' % (b'+' if keep_save else b'-',
-                                           branch, save_name))
-            elif not keep_save:
-                removals.append(b'%s/%s' % (branch, save_name))
+                revs = list(revs)
+                names = save_names_for_commit_utcs(utc for _, (utc, _) in revs)
+            saves = ((utc, unhexlify(oidx), tree)
+                     for oidx, (utc, tree) in revs)
+            estimate = sizes and ReclaimEstimate(sizes, git.catpipe().get)
+            dead = set()
+            for keep_save, (utc_, oid, tree) \
+                    in classify_saves(saves, period_start):
+                assert(keep_save in (False, True))
+                if estimate:
+                    if keep_save:
+                        estimate.kept(tree)
+                    else:
+                        estimate.removed(tree)
+                if opt.pretend:
+                    out.write(b'%s %s/%s\n' % (b'+' if keep_save else b'-',
+                                               branch, next(names)))
+                elif not keep_save:
+                    dead.add(oid)
+            if dead:
+                removals[branch] = unhexlify(branch_id), dead
+            if estimate:
+                reclaimable += estimate.total
+                log(f'{path_msg(branch)}: about'
+                    f' {format_filesize(estimate.total)}B reclaimable\n')
+        if opt.estimate:
+            log(f'total: about {format_filesize(reclaimable)}B reclaimable\n')
 
     if not opt.pretend:
         die_if_errors()
-        with LocalRepo() as repo:
-            bup_rm(repo, removals, compression=opt.compress,
-                   verbosity=opt.verbose)
+        rm_commits(removals, compression=opt.compress, verbosity=opt.verbose)
         if opt.gc:
             die_if_errors()
             bup_gc(threshold=opt.gc_threshold,
@@ -1,16 +1,19 @@
-
+from binascii import hexlify
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from copy import deepcopy
+from queue import SimpleQueue
 from stat import S_ISDIR
 import errno, os, re, stat, sys
 
-from bup import options, vfs
+from bup import git, options, vfs
 from bup._helpers import write_sparsely
 from bup.compat import argv_bytes, fsencode
-from bup.helpers import (add_error, chunkyreader,
-                         mkdirp, parse_rx_excludes, progress, qprogress,
-                         should_rx_exclude_path)
+from bup.helpers import (add_error, mkdirp, parse_rx_excludes, progress,
+                         qprogress, should_rx_exclude_path)
 from bup.io import byte_stream, path_msg
-from bup.repo import main_repo_location, repo_for_location
+from bup.repo import LocalRepo, main_repo_location, repo_for_location
 
 
 optspec = """
@@ -22,6 +25,8 @@ numeric-ids restore numeric IDs (user, group, etc.) rather than names
 exclude-rx= skip paths matching the unanchored regex (may be repeated)
 exclude-rx-from= skip --exclude-rx patterns in file (may be repeated)
 sparse      create sparse files
+reflink     copy uncompressed data directly from local packs when possible
+j,jobs=     write file contents with N threads [1]
 v,verbose   increase log output (can be used more than once)
 map-user=   given OLD=NEW, restore OLD user as NEW user
 map-group=  given OLD=NEW, restore OLD group as NEW group
@@ -132,26 +137,147 @@ def hardlink_if_possible(fullname, item, top, hardlinks):
     target_versions.append((fullname, item))
     return False
 
-def write_file_content(repo, dest_path, vfs_file):
-    with vfs.fopen(repo, vfs_file) as inf:
-        with open(dest_path, 'wb') as outf:
-            for b in chunkyreader(inf):
-                outf.write(b)
+_can_copy_file_range = hasattr(os, 'copy_file_range')
+
+def _write_all(fd, data):
+    with memoryview(data) as view:
+        while view:
+            view = view[os.write(fd, view):]
 
-def write_file_content_sparsely(repo, dest_path, vfs_file):
-    with vfs.fopen(repo, vfs_file) as inf:
-        outfd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+def _copy_range(src_fd, dest_fd, ofs, n):
+    global _can_copy_file_range
+    while n and _can_copy_file_range:
         try:
-            trailing_zeros = 0
-            for b in chunkyreader(inf):
-                trailing_zeros = write_sparsely(outfd, b, 512, trailing_zeros)
-            pos = os.lseek(outfd, trailing_zeros, os.SEEK_END)
-            os.ftruncate(outfd, pos)
+            copied = os.copy_file_range(src_fd, dest_fd, n, ofs)
+        except OSError as ex:
+            if ex.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP,
+                                errno.EINVAL):
+                raise
+            _can_copy_file_range = False
+            break
+        if not copied:
+            raise Exception(f'unexpected end of pack data at {ofs}')
+        ofs += copied
+        n -= copied
+    while n:
+        data = os.pread(src_fd, min(n, 1 << 20), ofs)
+        if not data:
+            raise Exception(f'unexpected end of pack data at {ofs}')
+        _write_all(dest_fd, data)
+        ofs += len(data)
+        n -= len(data)
+
+def copy_file_content(repo, dest_fd, vfs_file, finder):
+    """Write the content of vfs_file to dest_fd, copying the blobs
+    that the finder (a git.StoredBlobFinder) can locate directly from
+    the packs, which may allow the filesystem to share the data with
+    the pack (e.g. via reflinks) rather than writing a new copy."""
+    for oid in vfs.file_blob_oids(repo, vfs_file):
+        found = finder.find(oid)
+        if found:
+            pack_fd, extents = found
+            for ofs, n in extents:
+                _copy_range(pack_fd, dest_fd, ofs, n)
+        else:
+            _, _, _, it = vfs.get_oidx(repo, hexlify(oid))
+            for b in it:
+                _write_all(dest_fd, b)
+
+def write_file_content(repo, dest_path, vfs_file, dir_fd=None, finder=None):
+    def opener(path, flags):
+        return os.open(path, flags, 0o666, dir_fd=dir_fd)
+    if finder:
+        with open(dest_path, 'wb', buffering=0, opener=opener) as outf:
+            copy_file_content(repo, outf.fileno(), vfs_file, finder)
+        return
+    with open(dest_path, 'wb', opener=opener) as outf:
+        for b in vfs.file_chunks(repo, vfs_file):
+            outf.write(b)
+
+def write_file_content_sparsely(repo, dest_path, vfs_file, dir_fd=None):
+    outfd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600,
+                    dir_fd=dir_fd)
+    try:
+        trailing_zeros = 0
+        for b in vfs.file_chunks(repo, vfs_file):
+            trailing_zeros = write_sparsely(outfd, b, 512, trailing_zeros)
+        pos = os.lseek(outfd, trailing_zeros, os.SEEK_END)
+        os.ftruncate(outfd, pos)
+    finally:
+        os.close(outfd)
+
+class ContentWriters:
+    """Write file contents (and then apply the file's metadata) via a
+    pool of threads, one for each of the repos, which will be handed
+    to only one thread at a time.  Since the threads may still be
+    working on the files in a directory after the restore has moved
+    on, directory metadata must be deferred via defer_dir_meta(), and
+    will be applied by finish(), in the order it was deferred.
+
+    """
+    def __init__(self, repos, sparse, numeric_ids, owner_map, finder=None):
+        self._repos = SimpleQueue()
+        for repo in repos:
+            self._repos.put(repo)
+        self._sparse = sparse
+        self._finder = finder
+        self._numeric_ids = numeric_ids
+        self._owner_map = owner_map
+        self._pool = ThreadPoolExecutor(max_workers=len(repos))
+        self._pending = deque()
+        self._max_pending = 4 * len(repos)
+        self._dir_metas = []
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
+
+    def __enter__(self): return self
+    def __exit__(self, type, value, traceback): self.close()
+
+    def _write(self, dir_fd, name, item, meta, path):
+        try:
+            repo = self._repos.get()
+            try:
+                if self._sparse:
+                    write_file_content_sparsely(repo, name, item, dir_fd)
+                else:
+                    write_file_content(repo, name, item, dir_fd,
+                                       self._finder)
+            finally:
+                self._repos.put(repo)
         finally:
-            os.close(outfd)
+            os.close(dir_fd)
+        apply_metadata(meta, path, self._numeric_ids, self._owner_map)
+
+    def submit(self, name, item, meta, path):
+        """Write the content of item to name (relative to the current
+        directory), and then apply meta to the same file via path
+        (absolute).  Raise any exception from an earlier submission.
+
+        """
+        dir_fd = os.open(b'.', os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            job = self._pool.submit(self._write, dir_fd, name, item, meta,
+                                    path)
+        except:
+            os.close(dir_fd)
+            raise
+        self._pending.append(job)
+        while len(self._pending) > self._max_pending:
+            self._pending.popleft().result()
+
+    def defer_dir_meta(self, meta, path):
+        self._dir_metas.append((meta, path))
+
+    def finish(self):
+        while self._pending:
+            self._pending.popleft().result()
+        metas, self._dir_metas = self._dir_metas, []
+        for meta, path in metas:
+            apply_metadata(meta, path, self._numeric_ids, self._owner_map)
 
 def restore(repo, parent_path, name, item, top, sparse, numeric_ids, owner_map,
-            exclude_rxs, verbosity, hardlinks):
+            exclude_rxs, verbosity, hardlinks, writers=None, finder=None):
     global total_restored
     mode = vfs.item_mode(item)
     treeish = S_ISDIR(mode)
@@ -196,26 +322,33 @@ def restore(repo, parent_path, name, item, top, sparse, numeric_ids, owner_map,
                 for sub_name, sub_item in sub_items:
                     restore(repo, fullname, sub_name, sub_item, top, sparse,
                             numeric_ids, owner_map, exclude_rxs, verbosity,
-                            hardlinks)
+                            hardlinks, writers, finder)
             finally:
                 os.chdir(b'..')
-            apply_metadata(meta, name, numeric_ids, owner_map)
+            if writers:
+                writers.defer_dir_meta(meta, top + fullname)
+            else:
+                apply_metadata(meta, name, numeric_ids, owner_map)
         else:
             created_hardlink = False
             if meta.hardlink_target:
                 created_hardlink = hardlink_if_possible(fullname, item, top,
                                                         hardlinks)
+            written_later = False
             if not created_hardlink:
                 meta.create_path(name)
                 if stat.S_ISREG(meta.mode):
-                    if sparse:
+                    if writers:
+                        writers.submit(name, item, meta, top + fullname)
+                        written_later = True
+                    elif sparse:
                         write_file_content_sparsely(repo, name, item)
                     else:
-                        write_file_content(repo, name, item)
+                        write_file_content(repo, name, item, finder=finder)
             total_restored += 1
             if verbosity >= 0:
                 qprogress('Restoring: %d\r' % total_restored)
-            if not created_hardlink:
+            if not created_hardlink and not written_later:
                 apply_metadata(meta, name, numeric_ids, owner_map)
     finally:
         os.chdir(orig_cwd)
@@ -231,6 +364,8 @@ def main(argv):
 
     if not extra:
         o.fatal('must specify at least one path to restore')
+    if not isinstance(opt.jobs, int) or opt.jobs < 1:
+        o.fatal('--jobs must be a positive integer')
 
     exclude_rxs = parse_rx_excludes(flags, o.fatal)
 
@@ -242,7 +377,22 @@ def main(argv):
         mkdirp(opt.outdir)
         os.chdir(opt.outdir)
 
-    with repo_for_location(loc) as src:
+    with ExitStack() as ctx:
+        src = ctx.enter_context(repo_for_location(loc))
+        finder = None
+        if opt.reflink and not opt.sparse and not src.is_remote():
+            finder = ctx.enter_context(git.StoredBlobFinder(src.repo_dir))
+        writers = None
+        if opt.jobs > 1:
+            if src.is_remote(): # one connection per thread
+                repos = [ctx.enter_context(repo_for_location(loc))
+                         for _ in range(opt.jobs)]
+            else:
+                repos = [ctx.enter_context(LocalRepo(src.repo_dir,
+                                                     thread_safe=True))] * opt.jobs
+            writers = ctx.enter_context(ContentWriters(repos, opt.sparse,
+                                                       opt.numeric_ids,
+                                                       owner_map, finder))
         top = fsencode(os.getcwd())
         hardlinks = {}
         for path in [argv_bytes(x) for x in extra]:
@@ -271,6 +421,12 @@ def main(argv):
                 res_msg = path_msg(b'/'.join(name for name, item in resolved))
                 add_error(f'error: cannot access {res_msg} in {path_msg(path)}')
                 continue
+            if src.is_remote() and not writers \
+               and isinstance(leaf_item, (vfs.Item, vfs.Chunky, vfs.Commit)):
+                # Retrieve everything we'll need in one request rather
+                # than one object at a time.  (The writers have their
+                # own connections.)
+                src.prefetch(hexlify(leaf_item.oid))
             if not path_name or path_name == b'.':
                 # Source is /foo/what/ever/ or /foo/what/ever/. -- extract
                 # what/ever/* to the current directory, and if name == '.'
@@ -286,16 +442,22 @@ def main(argv):
                     for sub_name, sub_item in items:
                         restore(src, b'', sub_name, sub_item, top,
                                 opt.sparse, opt.numeric_ids, owner_map,
-                                exclude_rxs, verbosity, hardlinks)
+                                exclude_rxs, verbosity, hardlinks, writers,
+                                finder)
                     if path_name == b'.':
                         leaf_item = vfs.augment_item_meta(src, leaf_item,
                                                           include_size=True)
-                        apply_metadata(leaf_item.meta, b'.',
-                                       opt.numeric_ids, owner_map)
+                        if writers:
+                            writers.defer_dir_meta(leaf_item.meta, top)
+                        else:
+                            apply_metadata(leaf_item.meta, b'.',
+                                           opt.numeric_ids, owner_map)
             else:
                 restore(src, b'', leaf_name, leaf_item, top,
                         opt.sparse, opt.numeric_ids, owner_map,
-                        exclude_rxs, verbosity, hardlinks)
+                        exclude_rxs, verbosity, hardlinks, writers, finder)
+        if writers:
+            writers.finish()
 
     if verbosity >= 0:
         progress('Restoring: %d, done.\n' % total_restored)
@@ -1,6 +1,9 @@
 
 from binascii import hexlify
 from collections import ChainMap, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import mktime_tz, parsedate_tz
+from functools import partial
 from urllib import parse
 from urllib.parse import urlencode
 import mimetypes, os, posixpath, signal, stat, sys, time, traceback, webbrowser
@@ -9,19 +12,19 @@ from bup import options, git, vfs, xstat
 from bup.helpers import \
     (EXIT_FAILURE,
      EXIT_SUCCESS,
-     chunkyreader,
      debug1,
      format_filesize,
-     log)
+     log,
+     parse_num)
 from bup.io import path_msg
 from bup.metadata import Metadata
 from bup.path import resource_path
 from bup.repo import LocalRepo
 
 try:
-    from tornado import gen
     from tornado.httpserver import HTTPServer
     from tornado.ioloop import IOLoop
+    from tornado.iostream import StreamClosedError
     from tornado.netutil import bind_unix_socket
     import tornado.web
 except ImportError:
@@ -34,10 +37,45 @@ except ImportError:
 
 
 def http_date_from_utc_ns(utc_ns):
-    return time.strftime('%a, %d %b %Y %H:%M:%S', time.gmtime(utc_ns / 10**9))
+    return time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+                         time.gmtime(utc_ns // 10**9))
 
 
-def normalize_bool(k_, v): bool(v)
+def parse_byte_range(value, size):
+    """Return (start, end), where end is exclusive, for the HTTP Range
+    header value with respect to a file of the given size.  Return
+    None if the value isn't a single byte range (which the HTTP
+    specification allows us to ignore), and False if the range can't
+    be satisfied.
+
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        first = int(first) if first else None
+        last = int(last) if last else None
+    except ValueError:
+        return None
+    if first is None:
+        if last is None:
+            return None
+        if last == 0 or size == 0:
+            return False
+        return max(0, size - last), size
+    if last is not None and last < first:
+        return None
+    if first >= size:
+        return False
+    if last is None or last >= size:
+        return first, size
+    return first, last + 1
+
+
+def normalize_bool(k_, v): return int(bool(v))
 
 
 def from_req_bool(k, v):
@@ -46,6 +84,15 @@ def from_req_bool(k, v):
     raise ValueError(f'Request {k} parameter not 0 or 1')
 
 
+def normalize_int(k_, v): return int(v)
+
+def from_req_page(k, v):
+    page = int(v)
+    if page < 1:
+        raise ValueError(f'Request {k} parameter not a positive integer')
+    return page
+
+
 class ParamInfo:
     """The default indicates the value that will be assumed if the
     parameter is missing.  from_req(k, v) converts from a request
@@ -126,8 +173,14 @@ def _contains_hidden_files(repo, dir_item):
     return False
 
 
-def _dir_contents(repo, resolution, params, param_info):
-    """Yield the display information for the contents of dir_item."""
+def _dir_contents(repo, resolution, params, param_info, page_size=0):
+    """Return (contents, more) where contents is a list of the display
+    information for the entries of the resolved directory that are on
+    the requested page, and more is true if there are later pages.
+    The sizes and metadata are only computed for the entries on the
+    page.  A page_size of 0 puts all of the entries on one page.
+
+    """
 
     def item_info(name, item, resolved_item, display_name=None,
                   include_size=False):
@@ -166,24 +219,41 @@ def _dir_contents(repo, resolution, params, param_info):
         return path_msg(display_name), link + query, display_size, meta, oidx
 
     dir_item = resolution[-1][1]
-    for name, item in vfs.contents(repo, dir_item):
-        if not params.get('hidden'):
-            if (name not in (b'.', b'..')) and name.startswith(b'.'):
-                continue
+    mp = params.get('meta')
+    first = (params.get('page', 1) - 1) * page_size
+    contents = []
+    n = 0 # visible entries, excluding ..
+    for name, item in vfs.contents(repo, dir_item, want_meta=bool(mp)):
         if name == b'.':
             parent_item = resolution[-2][1] if len(resolution) > 1 else dir_item
-            yield item_info(b'..', parent_item, parent_item, b'..')
+            contents.append(item_info(b'..', parent_item, parent_item, b'..'))
+            continue
+        if not params.get('hidden'):
+            if name != b'..' and name.startswith(b'.'):
+                continue
+        if n < first:
+            n += 1
             continue
-        mp = params.get('meta')
-        res_item = vfs.ensure_item_has_metadata(repo, item, include_size=mp,
-                                                public=True)
-        yield item_info(name, item, res_item, include_size=mp)
+        if page_size and n == first + page_size:
+            return contents, True
+        n += 1
+        if mp:
+            res_item = vfs.ensure_item_has_metadata(repo, item,
+                                                    include_size=True,
+                                                    public=True)
+        else:
+            res_item = item
+        contents.append(item_info(name, item, res_item, include_size=mp))
+    return contents, False
 
 
 class BupRequestHandler(tornado.web.RequestHandler):
 
-    def initialize(self, repo=None, human=None):
+    def initialize(self, repo=None, human=None, executor=None, page_size=0):
+        # The repo must be thread safe since it's used via the executor
         self.repo = repo # pylint: disable=attribute-defined-outside-init
+        self.executor = executor # pylint: disable=attribute-defined-outside-init
+        self.page_size = page_size # pylint: disable=attribute-defined-outside-init
         default_false_param = ParamInfo(default=0, from_req=from_req_bool,
                                         normalize=normalize_bool)
         human_param = ParamInfo(default=1 if human else 0,
@@ -193,36 +263,46 @@ class BupRequestHandler(tornado.web.RequestHandler):
         self.bup_param_info = {'hash': default_false_param,
                                'hidden': default_false_param,
                                'human': human_param,
-                               'meta': default_false_param}
+                               'meta': default_false_param,
+                               'page': ParamInfo(default=1,
+                                                 from_req=from_req_page,
+                                                 normalize=normalize_int)}
 
     def decode_argument(self, value, name=None):
         if name == 'path':
             return value
         return super().decode_argument(value, name)
 
-    def get(self, path):
-        return self._process_request(path)
+    async def get(self, path):
+        await self._process_request(path)
+
+    async def head(self, path):
+        await self._process_request(path)
 
-    def head(self, path):
-        return self._process_request(path)
+    def _in_thread(self, fn, *args):
+        """Return an awaitable for the result of fn(*args), which will
+        be called via the executor so that the (blocking) repository
+        access doesn't prevent other requests from being handled."""
+        return IOLoop.current().run_in_executor(self.executor, fn, *args)
 
-    def _process_request(self, path):
+    async def _process_request(self, path):
         print('Handling request for %s' % path)
         sys.stdout.flush()
         # Set want_meta because dir metadata won't be fetched, and if
         # it's not a dir, then we're going to want the metadata.
-        res = vfs.resolve(self.repo, path, want_meta=True)
+        res = await self._in_thread(partial(vfs.resolve, self.repo, path,
+                                            want_meta=True))
         leaf_item = res[-1][1]
         if not leaf_item:
             self.send_error(404)
             return
         mode = vfs.item_mode(leaf_item)
         if stat.S_ISDIR(mode):
-            self._list_directory(path, res)
+            await self._list_directory(path, res)
         else:
-            self._get_file(self.repo, path, res)
+            await self._get_file(self.repo, path, res)
 
-    def _list_directory(self, path, resolution):
+    async def _list_directory(self, path, resolution):
         """Helper to produce a directory listing.
 
         Return value is either a file object, or None (indicating an
@@ -242,30 +322,72 @@ class BupRequestHandler(tornado.web.RequestHandler):
             # templates, e.g. {**params, **{'hidden': 1}}
             return encode_query(ChainMap(changes, params), param_info)
 
-        self.render(
+        def list_contents():
+            return (_contains_hidden_files(self.repo, resolution[-1][1]),
+                    *_dir_contents(self.repo, resolution, params, param_info,
+                                   page_size=self.page_size))
+        files_hidden, dir_contents, more = \
+            await self._in_thread(list_contents)
+        await self.render(
             'list-directory.html',
             path=path,
             breadcrumbs=_compute_breadcrumbs(path, params, param_info),
-            files_hidden=_contains_hidden_files(self.repo, resolution[-1][1]),
+            files_hidden=files_hidden,
             local_time_str=xstat.local_time_str,
             mode_str=xstat.mode_str,
             params=params,
             amend_query=amend_query,
-            dir_contents=_dir_contents(self.repo, resolution, params, param_info))
+            dir_contents=dir_contents,
+            page=params.get('page', 1),
+            more=more)
         return None
 
-    def _set_header(self, path, file_item):
+    def _set_header(self, path, file_item, content_range=None):
         meta = file_item.meta
         ctype = self._guess_type(path)
         assert len(file_item.oid) == 20
         if meta.mtime is not None:
             self.set_header("Last-Modified", http_date_from_utc_ns(meta.mtime))
         self.set_header("Content-Type", ctype)
-        self.set_header("Etag", hexlify(file_item.oid))
-        self.set_header("Content-Length", str(meta.size))
-
-    @gen.coroutine
-    def _get_file(self, repo, path, resolved):
+        self.set_header("Etag", '"%s"' % hexlify(file_item.oid).decode('ascii'))
+        self.set_header("Accept-Ranges", "bytes")
+        if content_range:
+            start, end = content_range
+            self.set_status(206)
+            self.set_header("Content-Range",
+                            "bytes %d-%d/%d" % (start, end - 1, meta.size))
+            self.set_header("Content-Length", str(end - start))
+        else:
+            self.set_header("Content-Length", str(meta.size))
+
+    def _not_modified(self, file_item):
+        """Return true if the request's conditions (If-None-Match or
+        If-Modified-Since) indicate that the client's copy of
+        file_item is current."""
+        if self.request.headers.get("If-None-Match"):
+            return self.check_etag_header()
+        since = self.request.headers.get("If-Modified-Since")
+        mtime = file_item.meta.mtime
+        if not since or mtime is None:
+            return False
+        since = parsedate_tz(since)
+        if not since:
+            return False
+        return mtime // 10**9 <= mktime_tz(since)
+
+    def _requested_range(self, file_item):
+        """Return the (start, end) the client requested via Range (and
+        If-Range), None for the whole file, or False if the range
+        can't be satisfied."""
+        value = self.request.headers.get("Range")
+        if not value:
+            return None
+        if_range = self.request.headers.get("If-Range")
+        if if_range and if_range != self._headers.get("Etag"):
+            return None
+        return parse_byte_range(value, file_item.meta.size)
+
+    async def _get_file(self, repo, path, resolved):
         """Process a request on a file.
 
         Return value is either a file object, or None (indicating an error).
@@ -273,29 +395,50 @@ class BupRequestHandler(tornado.web.RequestHandler):
         """
         try:
             file_item = resolved[-1][1]
-            file_item = vfs.augment_item_meta(repo, file_item,
-                                              include_size=True, public=True)
-
-            # Defer the set_header() calls until after we start
-            # writing so we can still generate a 500 failure if
-            # something fails.
+            file_item = await self._in_thread(
+                partial(vfs.augment_item_meta, repo, file_item,
+                        include_size=True, public=True))
+            size = file_item.meta.size
+            self._set_header(path, file_item)
+            if self._not_modified(file_item):
+                self.set_status(304)
+                self.clear_header("Content-Length")
+                return
+            content_range = self._requested_range(file_item)
+            if content_range is False:
+                self.set_status(416)
+                self.clear_header("Content-Length")
+                self.set_header("Content-Range", "bytes */%d" % size)
+                return
+            start, end = content_range or (0, size)
+            self._set_header(path, file_item, content_range)
             if self.request.method == 'HEAD':
-                self._set_header(path, file_item)
-            else:
-                set_header = False
-                with vfs.fopen(self.repo, file_item) as f:
-                    for blob in chunkyreader(f):
-                        if not set_header:
-                            self._set_header(path, file_item)
-                            set_header = True
-                        self.write(blob)
+                return
+            with vfs.fopen(self.repo, file_item) as f:
+                await self._in_thread(f.seek, start)
+                remaining = end - start
+                while remaining:
+                    blob = await self._in_thread(f.read,
+                                                 min(remaining, 1 << 18))
+                    if not blob:
+                        raise Exception(f'{path_msg(path)} is shorter than'
+                                        f' its recorded size {size}')
+                    remaining -= len(blob)
+                    self.write(blob)
+                    # Wait for the client to accept the data so that
+                    # we don't buffer the whole file.
+                    await self.flush()
+        except StreamClosedError:
+            debug1(f'bup-web: client closed connection for {path_msg(path)}\n')
         # pylint: disable-next=broad-exception-caught
         except Exception as e: # FIXME: *all* Exceptions?
+            log(traceback.format_exc())
+            if self._headers_written:
+                return
+            self.clear()
             self.set_status(500)
             self.write("<h1>Server Error</h1>\n")
             self.write("%s: %s\n" % (e.__class__.__name__, str(e)))
-            log(traceback.format_exc())
-        raise gen.Return()
 
     def _guess_type(self, path):
         """Guess the type of a file.
@@ -348,6 +491,8 @@ bup web unix://path
 --
 human-readable    display human readable file sizes (i.e. 3.9K, 4.7M)
 browser           show repository in default browser (incompatible with unix://)
+cache-size=       limit the total size of the VFS cache (e.g. 64M)
+page-size=        maximum number of directory entries per page (0 for no limit) [1000]
 """
 
 def main(argv):
@@ -383,6 +528,11 @@ def main(argv):
                 o.fatal(f'port {path_msg(port)} is not an integer')
             address = InetAddress(host=host, port=port)
 
+    if opt.cache_size:
+        vfs.set_cache_limits(parse_num(opt.cache_size))
+    if not isinstance(opt.page_size, int) or opt.page_size < 0:
+        o.fatal('--page-size must be a non-negative integer')
+
     git.check_repo_or_die()
 
     settings = {'debug': 1,
@@ -395,9 +545,11 @@ def main(argv):
     except AttributeError:
         sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 
-    with LocalRepo() as repo:
+    with LocalRepo(thread_safe=True) as repo, \
+         ThreadPoolExecutor(max_workers=8) as executor:
         handlers = [(r"(?P<path>/.*)", BupRequestHandler,
-                     {'repo': repo, 'human': opt.human_readable})]
+                     {'repo': repo, 'human': opt.human_readable,
+                      'executor': executor, 'page_size': opt.page_size})]
         application = tornado.web.Application(handlers, **settings)
 
         http_server = HTTPServer(application)
@@ -419,4 +571,7 @@ def main(argv):
             sys.exit(EXIT_FAILURE)
 
         io_loop = io_loop_pending
-        io_loop.start()
+        try:
+            io_loop.start()
+        finally:
+            vfs.log_cache_stats()
@@ -0,0 +1,369 @@
+"""Repository space usage accounting
+
+SpaceUsage reports how much (packed, i.e. compressed) space each save
+and each of its top-level directories occupies, divided into the
+space used by objects that nothing else being considered refers to
+(exclusive), and the space used by objects that are shared with
+other saves (or for directories, with other paths).
+
+Every object is labelled with the "owner" that refers to it: one
+top-level directory of one save, one save (when more than one of its
+top-level paths refer to it), or nothing in particular, i.e. SHARED.
+Since a label can only move from the first to the last, each tree is
+only read a few times no matter how many saves refer to it.  The
+labels are kept in arrays indexed by the objects' positions in their
+pack idx files (see _ObjectArrays), requiring a few bytes per object
+in the repository rather than a set or dict entry per object seen.
+
+The total size of each save and directory requires a walk of the
+whole tree, so those totals are kept by tree oid in an sqlite
+database (see cache_path()), and only new trees are walked to
+compute them.  Only the totals are cached; the ownership labels
+depend on the whole set of saves being considered, so they're
+recomputed (reading every tree at least once) on every run.  The
+cache depends on the packfiles, so gc removes it via clear().
+
+"""
+
+from array import array
+from binascii import hexlify, unhexlify
+import os, sqlite3, stat
+
+from bup import git
+from bup.compat import dataclass
+from bup.git import walk_object
+from bup.helpers import debug1, unlink
+from bup.io import path_msg
+
+
+_format_version = 1
+
+SHARED = -1
+
+
+def cache_path(repo_dir):
+    return os.path.join(repo_dir, b'du-cache.sqlite3')
+
+def clear(repo_dir):
+    """Remove the space usage cache for the repository, if any."""
+    path = cache_path(repo_dir)
+    for suffix in (b'', b'-wal', b'-shm', b'-journal'):
+        unlink(path + suffix)
+
+
+class UsageCache:
+    """The (objects, bytes) reachable from tree oids.  Any failure
+    to open, read, or update the cache is ignored (with a debug
+    message), since it's only a cache."""
+    def __init__(self, path):
+        self.closed = False
+        self._path = path
+        self._db = None
+        try:
+            self._db = sqlite3.connect(path, timeout=1, isolation_level=None)
+            self._db.execute('pragma journal_mode = wal')
+            self._prepare()
+        except sqlite3.Error as ex:
+            self._failed('open', ex)
+
+    def _prepare(self):
+        db = self._db
+        db.execute('create table if not exists info'
+                   ' (name text primary key, value integer)')
+        row = db.execute("select value from info where name = 'version'") \
+                .fetchone()
+        if row and row[0] == _format_version:
+            return
+        with db: # i.e. in a transaction
+            db.execute('begin immediate')
+            db.execute('drop table if exists tree_usage')
+            db.execute('create table tree_usage'
+                       ' (oid blob primary key,'
+                       '  objects integer not null, size integer not null)'
+                       ' without rowid')
+            db.execute("insert or replace into info values ('version', ?)",
+                       (_format_version,))
+
+    def _failed(self, what, ex):
+        debug1(f'du: unable to {what} {path_msg(self._path)}: {ex}\n')
+        if self._db:
+            self._db.close()
+            self._db = None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self._db:
+                self._db.close()
+
+    def __del__(self): assert self.closed
+    def __enter__(self): return self
+    def __exit__(self, type, value, traceback): self.close()
+
+    def tree_usage(self, oid):
+        """Return the Usage for the tree oid, or None."""
+        if not self._db:
+            return None
+        try:
+            row = self._db.execute('select objects, size from tree_usage'
+                                   ' where oid = ?', (oid,)).fetchone()
+        except sqlite3.Error as ex:
+            self._failed('read', ex)
+            return None
+        return Usage(*row) if row else None
+
+    def add_tree_usage(self, oid, usage):
+        if not self._db:
+            return
+        try:
+            self._db.execute('insert or ignore into tree_usage values (?, ?, ?)',
+                             (oid, usage.objects, usage.size))
+        except sqlite3.Error as ex:
+            self._failed('update', ex)
+
+
+@dataclass(slots=True)
+class Usage:
+    objects: int = 0
+    size: int = 0
+
+    def add(self, size, count=1):
+        self.objects += count
+        self.size += size
+
+
+@dataclass(slots=True)
+class DirUsage:
+    name: bytes
+    oid: bytes
+    unit: int
+    total: Usage = None
+
+
+@dataclass(slots=True)
+class SaveUsage:
+    commit: bytes
+    tree: bytes
+    dirs: list
+    total: Usage = None
+
+
+class _ObjectArrays:
+    """An integer (initially zero) for every object in the packs,
+    stored in an array per pack, indexed by the object's position in
+    the idx (see PackedSizes.locate())."""
+    def __init__(self, sizes, typecode):
+        self._sizes = sizes
+        self._typecode = typecode
+        self._arrays = {}
+
+    def __call__(self, pack):
+        a = self._arrays.get(pack)
+        if a is None:
+            a = array(self._typecode)
+            a.frombytes(bytes(a.itemsize * self._sizes.count(pack)))
+            self._arrays[pack] = a
+        return a
+
+
+class SpaceUsage:
+    """Account for the space used by the saves provided via
+    add_save(), finding the objects' packed sizes via sizes (a
+    PackedSizes), and reading objects via get_ref (which must behave
+    like CatPipe get).  If provided, consult and update cache (a
+    UsageCache) for the save and directory totals."""
+    def __init__(self, sizes, get_ref, cache=None):
+        self.saves = []
+        self.unpacked = set() # oids of objects that aren't in any pack
+        self._sizes = sizes
+        self._get_ref = get_ref
+        self._cache = cache
+        self._unit_save = [] # unit (top-level directory) -> save index
+        self._exclusive = {} # owner label -> Usage
+        self._save_for_commit = {}
+        self._owner = _ObjectArrays(sizes, 'i')
+        self._visits = _ObjectArrays(sizes, 'I'), _ObjectArrays(sizes, 'I')
+        self._visit = 0
+
+    # Owner labels (zero means "not seen yet")
+    def _unit_label(self, unit): return unit + 1
+    def _save_label(self, save): return -save - 2
+
+    def _label_save(self, label):
+        return self._unit_save[label - 1] if label > 0 else -label - 2
+
+    def _meet(self, old, new):
+        if old == 0 or old == new:
+            return new
+        if old == SHARED:
+            return SHARED
+        save = self._label_save(new)
+        if self._label_save(old) != save:
+            return SHARED
+        return self._save_label(save)
+
+    def _locate(self, oid):
+        loc = self._sizes.locate(oid)
+        if not loc:
+            self.unpacked.add(oid)
+        return loc
+
+    def _claim(self, oid, label):
+        """Record that label refers to oid, and return true if that
+        changed the object's owner (i.e. if the objects reachable from
+        it should also be claimed)."""
+        loc = self._locate(oid)
+        if not loc:
+            return False
+        pack, pos, size = loc
+        owners = self._owner(pack)
+        old = owners[pos]
+        new = self._meet(old, label)
+        if new == old:
+            return False
+        owners[pos] = new
+        if old:
+            self._exclusive[old].add(-size, -1)
+        usage = self._exclusive.get(new)
+        if usage is None:
+            usage = self._exclusive[new] = Usage()
+        usage.add(size)
+        return True
+
+    def _claim_reachable(self, oid, mode, label):
+        if not stat.S_ISDIR(mode): # a blob, and so a leaf
+            self._claim(oid, label)
+            return
+        stop_at = lambda oidx: not self._claim(unhexlify(oidx), label)
+        for _ in walk_object(self._get_ref, hexlify(oid), stop_at=stop_at,
+                             result='item'):
+            pass
+
+    def _entries(self, tree):
+        oidx, typ, _, data = self._get_ref(hexlify(tree))
+        if not oidx:
+            raise git.MissingObject(tree)
+        assert typ == b'tree', typ
+        return list(git.tree_iter(b''.join(data)))
+
+    def _new_visit(self):
+        self._visit += 1
+        return self._visit
+
+    def _add_reachable(self, oid, mode, totals):
+        """Add the objects reachable from oid to the usage for each
+        (visits, visit, usage) in totals, unless visits already
+        records the visit for the object."""
+        def note(oid):
+            loc = self._locate(oid)
+            if not loc:
+                return False
+            pack, pos, size = loc
+            noted = False
+            for visits, visit, usage in totals:
+                seen = visits(pack)
+                if seen[pos] != visit:
+                    seen[pos] = visit
+                    usage.add(size)
+                    noted = True
+            return noted
+        if not stat.S_ISDIR(mode):
+            note(oid)
+            return
+        stop_at = lambda oidx: not note(unhexlify(oidx))
+        for _ in walk_object(self._get_ref, hexlify(oid), stop_at=stop_at,
+                             result='item'):
+            pass
+
+    def _cached(self, tree):
+        return self._cache.tree_usage(tree) if self._cache else None
+
+    def _compute_totals(self, save, entries):
+        """Set the save and dir totals, where entries are the (mode,
+        oid, dir) for each entry in the save's tree, and dir is the
+        entry's DirUsage, or None if it's not a directory."""
+        for d in save.dirs:
+            d.total = self._cached(d.oid)
+        root = self._cached(save.tree)
+        if root is None or any(d.total is None for d in save.dirs):
+            # The save total requires a walk of every path anyway.
+            root = Usage()
+            in_save, in_dir = self._visits
+            for_save = in_save, self._new_visit(), root
+            self._add_reachable(save.tree, 0, (for_save,)) # just the tree
+            for mode, oid, d in entries:
+                if not d:
+                    self._add_reachable(oid, mode, (for_save,))
+                    continue
+                d.total = Usage()
+                self._add_reachable(oid, mode,
+                                    (for_save,
+                                     (in_dir, self._new_visit(), d.total)))
+            if self._cache:
+                self._cache.add_tree_usage(save.tree, root)
+                for d in save.dirs:
+                    self._cache.add_tree_usage(d.oid, d.total)
+        save.total = Usage(root.objects, root.size)
+        commit = self._locate(save.commit)
+        if commit:
+            save.total.add(commit[2])
+
+    def add_save(self, commit, tree):
+        """Account for the save with the given commit and tree oids,
+        and return its SaveUsage.  Adding the same commit more than
+        once has no further effect."""
+        i = self._save_for_commit.get(commit)
+        if i is not None:
+            return self.saves[i]
+        i = self._save_for_commit[commit] = len(self.saves)
+        entries = []
+        dirs = []
+        for mode, name, oid in self._entries(tree):
+            d = None
+            if stat.S_ISDIR(mode):
+                name, kind = git.demangle_name(name, mode)
+                if kind != git.BUP_CHUNKED:
+                    self._unit_save.append(i)
+                    d = DirUsage(name, oid, len(self._unit_save) - 1)
+                    dirs.append(d)
+            entries.append((mode, oid, d))
+        save = SaveUsage(commit, tree, dirs)
+        self.saves.append(save)
+        self._compute_totals(save, entries)
+
+        save_label = self._save_label(i)
+        self._claim(commit, save_label)
+        if self._claim(tree, save_label):
+            for mode, oid, d in entries:
+                label = self._unit_label(d.unit) if d else save_label
+                self._claim_reachable(oid, mode, label)
+        return save
+
+    def _exclusive_usage(self, label):
+        usage = self._exclusive.get(label)
+        return Usage(usage.objects, usage.size) if usage else Usage()
+
+    def exclusive(self, save, dir=None):
+        """Return the Usage of the objects that only the save (a
+        SaveUsage) refers to, or if dir (one of the save's dirs) is
+        provided, that only that directory refers to."""
+        if dir:
+            return self._exclusive_usage(self._unit_label(dir.unit))
+        result = self._exclusive_usage(self._save_label(
+            self._save_for_commit[save.commit]))
+        for d in save.dirs:
+            usage = self._exclusive_usage(self._unit_label(d.unit))
+            result.add(usage.size, usage.objects)
+        return result
+
+    def shared(self):
+        """Return the Usage of the objects that more than one save
+        refers to."""
+        return self._exclusive_usage(SHARED)
+
+    def unique(self):
+        """Return the Usage of all of the objects the saves refer to."""
+        result = Usage()
+        for usage in self._exclusive.values():
+            result.add(usage.size, usage.objects)
+        return result
@@ -0,0 +1,457 @@
+"""In-process pack verification
+
+verify_pack() checks a pack file and its index without running git.
+A quick check only compares the trailing checksums of both files to
+their contents (and the pack checksum recorded in the index to the
+pack's).  A full check also requires a version 2 index, and then
+verifies that the index and pack agree on the object count, that
+every offset in the index is the start of an object, that the CRC
+recorded in the index matches the object's bytes, and that each
+object inflates to content whose oid matches the index.  Delta
+objects (which bup doesn't write, but git may) are resolved against
+their bases in the same pack.
+
+Both files are mmapped, and the checks are independent per pack, so
+callers can verify different packs in different processes.
+
+Since packs never change once written, a Ledger records when each
+pack was last verified, identified by its size, mtime, and trailing
+checksum, so that incremental runs can skip packs verified recently
+(see packs_to_verify()).
+
+"""
+
+from os.path import basename
+import os, sqlite3, struct, zlib
+
+from bup.compat import dataclass
+from bup.git import calc_hash
+from bup.helpers import Sha1, log, mmap_read
+from bup.io import path_msg
+
+
+_idx_v2_magic = b'\377tOc\0\0\0\2'
+_pack_types = {1: b'commit', 2: b'tree', 3: b'blob', 4: b'tag'}
+_ofs_delta = 6
+_ref_delta = 7
+_max_delta_chain = 10_000
+_max_cached_bases = 64 * 1024 * 1024 # total bytes
+
+
+@dataclass(slots=True)
+class PackVerification:
+    ok: bool
+    objects: int # zero for a quick check
+    size: int # total bytes in the pack and index
+
+
+class _Corrupt(Exception):
+    pass
+
+
+def _map(path):
+    """Return an mmap (or b'' when empty) of path, or None if it
+    doesn't exist."""
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        return mmap_read(f, close=False)
+
+
+def _close(m):
+    if m is not None and not isinstance(m, bytes):
+        m.close()
+
+
+def _checksum_ok(m, path):
+    if len(m) < 20:
+        log(f'error: truncated {path_msg(path)}\n')
+        return False
+    actual = Sha1(memoryview(m)[:-20]).digest()
+    expected = m[-20:]
+    if actual != expected:
+        log(f'error: expected {expected.hex()}, got {actual.hex()}'
+            f' for {path_msg(path)}\n')
+        return False
+    return True
+
+
+def _delta_size(delta, pos):
+    size = shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return size, pos
+
+
+def _apply_delta(base, delta):
+    src_size, pos = _delta_size(delta, 0)
+    if src_size != len(base):
+        raise _Corrupt(f'delta base size {src_size} != {len(base)}')
+    dst_size, pos = _delta_size(delta, pos)
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        c = delta[pos]
+        pos += 1
+        if c & 0x80: # copy from base
+            cp_ofs = cp_size = 0
+            for i in range(4):
+                if c & (1 << i):
+                    cp_ofs |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if c & (0x10 << i):
+                    cp_size |= delta[pos] << (8 * i)
+                    pos += 1
+            cp_size = cp_size or 0x10000
+            if cp_ofs + cp_size > len(base):
+                raise _Corrupt('delta copy past end of base')
+            out += base[cp_ofs:cp_ofs + cp_size]
+        elif c: # insert
+            if pos + c > end:
+                raise _Corrupt('delta insert past end of delta')
+            out += delta[pos:pos + c]
+            pos += c
+        else:
+            raise _Corrupt('reserved delta opcode 0')
+    if len(out) != dst_size:
+        raise _Corrupt(f'delta result size {len(out)} != {dst_size}')
+    return bytes(out)
+
+
+class _PackReader:
+    """Decodes the objects in a mmapped pack, given the offset of the
+    end of each object."""
+    def __init__(self, pack, ends, find_oid_ofs):
+        self._pack = pack
+        self._ends = ends
+        self._find_oid_ofs = find_oid_ofs
+        self._bases = {}
+        self._base_bytes = 0
+
+    def _raw(self, ofs):
+        """Return (type, base, data) for the object at ofs,
+        where base is the offset of the delta base (or None), and
+        data is the inflated content."""
+        pack = self._pack
+        end = self._ends.get(ofs)
+        if end is None:
+            raise _Corrupt(f'no object at offset {ofs}')
+        pos = ofs
+        c = pack[pos]
+        kind = (c >> 4) & 7
+        size = c & 0x0f
+        shift = 4
+        while c & 0x80:
+            pos += 1
+            c = pack[pos]
+            size |= (c & 0x7f) << shift
+            shift += 7
+        pos += 1
+        base = None
+        if kind == _ofs_delta:
+            c = pack[pos]
+            pos += 1
+            rel = c & 0x7f
+            while c & 0x80:
+                c = pack[pos]
+                pos += 1
+                rel = ((rel + 1) << 7) | (c & 0x7f)
+            base = ofs - rel
+            if base < 12 or base >= ofs:
+                raise _Corrupt(f'invalid delta base offset {base}')
+        elif kind == _ref_delta:
+            oid = pack[pos:pos + 20]
+            pos += 20
+            base = self._find_oid_ofs(oid)
+            if base is None:
+                raise _Corrupt(f'delta base {oid.hex()} not in pack')
+        elif kind not in _pack_types:
+            raise _Corrupt(f'unknown object type {kind}')
+        if pos > end:
+            raise _Corrupt('object header past end of object')
+        z = zlib.decompressobj()
+        with memoryview(pack) as mv:
+            data = z.decompress(mv[pos:end])
+        if not z.eof or z.unused_data:
+            raise _Corrupt('object data does not end at the next object')
+        if len(data) != size:
+            raise _Corrupt(f'inflated size {len(data)} != {size}')
+        return kind, base, data
+
+    def object(self, ofs):
+        """Return the type name and content of the object at ofs."""
+        kind, base, data = self._raw(ofs)
+        if base is None:
+            return _pack_types[kind], data
+        deltas = [data]
+        while True:
+            if len(deltas) > _max_delta_chain:
+                raise _Corrupt('delta chain too long (or circular)')
+            cached = self._bases.get(base)
+            if cached is not None:
+                kind, data = cached
+                break
+            kind, next_base, data = self._raw(base)
+            if next_base is None:
+                kind = _pack_types[kind]
+                self._remember(base, kind, data)
+                break
+            deltas.append(data)
+            base = next_base
+        for delta in reversed(deltas):
+            data = _apply_delta(data, delta)
+        return kind, data
+
+    def _remember(self, ofs, kind, data):
+        if self._base_bytes + len(data) > _max_cached_bases:
+            self._bases.clear()
+            self._base_bytes = 0
+        self._bases[ofs] = kind, data
+        self._base_bytes += len(data)
+
+
+def _verify_objects(pack, idx, pack_path, idx_path):
+    """Return the number of objects verified, or None (after logging
+    errors) if the pack or index is damaged."""
+    nsha = struct.unpack_from('!I', idx, 8 + 255 * 4)[0]
+    sha_ofs = 8 + 256 * 4
+    crc_ofs = sha_ofs + 20 * nsha
+    ofs32_ofs = crc_ofs + 4 * nsha
+    ofs64_ofs = ofs32_ofs + 4 * nsha
+    if ofs64_ofs + 40 > len(idx):
+        log(f'error: truncated {path_msg(idx_path)}\n')
+        return None
+    n_ofs64 = (len(idx) - 40 - ofs64_ofs) // 8
+    sig, ver, count = struct.unpack_from('!4sII', pack, 0)
+    if sig != b'PACK' or ver not in (2, 3):
+        log(f'error: invalid header in {path_msg(pack_path)}\n')
+        return None
+    if count != nsha:
+        log(f'error: {path_msg(pack_path)} has {count} objects,'
+            f' index has {nsha}\n')
+        return None
+
+    offsets = []
+    for i in range(nsha):
+        ofs = struct.unpack_from('!I', idx, ofs32_ofs + 4 * i)[0]
+        if ofs & 0x80000000:
+            j = ofs & 0x7fffffff
+            if j >= n_ofs64:
+                log(f'error: invalid large offset in {path_msg(idx_path)}\n')
+                return None
+            ofs = struct.unpack_from('!Q', idx, ofs64_ofs + 8 * j)[0]
+        offsets.append((ofs, i))
+    offsets.sort()
+    pack_end = len(pack) - 20
+    ends = {}
+    prev = 12
+    for n, (ofs, i) in enumerate(offsets):
+        if (n == 0 and ofs != 12) or (n > 0 and ofs <= prev) \
+           or ofs >= pack_end:
+            log(f'error: invalid offset {ofs} in {path_msg(idx_path)}\n')
+            return None
+        ends[ofs] = offsets[n + 1][0] if n + 1 < nsha else pack_end
+        prev = ofs
+
+    oid_ofs = None
+    def find_oid_ofs(oid):
+        nonlocal oid_ofs
+        if oid_ofs is None:
+            oid_ofs = {idx[sha_ofs + 20 * i:sha_ofs + 20 * (i + 1)]: ofs
+                       for ofs, i in offsets}
+        return oid_ofs.get(oid)
+
+    reader = _PackReader(pack, ends, find_oid_ofs)
+    ok = True
+    with memoryview(pack) as pack_mv:
+        for ofs, i in offsets:
+            oid = idx[sha_ofs + 20 * i:sha_ofs + 20 * (i + 1)]
+            crc = struct.unpack_from('!I', idx, crc_ofs + 4 * i)[0]
+            if zlib.crc32(pack_mv[ofs:ends[ofs]]) != crc:
+                log(f'error: CRC mismatch for {oid.hex()}'
+                    f' in {path_msg(pack_path)}\n')
+                ok = False
+                continue
+            try:
+                kind, data = reader.object(ofs)
+            except (_Corrupt, zlib.error, IndexError) as ex:
+                log(f'error: damaged object {oid.hex()}'
+                    f' in {path_msg(pack_path)} ({ex})\n')
+                ok = False
+                continue
+            actual = calc_hash(kind, data)
+            if actual != oid:
+                log(f'error: object {oid.hex()} has oid {actual.hex()}'
+                    f' in {path_msg(pack_path)}\n')
+                ok = False
+    return nsha if ok else None
+
+
+def verify_pack(stem, *, quick=False):
+    """Verify stem.pack and stem.idx as described in the module
+    documentation, logging any problems, and return a
+    PackVerification, or None if the full (not quick) check isn't
+    possible because the index isn't version 2, in which case the
+    caller may want to fall back to git verify-pack."""
+    pack_path, idx_path = stem + b'.pack', stem + b'.idx'
+    pack = idx = None
+    try:
+        idx = _map(idx_path)
+        pack = _map(pack_path)
+        ok = True
+        for path, m in ((idx_path, idx), (pack_path, pack)):
+            if m is None:
+                log(f'error: missing {path_msg(path)}\n')
+                ok = False
+        if not ok:
+            return PackVerification(False, 0, len(idx or b'') + len(pack or b''))
+        size = len(idx) + len(pack)
+        if not quick and idx[:8] != _idx_v2_magic:
+            return None
+        # Check both, for the error messages
+        ok = _checksum_ok(idx, idx_path)
+        ok = _checksum_ok(pack, pack_path) and ok
+        if not ok:
+            return PackVerification(False, 0, size)
+        if idx[-40:-20] != pack[-20:]:
+            log(f'error: {path_msg(idx_path)} is not the index for'
+                f' {path_msg(pack_path)}\n')
+            return PackVerification(False, 0, size)
+        if quick:
+            return PackVerification(True, 0, size)
+        if len(idx) < 8 + 256 * 4 + 40 or len(pack) < 12 + 20:
+            log(f'error: truncated {path_msg(idx_path)}\n')
+            return PackVerification(False, 0, size)
+        objects = _verify_objects(pack, idx, pack_path, idx_path)
+        if objects is None:
+            return PackVerification(False, 0, size)
+        return PackVerification(True, objects, size)
+    finally:
+        _close(pack)
+        _close(idx)
+
+
+def ledger_path(repo_dir):
+    return os.path.join(repo_dir, b'fsck-ledger.sqlite3')
+
+
+def pack_fingerprint(stem):
+    """Return (size, mtime_ns, trailing checksum) for stem.pack, or
+    None if it doesn't exist."""
+    try:
+        f = open(stem + b'.pack', 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        st = os.fstat(f.fileno())
+        if st.st_size < 20:
+            return st.st_size, st.st_mtime_ns, b''
+        f.seek(-20, os.SEEK_END)
+        return st.st_size, st.st_mtime_ns, f.read(20)
+
+
+class Ledger:
+    """The record of the last successful verification of each pack,
+    keyed by pack name (e.g. pack-HASH.pack)."""
+    def __init__(self, path):
+        """Open (creating if needed) the ledger at path.  Raise
+        sqlite3.Error if that's not possible."""
+        self.closed = True
+        self._db = sqlite3.connect(path, timeout=10, isolation_level=None)
+        try:
+            self._db.execute('create table if not exists verified'
+                             ' (name blob primary key,'
+                             '  size integer not null,'
+                             '  mtime_ns integer not null,'
+                             '  trailer blob not null,'
+                             '  verified_at real not null)'
+                             ' without rowid')
+            self._db.execute('create table if not exists info'
+                             ' (name text primary key, value)')
+        except:
+            self._db.close()
+            raise
+        self.closed = False
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._db.close()
+
+    def __del__(self): assert self.closed
+    def __enter__(self): return self
+    def __exit__(self, type, value, traceback): self.close()
+
+    def entries(self):
+        """Return a dict mapping pack names to (size, mtime_ns,
+        trailer, verified_at)."""
+        return {row[0]: tuple(row[1:]) for row in
+                self._db.execute('select name, size, mtime_ns, trailer,'
+                                 ' verified_at from verified')}
+
+    def record(self, stem, fingerprint, verified_at):
+        """Record that stem.pack, with the given pack_fingerprint(),
+        was verified at verified_at (seconds since the epoch)."""
+        self._db.execute('insert or replace into verified'
+                         ' values (?, ?, ?, ?, ?)',
+                         (basename(stem) + b'.pack', *fingerprint,
+                          verified_at))
+
+    def forget_except(self, stems):
+        """Drop the records for all packs other than the stems'."""
+        keep = frozenset(basename(x) + b'.pack' for x in stems)
+        with self._db:
+            self._db.execute('begin immediate')
+            gone = [(name,) for name in self.entries() if name not in keep]
+            self._db.executemany('delete from verified where name = ?', gone)
+
+    def last_run(self):
+        """Return the start time of the previous incremental run, or
+        None."""
+        row = self._db.execute("select value from info"
+                               " where name = 'last-run'").fetchone()
+        return row[0] if row else None
+
+    def set_last_run(self, when):
+        self._db.execute("insert or replace into info values ('last-run', ?)",
+                         (when,))
+
+
+def packs_to_verify(ledger, stems, now, max_age_days):
+    """Return the subset of the pack stems that an incremental run
+    starting at now should verify: every pack that hasn't been
+    verified, has changed since it was verified, or was last verified
+    max_age_days or more ago, plus enough of the least recently
+    verified remaining packs to spread verification of all of them
+    evenly over max_age_days (given the time since the previous run),
+    rather than having them all come due at once."""
+    entries = ledger.entries()
+    max_age = max_age_days * 24 * 60 * 60
+    due = []
+    current = []
+    for stem in stems:
+        fingerprint = pack_fingerprint(stem)
+        entry = entries.get(basename(stem) + b'.pack')
+        if fingerprint is None or entry is None or entry[:3] != fingerprint \
+           or now - entry[3] >= max_age:
+            due.append(stem)
+        else:
+            current.append((entry[3], stem))
+    last_run = ledger.last_run()
+    if last_run is None:
+        share = 1
+    else:
+        share = min(1, max(0, now - last_run) / max_age)
+    extra = round(len(stems) * share) - len(due)
+    if extra > 0:
+        current.sort()
+        due.extend(stem for _, stem in current[:extra])
+    due_set = frozenset(due)
+    return [stem for stem in stems if stem in due_set]
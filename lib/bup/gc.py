@@ -4,7 +4,7 @@ from contextlib import ExitStack
 from os.path import basename
 import glob, os, re, subprocess, sys, tempfile
 
-from bup import bloom, git, midx
+from bup import bloom, du, git, midx, vfsdb
 from bup.bloom import BloomWriter
 from bup.git import MissingObject, walk_object
 from bup.helpers import \
@@ -292,6 +292,10 @@ def bup_gc(threshold=10, compression=1, verbosity=0, ignore_missing=False):
                 sweep(live_objects, live_trees, existing_count, cat_pipe,
                       threshold, compression,
                       verbosity)
+                # After the sweep, since it opens (and so may create) it
+                if verbosity: log('clearing persistent vfs cache\n')
+                vfsdb.clear(git.repo())
+                du.clear(git.repo())
             except BaseException as ex:
                 log('WARNING: Collection interrupted.  Run gc (again) to completion before\n'
                     'WARNING: adding any new data to the repository (e.g. via save or get).\n')
@@ -3,9 +3,11 @@ bup repositories are in Git format. This library allows us to
 interact with the Git data structures.
 """
 
-import os, sys, zlib, subprocess, struct, stat, re, glob
+import os, sys, zlib, subprocess, struct, stat, re, glob, threading, time
 from array import array
 from binascii import hexlify, unhexlify
+from bisect import bisect_right
+from collections import deque
 from contextlib import ExitStack
 from dataclasses import replace
 from itertools import islice
@@ -16,7 +18,7 @@ from sys import stderr
 from typing import Literal, Optional, Union
 
 from bup import _helpers, hashsplit, midx, xstat
-from bup.bloom import BloomInvalid, BloomNotFound, BloomReader
+from bup.bloom import BloomInvalid, BloomNotFound, SegmentedBloomReader
 from bup.commit import create_commit_blob, parse_commit
 from bup.compat import dataclass_frozen_for_testing, environ
 from bup.config import ConfigError
@@ -738,7 +740,7 @@ class PackIdxList:
             self.packs = new_packs
             if self.bloom is None:
                 try:
-                    self.bloom = BloomReader(bfull)
+                    self.bloom = SegmentedBloomReader(bfull)
                 except BloomNotFound:
                     pass
                 except BloomInvalid as ex:
@@ -759,6 +761,129 @@ class PackIdxList:
             % (len(self.packs), len(self.packs)!=1 and 'es' or ''))
 
 
+class SharedPackIdxList:
+    """A PackIdxList that can be shared by multiple threads (e.g. bup
+    daemon sessions) as a read-only view of a repository's indexes.
+    Since a process may only have one PackIdxList, there can only be
+    one of these, and no other PackIdxList, while it's open.  Packs
+    written by other processes are noticed (via the pack directory
+    mtime) within refresh_interval seconds.
+
+    """
+    def __init__(self, dir, ignore_midx=False, refresh_interval=1):
+        self.dir = dir
+        self._lock = threading.Lock()
+        self._midx_lock = threading.Lock()
+        self._refresh_interval = refresh_interval
+        self._dir_mtime = self._pack_dir_mtime()
+        self._checked = time.monotonic()
+        self._pil = PackIdxList(dir, ignore_midx=ignore_midx)
+
+    def close(self):
+        with self._lock:
+            self._pil.close()
+
+    def __enter__(self): return self
+    def __exit__(self, type, value, traceback): self.close()
+
+    def _pack_dir_mtime(self):
+        try:
+            return os.stat(self.dir).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _maybe_refresh(self):
+        now = time.monotonic()
+        if now - self._checked < self._refresh_interval:
+            return
+        self._checked = now
+        mtime = self._pack_dir_mtime()
+        if mtime != self._dir_mtime:
+            self._dir_mtime = mtime
+            self._pil.refresh()
+
+    def exists(self, hash, want_source=False, want_offset=False):
+        """Return an ObjectLocation if the object exists in this
+           index, otherwise None."""
+        with self._lock:
+            self._maybe_refresh()
+            return self._pil.exists(hash, want_source=want_source,
+                                    want_offset=want_offset)
+
+    def refresh(self):
+        with self._lock:
+            self._dir_mtime = self._pack_dir_mtime()
+            self._checked = time.monotonic()
+            self._pil.refresh()
+
+    def pack_finished(self, run_midx=True):
+        """Account for a newly written pack, running auto_midx()
+        first when run_midx is true (serialized across threads)."""
+        if run_midx:
+            with self._midx_lock:
+                auto_midx(self.dir)
+        self.refresh()
+
+
+class PackedSizes:
+    """Report the number of bytes each object occupies in its pack
+    (i.e. compressed, including the object header), via the offset
+    of the object that follows it.  Callers must close() the
+    instance."""
+    def __init__(self, idxs):
+        """Find objects via the idxs, a PackIdxList."""
+        self._idxs = idxs
+        self._packs = {} # idx name -> (idx, sorted offsets, pack data end)
+
+    def close(self):
+        packs, self._packs = self._packs, {}
+        with ExitStack() as stack:
+            for idx, _, _ in packs.values():
+                stack.enter_context(idx)
+
+    def __enter__(self): return self
+    def __exit__(self, type, value, traceback): self.close()
+
+    def _pack(self, name):
+        info = self._packs.get(name)
+        if info:
+            return info
+        idx_path = os.path.join(self._idxs.dir, name)
+        idx = open_idx(idx_path)
+        try:
+            offsets = array('Q', sorted(ofs for ofs, _
+                                        in idx.oid_offsets_and_idxs()))
+            end = os.path.getsize(idx_path[:-4] + b'.pack') - 20
+        except BaseException:
+            idx.close()
+            raise
+        info = self._packs[name] = idx, offsets, end
+        return info
+
+    def count(self, name):
+        """Return the number of objects in the pack whose idx is
+        named name (as per locate())."""
+        return len(self._pack(name)[0])
+
+    def locate(self, oid):
+        """Return (idx name, position in the idx, packed size) for
+        the object, or None if it's not in any of the packs."""
+        loc = self._idxs.exists(oid, want_source=True)
+        if not loc:
+            return None
+        idx, offsets, end = self._pack(loc.pack)
+        pos = idx._idx_from_hash(oid)
+        ofs = idx._ofs_from_idx(pos)
+        i = bisect_right(offsets, ofs)
+        return loc.pack, pos, (offsets[i] if i < len(offsets) else end) - ofs
+
+    def size(self, oid):
+        """Return the packed size of the object, or None if it's not
+        in any of the packs."""
+        loc = self.locate(oid)
+        return loc[2] if loc else None
+
+
 def open_idx(filename):
     if not filename.endswith(b'.idx'): # why is this enforced *here*?
         raise GitError('pack idx filenames must end with .idx')
@@ -780,6 +905,103 @@ def open_idx(filename):
                        % path_msg(filename))
 
 
+class StoredBlobFinder:
+    """Find the content of blobs that are stored in a repository's
+    packs without compression (i.e. written with compression level 0,
+    as zlib "stored" blocks) so it can be copied directly from the
+    pack files, e.g. via os.copy_file_range().  May be used by
+    multiple threads.
+
+    """
+    def __init__(self, repo_dir=None):
+        self._pack_dir = repo(b'objects/pack', repo_dir=repo_dir)
+        self._lock = threading.Lock()
+        self._packs = {} # idx name -> (idx, pack fd)
+        self.closed = False
+        self._idxs = SharedPackIdxList(self._pack_dir)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            with ExitStack() as contexts:
+                contexts.enter_context(self._idxs)
+                for idx, fd in self._packs.values():
+                    contexts.enter_context(idx)
+                    contexts.callback(os.close, fd)
+                self._packs = {}
+
+    def __enter__(self): return self
+    def __exit__(self, type, value, traceback): self.close()
+
+    def _pack(self, name):
+        """Return (idx, pack fd) for the idx named name."""
+        with self._lock:
+            info = self._packs.get(name)
+            if info is None:
+                path = os.path.join(self._pack_dir, name)
+                idx = open_idx(path)
+                try:
+                    fd = os.open(path[:-len(b'.idx')] + b'.pack', os.O_RDONLY)
+                except BaseException:
+                    idx.close()
+                    raise
+                info = self._packs[name] = idx, fd
+            return info
+
+    def find(self, oid):
+        """Return (pack_fd, extents) if the blob oid is stored without
+        compression, where extents is a list of the (offset, length)
+        pairs within the pack that make up the blob's content,
+        otherwise return None.
+
+        """
+        loc = self._idxs.exists(oid, want_source=True)
+        if not loc:
+            return None
+        idx, fd = self._pack(loc.pack)
+        ofs = idx.find_offset(oid)
+        if ofs is None:
+            return None
+        hdr = os.pread(fd, 32, ofs)
+        c = hdr[0]
+        if (c & 0x70) >> 4 != _typemap[b'blob']:
+            return None # including deltas
+        size = c & 0x0f
+        shift = 4
+        i = 0
+        while c & 0x80:
+            i += 1
+            c = hdr[i]
+            size |= (c & 0x7f) << shift
+            shift += 7
+        i += 1
+        cmf, flg = hdr[i], hdr[i + 1]
+        if cmf & 0x0f != 8 or flg & 0x20: # not deflate, or has a dictionary
+            return None
+        pos = ofs + i + 2
+        extents = []
+        found = 0
+        while True:
+            block = os.pread(fd, 5, pos)
+            if len(block) != 5:
+                return None
+            final = block[0] & 1
+            if (block[0] >> 1) & 3 != 0: # not a stored block
+                return None
+            n, check = struct.unpack('<HH', block[1:])
+            if n ^ check != 0xffff:
+                return None
+            if n:
+                extents.append((pos + 5, n))
+                found += n
+            pos += 5 + n
+            if final:
+                break
+        if found != size:
+            return None
+        return fd, extents
+
+
 def open_object_idx(filename):
     if filename.endswith(b'.idx'):
         return open_idx(filename)
@@ -805,9 +1027,12 @@ def idxmerge(idxlist, final_progress=True):
 class LocalPackStore():
 
     def __init__(self, *, allow_duplicates=False, on_pack_finish=None,
-                 repo_dir=None, run_midx=True):
+                 repo_dir=None, run_midx=True, objcache=None):
         """When allow_duplicates is false, (at some cost) avoid
         writing duplicates of objects that already in the repository.
+        When objcache (e.g. a SharedPackIdxList) is provided, use it
+        for exists(), leave it open, and call its pack_finished()
+        after each pack is written.
 
         """
         self._closed = False
@@ -815,7 +1040,8 @@ class LocalPackStore():
         self._idx = None
         self._deduplicate_writes = not allow_duplicates
         self._obj_count = 0
-        self._objcache = None
+        self._shared_objcache = objcache
+        self._objcache = objcache
         self._on_pack_finish = on_pack_finish
         self._parentfd = None
         self._repo_dir = repo_dir or repo()
@@ -878,7 +1104,8 @@ class LocalPackStore():
         self._file, f = None, self._file
         self._idx, idx = None, self._idx
         try:
-            with nullcontext_if_not(self._objcache), \
+            with nullcontext_if_not(None if self._shared_objcache
+                                    else self._objcache), \
                  finalized(pfd, lambda x: x is not None and os.close(x)), \
                  nullcontext_if_not(f):
                 if abort or not f:
@@ -909,12 +1136,15 @@ class LocalPackStore():
                 fsync(pfd)
                 if self._on_pack_finish:
                     self._on_pack_finish(nameprefix)
-                if self._run_midx:
+                if self._shared_objcache:
+                    self._shared_objcache.pack_finished(run_midx=self._run_midx)
+                elif self._run_midx:
                     auto_midx(os.path.join(self._repo_dir, b'objects/pack'))
                 return nameprefix
         finally:
             self._obj_count = 0
-            self._objcache = None # last -- some code above depends on it
+            # last -- some code above depends on it
+            self._objcache = self._shared_objcache
             if tmpdir:
                 rmtree(tmpdir)
 
@@ -927,19 +1157,36 @@ class LocalPackStore():
         return self.finish_pack()
 
 
+# The most object content PackWriter will hold while deferring
+# existence checks (see check_batch).
+_max_deferred_bytes = 8 * 1024 * 1024
+
 # bup-gc assumes that it can disable all PackWriter activities
 # (bloom/midx/cache) via the constructor and close() arguments.
 
 
 class PackWriter:
-    """Write Git objects to pack files."""
+    """Write Git objects to pack files.
+
+    When check_batch is not None, maybe_write() defers up to that many
+    objects whose existence is unknown, and then checks for all of
+    them at once via store.exists_many(), which must return a list of
+    booleans like Client.have_oids().  That's much less expensive than
+    a check per object when the store has to ask a server.
+
+    """
 
     def __init__(self, *, store, compression_level=None,
-                 max_pack_size=None, max_pack_objects=None):
+                 max_pack_size=None, max_pack_objects=None,
+                 check_batch=None):
+        assert check_batch is None or check_batch > 0, check_batch
         self._byte_count = 0
         self._obj_count = 0
         self._store = store
         self._pending_oids = set()
+        self._check_batch = check_batch
+        self._deferred = {} # oid -> (type, content)
+        self._deferred_bytes = 0
         if compression_level is None:
             compression_level = 1
         self.compression_level = compression_level
@@ -972,8 +1219,22 @@ class PackWriter:
     def exists(self, oid, want_source=False):
         """Return non-empty if an object is found in the object cache."""
         return oid in self._pending_oids \
+            or oid in self._deferred \
             or self._store.exists(oid, want_source=want_source)
 
+    def _write_deferred(self):
+        if not self._deferred:
+            return
+        deferred = self._deferred
+        self._deferred = {}
+        self._deferred_bytes = 0
+        oids = list(deferred)
+        for oid, found in zip(oids, self._store.exists_many(oids)):
+            if not found:
+                type, content = deferred[oid]
+                self._write(oid, type, content)
+                self._pending_oids.add(oid)
+
     def just_write(self, sha, type, content):
         """Write an object to the pack file without deduplication."""
         self._write(sha, type, content)
@@ -982,9 +1243,20 @@ class PackWriter:
     def maybe_write(self, type, content):
         """Write an object to the pack file if not present and return its id."""
         sha = calc_hash(type, content)
-        if not self.exists(sha):
-            self._write(sha, type, content)
-            self._pending_oids.add(sha)
+        if self._check_batch is None:
+            if not self.exists(sha):
+                self._write(sha, type, content)
+                self._pending_oids.add(sha)
+            return sha
+        if sha in self._pending_oids or sha in self._deferred:
+            return sha
+        self._deferred[sha] = type, content
+        self._deferred_bytes += len(content)
+        # Write commits right away since they're likely to be
+        # referred to (e.g. by a ref update) as soon as they exist.
+        if type == b'commit' or len(self._deferred) >= self._check_batch \
+           or self._deferred_bytes >= _max_deferred_bytes:
+            self._write_deferred()
         return sha
 
     def new_blob(self, blob):
@@ -1013,16 +1285,20 @@ class PackWriter:
 
     def abort(self):
         """Remove the pack file from disk."""
+        self._deferred = {}
+        self._deferred_bytes = 0
         self._store.abort()
 
     def breakpoint(self):
         """Clear byte and object counts and return the last processed id."""
+        self._write_deferred()
         result = self._store.finish_pack()
         self._byte_count = self._obj_count = 0
         return result
 
     def close(self):
         """Close the pack file and move it to its definitive path."""
+        self._write_deferred()
         return self._store.close()
 
 
@@ -1478,6 +1754,63 @@ class CatPipe:
                 raise ex
         return oidx, typ, size, data_iterator()
 
+    def get_many(self, refs, window=64):
+        """Yield the get() result for each of the refs, in order,
+        except that the data will be bytes rather than an iterator.
+        Keep up to window requests outstanding so that git can
+        retrieve the upcoming objects while the caller is handling the
+        current one.
+
+        """
+        if not self.p or self.p.poll() is not None:
+            self.restart()
+        assert not self.inprogress, \
+            f'batch request while {self.inprogress.decode("ascii")} is open'
+        p = self.p
+        prefix = b'contents ' if self.have_batch_command else b''
+        refs = iter(refs)
+        pending = deque()
+        def send():
+            for ref in islice(refs, window - len(pending)):
+                assert ref.find(b'\n') < 0
+                assert ref.find(b'\r') < 0
+                assert not ref.startswith(b'-')
+                p.stdin.write(prefix + ref + b'\n')
+                pending.append(ref)
+            p.stdin.flush()
+        self.inprogress = b'batch'
+        try:
+            send()
+            while pending:
+                ref = pending.popleft()
+                hdr = p.stdout.readline()
+                if not hdr:
+                    raise GitError('unexpected cat-file EOF (last request: %r, exit: %s)'
+                                   % (ref, p.poll() or 'none'))
+                if hdr.endswith(b' missing\n'):
+                    result = None, None, None, None
+                else:
+                    info = hdr.split(b' ')
+                    if len(info) != 3 or len(info[0]) != 40:
+                        raise GitError('expected object (id, type, size), got %r' % info)
+                    oidx, typ, size = info
+                    size = int(size)
+                    data = p.stdout.read(size)
+                    if len(data) != size:
+                        raise GitError('unexpected cat-file EOF (last request: %r, exit: %s)'
+                                       % (ref, p.poll() or 'none'))
+                    readline_result = p.stdout.readline()
+                    assert readline_result == b'\n'
+                    result = oidx, typ, size, data
+                if len(pending) < window // 2:
+                    send()
+                yield result
+        except BaseException:
+            # Including GeneratorExit, since responses may be pending
+            self.close()
+            raise
+        self.inprogress = None
+
 
 _catpipe_for = {}
 
@@ -1501,6 +1834,69 @@ def close_catpipes():
         cp.close(wait=True)
 
 
+class CatPipePool:
+    """A CatPipe substitute that may be used by multiple threads at
+    once.  Each get() is handled by an idle CatPipe (a new one if
+    they're all busy), and so the returned data iterator will always
+    be over data that has already been read in full.
+
+    """
+    def __init__(self, repo_dir=None):
+        self.repo_dir = repo_dir
+        self._lock = threading.Lock()
+        self._idle = []
+        self._all = []
+
+    def close(self, wait=False):
+        with self._lock:
+            pipes, self._all, self._idle = self._all, [], []
+        result = None
+        for cp in pipes:
+            rc = cp.close(wait=wait)
+            result = result or rc
+        return result
+
+    def __enter__(self): return self
+    def __exit__(self, type, value, traceback): self.close()
+
+    def get(self, ref, include_data=True):
+        """Return the same thing as CatPipe.get()."""
+        with self._lock:
+            cp = self._idle.pop() if self._idle else None
+        if not cp:
+            cp = CatPipe(self.repo_dir)
+            with self._lock:
+                self._all.append(cp)
+        try:
+            oidx, typ, size, it = cp.get(ref, include_data=include_data)
+            if it is not None:
+                it = iter((b''.join(it),))
+        except BaseException:
+            # The request may still be in progress, so the pipe must
+            # be restarted by the next get().
+            cp.close()
+            raise
+        finally:
+            with self._lock:
+                self._idle.append(cp)
+        return oidx, typ, size, it
+
+    def get_many(self, refs, window=64):
+        """Return the same thing as CatPipe.get_many()."""
+        with self._lock:
+            cp = self._idle.pop() if self._idle else None
+        if not cp:
+            cp = CatPipe(self.repo_dir)
+            with self._lock:
+                self._all.append(cp)
+        try:
+            yield from cp.get_many(refs, window=window)
+        finally:
+            # Safe even when abandoned, since the pipe will be restarted
+            with self._lock:
+                self._idle.append(cp)
+
+
 def tags(repo_dir = None):
     """Return a dictionary of all tags in the form {hash: [tag_names, ...]}."""
     res = {}
@@ -1611,3 +2007,42 @@ def walk_object(get_ref, oidx, *, stop_at=None, include_data=None,
             for mode, name, ent_id in tree_iter(data):
                 pending.append((False, hexlify(ent_id), tree_path, name, mode,
                                 b'tree' if stat.S_ISDIR(mode) else b'blob'))
+
+
+def walk_tree_objects(get_ref, oidx, *, exclude=()):
+    """Yield a WalkItem (including the data) for oidx and for every
+    object reachable from it via get_ref (which must behave like
+    CatPipe get), once each, skipping any object whose oidx is in
+    exclude, along with anything only reachable through it.  When
+    oidx refers to a commit, yield the commit and its tree, but don't
+    follow its parents.  Unlike walk_object, yield items depth first,
+    pre-order, i.e. each tree before its entries, and the entries in
+    tree order, so that a consumer reading the objects as it
+    traverses the tree can use them as they arrive.  Set the data to
+    False (and the type to None) for missing objects.
+
+    """
+    seen = set(exclude)
+    pending = [(oidx, oidx, None, True)]
+    while pending:
+        oidx, name, mode, top = pending.pop()
+        if oidx in seen:
+            continue
+        seen.add(oidx)
+        get_oidx, typ, _, it = get_ref(oidx)
+        if not get_oidx:
+            yield WalkItem(oid=unhexlify(oidx), type=None, name=name, mode=mode,
+                           data=False)
+            continue
+        if typ not in (b'blob', b'commit', b'tree'):
+            raise Exception('unexpected repository object type %r' % typ)
+        data = b''.join(it)
+        yield WalkItem(oid=unhexlify(oidx), type=typ, name=name, mode=mode,
+                       data=data)
+        if typ == b'commit':
+            if top:
+                tree = parse_commit(data).tree
+                pending.append((tree, tree, hashsplit.GIT_MODE_TREE, False))
+        elif typ == b'tree':
+            for ent_mode, ent_name, ent_id in reversed(list(tree_iter(data))):
+                pending.append((hexlify(ent_id), ent_name, ent_mode, False))
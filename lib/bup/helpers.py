@@ -8,7 +8,7 @@ from time import localtime
 from typing import Callable, NoReturn
 from shutil import rmtree
 import sys, os, subprocess, errno, select, mmap, stat, re, struct
-import hashlib, heapq, math, operator, time
+import hashlib, heapq, math, operator, time, zlib
 
 from bup import _helpers
 from bup import io
@@ -550,6 +550,50 @@ def mux(outfd, outr, errr):
         os.write(outfd, struct.pack('!IB', 0, 3))
 
 
+class MuxOutput:
+    """A file-like object that multiplexes everything written to it
+    onto the file f as mux() does for stdout, for a DemuxConn on the
+    other end.  Call close() to terminate the multiplexed "session".
+
+    """
+    def __init__(self, f):
+        self._f = f
+        self._buf = bytearray()
+        self.closed = False
+        f.write(b'BUPMUX')
+
+    def _send(self, fdw, data):
+        for i in range(0, len(data), MAX_PACKET):
+            packet = data[i:i + MAX_PACKET]
+            self._f.write(struct.pack('!IB', len(packet), fdw))
+            self._f.write(packet)
+
+    def write(self, data):
+        self._buf += data
+        if len(self._buf) >= MAX_PACKET:
+            self._send(1, self._buf)
+            self._buf.clear()
+
+    def flush(self):
+        if self._buf:
+            self._send(1, self._buf)
+            self._buf.clear()
+        self._f.flush()
+
+    def write_stderr(self, data):
+        """Send data as if it had been written to stderr."""
+        self.flush()
+        self._send(2, data)
+        self._f.flush()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.flush()
+            self._f.write(struct.pack('!IB', 0, 3))
+            self._f.flush()
+
+
 class DemuxConn(BaseConn):
     """A helper class for bup's client-server protocol.  For now, it
     always assumes it takes responsbility for all of the remaining
@@ -666,6 +710,124 @@ class DemuxConn(BaseConn):
         return self._load_buf(0)
 
 
+class _DeflatingWriter:
+    """Compress everything written, and send it to the conn as
+    length-prefixed frames, one whenever flush() is called, or
+    whenever the pending compressed data grows too large.
+
+    """
+    max_frame = 1 << 20
+    def __init__(self, conn, level):
+        self._conn = conn
+        self._compressor = zlib.compressobj(level)
+        self._frame = []
+        self._frame_size = 0
+        self._pending = False
+    def _send_frame(self, frame):
+        for i in range(0, max(1, len(frame)), self.max_frame):
+            part = frame[i:i + self.max_frame]
+            self._conn.write(struct.pack('!I', len(part)))
+            self._conn.write(part)
+    def write(self, data):
+        if data:
+            self._pending = True
+            buf = self._compressor.compress(data)
+            if buf:
+                self._frame.append(buf)
+                self._frame_size += len(buf)
+                if self._frame_size >= self.max_frame:
+                    self._send_frame(b''.join(self._frame))
+                    self._frame, self._frame_size = [], 0
+        return len(data)
+    def flush(self):
+        if self._pending:
+            self._frame.append(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+            self._send_frame(b''.join(self._frame))
+            self._frame, self._frame_size = [], 0
+            self._pending = False
+        self._conn.outp.flush()
+
+
+class CompressedConn(BaseConn):
+    """A conn that zlib compresses everything written to (and
+    decompresses everything read from) another conn.  Data is sent as
+    a single compression stream, split into length-prefixed frames,
+    and the last frame before any read is flushed (Z_SYNC_FLUSH) so
+    that the peer can decompress everything written so far.  Closing
+    this conn does not close the underlying conn.
+
+    Frames larger than _DeflatingWriter.max_frame are rejected, and
+    no more than max_inflate bytes are decompressed at a time, so that
+    the peer can't force arbitrarily large allocations.
+
+    """
+    max_inflate = 1 << 20
+    def __init__(self, conn, level):
+        BaseConn.__init__(self, _DeflatingWriter(conn, level))
+        self._conn = conn
+        self._decompressor = zlib.decompressobj()
+        self._buf = bytearray()
+        self._pos = 0
+
+    def close(self):
+        if not self._base_closed:
+            self.outp.flush()
+            BaseConn.close(self)
+
+    def _fill(self):
+        """Decompress up to max_inflate more bytes into the buffer,
+        reading the next frame if the current one has been consumed.
+        Return false at EOF.
+
+        """
+        data = self._decompressor.unconsumed_tail
+        if not data:
+            ns = self._conn.read(4)
+            if not ns:
+                return False
+            if len(ns) < 4:
+                raise Exception('compressed conn: EOF in frame header')
+            n = struct.unpack('!I', ns)[0]
+            if n > _DeflatingWriter.max_frame:
+                raise Exception('compressed conn: frame size %d exceeds %d'
+                                % (n, _DeflatingWriter.max_frame))
+            data = self._conn.read(n)
+            if len(data) < n:
+                raise Exception('compressed conn: EOF with %d frame bytes remaining'
+                                % (n - len(data)))
+        buf = self._buf
+        if self._pos:
+            del buf[:self._pos]
+            self._pos = 0
+        buf += self._decompressor.decompress(data, self.max_inflate)
+        return True
+
+    def _read(self, size):
+        while len(self._buf) - self._pos < size:
+            if not self._fill():
+                break
+        pos = self._pos
+        self._pos = min(len(self._buf), pos + size)
+        return bytes(self._buf[pos:self._pos])
+
+    def _readline(self):
+        scanned = 0 # unread bytes already known not to contain a newline
+        while True:
+            i = self._buf.find(b'\n', self._pos + scanned)
+            if i < 0:
+                scanned = len(self._buf) - self._pos
+                if self._fill():
+                    continue
+            pos = self._pos
+            self._pos = i + 1 if i >= 0 else len(self._buf)
+            return bytes(self._buf[pos:self._pos])
+
+    def has_input(self):
+        return len(self._buf) > self._pos \
+            or bool(self._decompressor.unconsumed_tail) \
+            or self._conn.has_input()
+
+
 def linereader(f):
     """Generate a list of input lines from 'f' without terminating newlines."""
     while 1:
@@ -739,7 +901,7 @@ class atomically_replaced_file:
         self._path_parent_fd = None
         self._path_parent, self._path_base = os.path.split(self.path)
         if not self._path_parent:
-            self._path_parent = '.'
+            self._path_parent = b'.' if isinstance(path, bytes) else '.'
         assert self._path_base, f'{self._path_base} is a directory'
         ctx = ExitStack()
         self._cleanup = ctx
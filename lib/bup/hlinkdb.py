@@ -1,35 +1,185 @@
+"""The index's record of hard links
 
+The database maps each "node" (device and inode number) with more
+than one link to the paths that refer to it.  It's stored in a
+sorted binary format (see _header_fmt) that's memory mapped, and
+looked up via binary search, so that neither opening the database
+nor finding a node's paths requires memory proportional to the
+number of hard links.  Changes are kept in memory until the database
+is saved, at which point the existing content is merged with them to
+produce the new file.
+
+Older versions of bup pickled a {b'dev:ino': [path, ...]} dict, and
+that format is still read (and converted when saved).
+
+"""
+
+from bisect import bisect_left
 from contextlib import ExitStack
-import pickle
+import pickle, struct
 
-from bup.helpers import atomically_replaced_file, fsync, unlink
+from bup.helpers import \
+    atomically_replaced_file, fsync, mmap_read, unlink
 
 
-def pickle_load(filename):
-    try:
-        f = open(filename, 'rb')
-    except FileNotFoundError:
-        return None
-    with f:
-        return pickle.load(f, encoding='bytes')
+# magic, version, node count, node table offset; then the paths
+# (NUL separated for each node), and then the node table, sorted by
+# (dev, ino), each entry giving the node's paths offset and length.
+_header_fmt = '!4sIQQ'
+_header_len = struct.calcsize(_header_fmt)
+_node_fmt = '!QQQQ'
+_node_len = struct.calcsize(_node_fmt)
+_key_len = 16
+
+HLINK_HEADER = b'HLNK'
+HLINK_VERSION = 1
 
 
 class Error(Exception):
     pass
 
+
+def _node_key(dev, ino):
+    return struct.pack('!QQ', dev, ino)
+
+
+class _NodeTable:
+    """The content of an existing database file."""
+    def __init__(self, filename):
+        self.count = 0
+        self._map = None
+        self._legacy = None
+        try:
+            f = open(filename, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            header = f.read(_header_len)
+            if not header.startswith(HLINK_HEADER):
+                f.seek(0)
+                self._load_legacy(f)
+                return
+            if len(header) < _header_len:
+                raise Error(f'{filename!r} is truncated')
+            _, version, self.count, self._table_ofs = \
+                struct.unpack(_header_fmt, header)
+            if version != HLINK_VERSION:
+                raise Error(f'{filename!r} has unsupported version {version}')
+            if self.count:
+                self._map = mmap_read(f, close=False)
+
+    def _load_legacy(self, f):
+        node_paths = pickle.load(f, encoding='bytes')
+        legacy = []
+        for node, paths in node_paths.items():
+            dev, ino = node.split(b':')
+            legacy.append((_node_key(int(dev), int(ino)), paths))
+        legacy.sort()
+        self._legacy = legacy
+        self.count = len(legacy)
+
+    def close(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+
+    def _entry(self, i):
+        """Return (key, paths offset, paths length) for node i."""
+        m = self._map
+        ofs = self._table_ofs + i * _node_len
+        return (m[ofs:ofs + _key_len],
+                *struct.unpack_from('!QQ', m, ofs + _key_len))
+
+    def _paths(self, ofs, size):
+        return self._map[ofs:ofs + size].split(b'\0')
+
+    def find(self, key):
+        """Return the list of paths for the node key, or None."""
+        if self._legacy is not None:
+            i = bisect_left(self._legacy, (key,))
+            if i < len(self._legacy) and self._legacy[i][0] == key:
+                return list(self._legacy[i][1])
+            return None
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            k, ofs, size = self._entry(lo)
+            if k == key:
+                return self._paths(ofs, size)
+        return None
+
+    def __iter__(self):
+        """Yield (key, paths) for every node, in key order."""
+        if self._legacy is not None:
+            yield from self._legacy
+            return
+        for i in range(self.count):
+            key, ofs, size = self._entry(i)
+            yield key, self._paths(ofs, size)
+
+
 class HLinkDB:
     def __init__(self, filename):
         self.closed = False
         self._cleanup = ExitStack()
         self._filename = filename
         self._pending_save = None
-        # Map a "dev:ino" node to a list of paths associated with that node.
-        self._node_paths = pickle_load(filename) or {}
-        # Map a path to a "dev:ino" node (a reverse hard link index).
-        self._path_node = {}
-        for node, paths in self._node_paths.items():
-            for path in paths:
-                self._path_node[path] = node
+        self._prepared = False
+        self._nodes = _NodeTable(filename)
+        self._cleanup.callback(self._nodes.close)
+        # Changes to the nodes: key -> paths added, key -> paths removed
+        self._added = {}
+        self._removed = {}
+
+    def _merged(self):
+        """Yield (key, paths) for every node with paths, including the
+        pending changes, in key order."""
+        added, removed = self._added, self._removed
+        changed = sorted(added.keys() | removed.keys())
+        def apply(key, paths):
+            gone = removed.get(key)
+            if gone:
+                paths = [p for p in paths if p not in gone]
+            return paths + added.get(key, [])
+        i = 0
+        for key, paths in self._nodes:
+            while i < len(changed) and changed[i] < key:
+                paths_ = apply(changed[i], [])
+                if paths_:
+                    yield changed[i], paths_
+                i += 1
+            if i < len(changed) and changed[i] == key:
+                paths = apply(key, paths)
+                i += 1
+            if paths:
+                yield key, paths
+        for key in changed[i:]:
+            paths = apply(key, [])
+            if paths:
+                yield key, paths
+
+    def _write(self, f):
+        """Write the merged nodes to f and return the node count."""
+        f.write(b'\0' * _header_len)
+        count = 0
+        for _, paths in self._merged():
+            f.write(b'\0'.join(paths))
+            count += 1
+        table_ofs = f.tell()
+        ofs = _header_len
+        for key, paths in self._merged():
+            size = len(b'\0'.join(paths))
+            f.write(key + struct.pack('!QQ', ofs, size))
+            ofs += size
+        f.seek(0)
+        f.write(struct.pack(_header_fmt, HLINK_HEADER, HLINK_VERSION,
+                            count, table_ofs))
+        return count
 
     def prepare_save(self):
         """ Commit all of the relevant data to disk.  Do as much work
@@ -37,23 +187,24 @@ class HLinkDB:
         if self._pending_save:
             raise Error('save of %r already in progress' % self._filename)
         with self._cleanup:
-            if self._node_paths:
-                self._pending_save = atomically_replaced_file(self._filename,
-                                                              mode='wb',
-                                                              buffering=65536)
-                with self._cleanup.enter_context(self._pending_save) as f:
-                    pickle.dump(self._node_paths, f, 2)
+            pending = atomically_replaced_file(self._filename, mode='wb',
+                                               buffering=65536)
+            with self._cleanup.enter_context(pending) as f:
+                if self._write(f):
                     f.flush()
                     fsync(f.fileno())
-            else: # No data
-                self._cleanup.callback(lambda: unlink(self._filename))
+                    self._pending_save = pending
+                else: # No data
+                    pending.cancel()
+                    self._cleanup.callback(lambda: unlink(self._filename))
             self._cleanup = self._cleanup.pop_all()
+        self._prepared = True
 
     def commit_save(self):
         if self.closed:
             return
         self.closed = True
-        if self._node_paths and not self._pending_save:
+        if not self._prepared and (self._nodes.count or self._added):
             raise Error('cannot commit save of %r; no save prepared'
                         % self._filename)
         self._cleanup.close()
@@ -78,34 +229,38 @@ class HLinkDB:
         assert self.closed
 
     def add_path(self, path, dev, ino):
-        # Assume path is new.
-        node = b'%d:%d' % (dev, ino)
-        self._path_node[path] = node
-        link_paths = self._node_paths.get(node)
-        if link_paths and path not in link_paths:
-            link_paths.append(path)
-        else:
-            self._node_paths[node] = [path]
-
-    def _del_node_path(self, node, path):
-        link_paths = self._node_paths[node]
-        link_paths.remove(path)
-        if not link_paths:
-            del self._node_paths[node]
-
-    def change_path(self, path, new_dev, new_ino):
-        prev_node = self._path_node.get(path)
-        if prev_node:
-            self._del_node_path(prev_node, path)
-        self.add_path(new_dev, new_ino, path)
-
-    def del_path(self, path):
+        key = _node_key(dev, ino)
+        gone = self._removed.get(key)
+        if gone and path in gone:
+            gone.discard(path)
+            return
+        if path in (self._nodes.find(key) or ()):
+            return
+        paths = self._added.setdefault(key, [])
+        if path not in paths:
+            paths.append(path)
+
+    def del_path(self, path, dev, ino):
+        """Remove the path from the (dev, ino) node, if it's there."""
         # Path may not be in db (if updating a pre-hardlink support index).
-        node = self._path_node.get(path)
-        if node:
-            self._del_node_path(node, path)
-            del self._path_node[path]
+        key = _node_key(dev, ino)
+        paths = self._added.get(key)
+        if paths and path in paths:
+            paths.remove(path)
+            return
+        if path in (self._nodes.find(key) or ()):
+            self._removed.setdefault(key, set()).add(path)
+
+    def change_path(self, path, dev, ino, new_dev, new_ino):
+        self.del_path(path, dev, ino)
+        self.add_path(path, new_dev, new_ino)
 
     def node_paths(self, dev, ino):
-        node = b'%d:%d' % (dev, ino)
-        return self._node_paths[node]
+        """Return the list of paths for the (dev, ino) node, which may
+        be empty."""
+        key = _node_key(dev, ino)
+        paths = self._nodes.find(key) or []
+        gone = self._removed.get(key)
+        if gone:
+            paths = [p for p in paths if p not in gone]
+        return paths + self._added.get(key, [])
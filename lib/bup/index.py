@@ -12,6 +12,7 @@ from bup.helpers import \
      log,
      merge_iter,
      mkdirp,
+     mmap_read,
      mmap_readwrite,
      progress,
      qprogress,
@@ -105,10 +106,15 @@ def header_len(sig):
 
 class MetaStoreReader:
     def __init__(self, filename):
-        self._file = None
+        self._file = self._map = None
         self._file = open(filename, 'rb') # pylint: disable=consider-using-with
+        if os.fstat(self._file.fileno()).st_size:
+            self._map = mmap_read(self._file, close=False)
 
     def close(self):
+        m, self._map = self._map, None
+        if m:
+            m.close()
         f, self._file = self._file, None
         if f:
             f.close()
@@ -119,6 +125,9 @@ class MetaStoreReader:
 
     def metadata_at(self, ofs):
         # Must return a new instance (callers are allowed to modify it)
+        if self._map and ofs < len(self._map):
+            return metadata.decode(self._map, ofs)[0]
+        # e.g. appended since the file was mapped
         self._file.seek(ofs)
         return metadata.Metadata.read(self._file)
 
@@ -138,22 +147,26 @@ class MetaStoreWriter:
             mkdirp(dirname)
         # FIXME: see how slow this is; does it matter?
         with open(filename, 'ab+') as m_file:
-            m_file.seek(0)
-            try:
-                m_off = m_file.tell()
-                m = metadata.Metadata.read(m_file)
-                while m:
-                    m_encoded = m.encode()
-                    self._offsets[m_encoded] = m_off
-                    m_off = m_file.tell()
-                    m = metadata.Metadata.read(m_file)
-            except EOFError:
-                pass
-            except:
-                log('index metadata in %r appears to be corrupt\n' % filename)
-                raise
+            if os.fstat(m_file.fileno()).st_size:
+                with mmap_read(m_file, close=False) as m_map:
+                    self._load_offsets(m_map, filename)
         self._file = open(filename, 'ab') # pylint: disable=consider-using-with
 
+    def _load_offsets(self, m_map, filename):
+        try:
+            m_off = 0
+            entry = metadata.decode(m_map, m_off)
+            while entry:
+                m, end = entry
+                self._offsets[m.encode()] = m_off
+                m_off = end
+                entry = metadata.decode(m_map, m_off)
+        except EOFError:
+            pass
+        except:
+            log('index metadata in %r appears to be corrupt\n' % filename)
+            raise
+
     def close(self):
         self._closed = True
         if self._file:
@@ -173,14 +173,13 @@ def within_repo(repo, opt, out, pwd=b''):
                     if sub_name.startswith(b'.') and \
                        opt.show_hidden not in ('almost', 'all'):
                         continue
+                    # Only the long listing needs the size, and the
+                    # classification only needs the mode, so don't
+                    # augment the metadata of the other entries.
                     if opt.l:
                         sub_item = vfs.ensure_item_has_metadata(repo, sub_item,
                                                                 include_size=True,
                                                                 public=True)
-                    elif want_meta:
-                        sub_item = vfs.augment_item_meta(repo, sub_item,
-                                                         include_size=True,
-                                                         public=True)
                     line = item_line(sub_item, sub_name)
                     if not opt.long_listing and istty1:
                         pending.append(line)
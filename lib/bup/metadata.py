@@ -8,11 +8,12 @@
 from copy import deepcopy
 from errno import EACCES, EINVAL, ENOTTY, ENOSYS, EOPNOTSUPP
 from io import BytesIO
+from operator import attrgetter
 from os import environb as environ
 from time import gmtime, strftime
 import copy, errno, os, sys, stat, socket
 
-from bup import vint, xstat
+from bup import _helpers, vint, xstat
 from bup.drecurse import recursive_dirlist
 from bup.helpers import \
     (EXIT_FAILURE,
@@ -886,6 +887,17 @@ class Metadata:
         port.write(self.encode(include_path=include_path))
 
     def encode(self, include_path=True):
+        fields = _codec_fields_of(self)
+        if not include_path:
+            fields = (None,) + fields[1:]
+        try:
+            return _helpers.metadata_encode(fields)
+        except (OverflowError, TypeError):
+            # e.g. values beyond 64 bits, or a float time; let the
+            # Python code handle (or reject) them.
+            return self._encode_records(include_path)
+
+    def _encode_records(self, include_path):
         ret = []
         records = [(_rec_tag_path, self._encode_path())] if include_path else []
         records.extend([(_rec_tag_common_v3, self._encode_common()),
@@ -992,6 +1004,126 @@ class Metadata:
 empty_metadata = Metadata()
 
 
+# The Metadata attributes, in the order expected by the _helpers
+# metadata codec.
+_codec_fields = ('path', 'mode', 'uid', 'user', 'gid', 'group', 'rdev',
+                 'atime', 'mtime', 'ctime', 'size',
+                 'symlink_target', 'hardlink_target',
+                 'posix1e_acl', 'linux_attr', 'linux_xattr')
+_codec_fields_of = attrgetter(*_codec_fields)
+
+def _from_fields(fields):
+    result = Metadata(frozen=False)
+    for name, value in zip(_codec_fields, fields):
+        setattr(result, name, value)
+    return result.freeze()
+
+
+class _BufferReader:
+    """A minimal read-only file over a buffer (without copying it)."""
+    __slots__ = ('_buf', 'pos')
+    def __init__(self, buf, pos):
+        self._buf = memoryview(buf)
+        self.pos = pos
+    def read(self, n=-1):
+        start = self.pos
+        end = len(self._buf) if n < 0 else min(start + n, len(self._buf))
+        self.pos = end
+        return bytes(self._buf[start:end])
+
+def decode(data, ofs=0, empty=_use_empty_metadata):
+    """Decode the encoded Metadata at ofs in data (a bytes-like
+    object), and return (meta, end), where end is the offset just past
+    the entry, or None if ofs is at the end of the data.  As with
+    Metadata.read(), meta will be empty (defaulting to
+    metadata.empty_metadata) if the entry had no information at all.
+
+    """
+    if empty is _use_empty_metadata:
+        empty = empty_metadata
+    result = _helpers.metadata_decode(data, ofs)
+    if result is NotImplemented: # e.g. a legacy ACL record
+        port = _BufferReader(data, ofs)
+        meta = Metadata.read(port, empty=empty)
+        return None if meta is None else (meta, port.pos)
+    if result is None:
+        return None
+    fields, end = result
+    return (_from_fields(fields) if fields else empty), end
+
+def decode_all(data, empty=_use_empty_metadata):
+    """Return a list of all of the Metadata entries encoded in data
+    (e.g. the content of a .bupm file).  Entries with no information
+    at all will be empty (defaulting to metadata.empty_metadata)."""
+    if empty is _use_empty_metadata:
+        empty = empty_metadata
+    entries = _helpers.metadata_decode_all(data)
+    if entries is not NotImplemented:
+        return [_from_fields(x) if x else empty for x in entries]
+    result = []
+    ofs = 0
+    while True:
+        entry = decode(data, ofs, empty=empty)
+        if not entry:
+            return result
+        meta, ofs = entry
+        result.append(meta)
+
+def encoded_entries(data):
+    """Return a list of the (still encoded) entries in data, e.g. the
+    content of a .bupm file, without decoding them.  Throw EOFError if
+    the data ends within an entry."""
+    return _helpers.metadata_split(data)
+
+
+class LazyMetadata(Metadata):
+    """A frozen Metadata view of an encoded entry (see
+    encoded_entries()) that isn't decoded until one of its fields is
+    first accessed."""
+
+    __slots__ = ('_encoded',)
+
+    def __init__(self, encoded): # pylint: disable=super-init-not-called
+        self._encoded = encoded
+        self._frozen = True
+
+    def _decode(self):
+        result = _helpers.metadata_decode(self._encoded, 0)
+        if result is NotImplemented or result is None:
+            fields = _codec_fields_of(decode(self._encoded)[0])
+        else:
+            fields = result[0] or (None,) * len(_codec_fields)
+        for name, value in zip(_codec_fields, fields):
+            object.__setattr__(self, name, value)
+
+    def __getattr__(self, name):
+        # Only reached for fields that haven't been set, i.e. before
+        # the entry has been decoded.
+        if name not in _codec_fields:
+            raise AttributeError(f'{type(self).__name__!r} object'
+                                 f' has no attribute {name!r}',
+                                 name=name, obj=self)
+        self._decode()
+        return getattr(self, name)
+
+    def _materialize(self):
+        result = Metadata(frozen=False)
+        for name in _codec_fields:
+            setattr(result, name, getattr(self, name))
+        result._frozen = self._frozen
+        return result
+
+    def thaw(self):
+        getattr(self, 'mode') # decode (if needed) before any changes
+        return super().thaw()
+
+    # Copies are ordinary Metadata instances
+    def __copy__(self):
+        return self._materialize()
+    def __deepcopy__(self, memo):
+        return deepcopy(self._materialize(), memo)
+
+
 def from_path(path, statinfo=None, archive_path=None,
               save_symlinks=True, hardlink_target=None,
               normalized=False, after_stat=None):
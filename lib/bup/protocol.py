@@ -3,7 +3,14 @@ import os, struct
 from binascii import hexlify, unhexlify
 
 from bup import git, vfs, vint
-from bup.helpers import debug1, debug2, linereader, lines_until_sentinel, log
+from bup.config import ConfigError
+from bup.helpers import \
+    (CompressedConn,
+     debug1,
+     debug2,
+     lines_until_sentinel,
+     log,
+     nullcontext_if_not)
 from bup.io import path_msg
 from bup.metadata import Metadata
 from bup.vint import \
@@ -17,12 +24,17 @@ from bup.vfs import Item, Chunky, RevList, Root, Tags, Commit, FakeLink
 
 valid_config_opts = \
     frozenset((b'bup.repo.id',
+               b'bup.server.have-oids',
                b'bup.split.trees',
                b'bup.split.files',
                b'pack.packsizelimit',
                b'core.compression',
                b'pack.compression'))
 
+# The most oids a have-oids request may contain, which bounds the
+# server's memory use.  Client.have_oids() splits larger queries.
+max_have_oids = 256
+
 
 def read_item(port):
     """Read an encoded VFS item from port. Throw EOFError for EOF."""
@@ -176,8 +188,8 @@ class Server:
                  vet_init_dir=None, vet_set_dir=None, vet_update_ref=None):
         """When commands is a sequence of command names (bytes),
         enable those commands.  When it is 'all', enable all commands.
-        The help and quit commands are always enabled, and the
-        init-dir and set-dir commands are also enabled, at least for
+        The help, quit, and compress commands are always enabled, and
+        the init-dir and set-dir commands are also enabled, at least for
         now, because earlier versions of the client unconditionally
         required them during initialization.
 
@@ -194,11 +206,12 @@ class Server:
             # init-dir, set-dir, list-indexes, and send-index were
             # unconditionally required by Client() before 0.34, so
             # always include them for now.
-            self._commands = frozenset((b'help', b'quit',
+            self._commands = frozenset((b'help', b'quit', b'compress',
                                         b'init-dir', b'set-dir',
                                         b'list-indexes', b'send-index',
                                         *commands))
         self.conn = conn
+        self._compressed_conn = None
         self._backend = backend
         self.suspended = False
         self.repo = None
@@ -225,6 +238,27 @@ class Server:
         self.conn.write(b'Commands:\n    %s\n' % b'\n    '.join(sorted(self._commands)))
         self.conn.ok()
 
+    @_command
+    def compress(self, args):
+        """Reply with the zlib compression level determined by
+        bup.server.compress, where 0 means none, and if it's not 0,
+        compress all further traffic in both directions.
+
+        """
+        assert not args
+        if self._compressed_conn:
+            raise Exception('connection is already compressed')
+        self.init_session()
+        level = self.repo.config_get(b'bup.server.compress', opttype='int')
+        level = 0 if level is None else level
+        if not -1 <= level <= 9:
+            raise ConfigError(f'bup.server.compress {level} is not between -1 and 9')
+        self.conn.write(b'%d\n' % level)
+        self.conn.ok()
+        if level:
+            debug1(f'bup server: compressing connection (level {level})\n')
+            self._compressed_conn = self.conn = CompressedConn(self.conn, level)
+
     def init_session(self, repo_dir=None):
         if self.repo:
             if repo_dir:
@@ -341,6 +375,31 @@ class Server:
             self._check(crcr, crc, 'object read: expected crc %d, got %d\n')
         assert False  # should be unreachable
 
+    @_command
+    def have_oids(self, args):
+        """Read a vuint count followed by that many 20-byte oids and
+        reply with a bitmap (bit i of byte i // 8, least significant
+        first) of the oids that exist in the repository.
+
+        """
+        self.init_session()
+        assert not args
+        n = read_vuint(self.conn)
+        if n is None:
+            raise EOFError('EOF while reading have-oids count')
+        if n > max_have_oids:
+            raise Exception(f'have-oids: {n} oids exceeds limit of {max_have_oids}')
+        oids = self.conn.read(n * 20)
+        if len(oids) != n * 20:
+            raise EOFError('EOF while reading have-oids oids')
+        bitmap = bytearray((n + 7) // 8)
+        exists = self.repo.exists
+        for i in range(n):
+            if exists(oids[i * 20 : (i + 1) * 20]):
+                bitmap[i >> 3] |= 1 << (i & 7)
+        self.conn.write(bitmap)
+        self.conn.ok()
+
     @_command
     def read_ref(self, refname):
         self.init_session()
@@ -391,6 +450,24 @@ class Server:
                 self.conn.write(buf)
         self.conn.ok()
 
+    @_command
+    def fetch_tree(self, args):
+        self.init_session()
+        oidx = args.strip()
+        if len(oidx) != 40:
+            raise Exception(f'fetch-tree: invalid object id {oidx!r}')
+        # Read the exclusions before responding to avoid deadlock
+        exclude = frozenset(x[:-1] for x in
+                            lines_until_sentinel(self.conn, b'\n', Exception))
+        for oidx, kind, data in self.repo.fetch_tree(oidx, exclude=exclude):
+            if not kind:
+                self.conn.write(b'%s missing\n' % oidx)
+                continue
+            self.conn.write(b'%s %s %d\n' % (oidx, kind, len(data)))
+            self.conn.write(data)
+        self.conn.write(b'\n')
+        self.conn.ok()
+
     @_command
     def refs(self, args):
         limit_to_heads, limit_to_tags = args.split()
@@ -485,8 +562,11 @@ class Server:
 
         # FIXME: this protocol is totally lame and not at all future-proof.
         # (Especially since we abort completely as soon as *anything* bad happens)
-        lr = linereader(self.conn)
-        for _line in lr:
+        # Read each line from self.conn since compress changes it.
+        while True:
+            _line = self.conn.readline()
+            if not _line:
+                break
             line = _line.strip()
             if not line:
                 continue
@@ -510,9 +590,10 @@ class Server:
         return self
 
     def __exit__(self, type, value, traceback):
-        try:
-            if self.suspended:
-                self.repo.finish_writing()
-        finally:
-            if self.repo:
-                self.repo.close()
+        with nullcontext_if_not(self._compressed_conn):
+            try:
+                if self.suspended:
+                    self.repo.finish_writing()
+            finally:
+                if self.repo:
+                    self.repo.close()
@@ -76,6 +76,29 @@ class RepoProtocol:
 
         """
 
+    @notimplemented
+    def cat_batch(self, refs):
+        """Yield (oidx, type, size, data_iterator) for each of the
+        refs (an iterable), in order, as cat() would, but possibly
+        retrieving the upcoming objects while the current one is being
+        handled.  The iteration must be finished (or abandoned) before
+        calling other repository methods, except that the refs may be
+        produced lazily, and producing them may call cat().
+
+        """
+
+    @notimplemented
+    def fetch_tree(self, oidx, exclude=()):
+        """Yield (oidx, type, data) for oidx (a commit, tree, or blob)
+        and for every object reachable from it, once each, omitting
+        anything only reachable through an oidx in exclude.  Don't
+        follow commit parents.  The type and data will be None for
+        missing objects.  For some repositories (like RemoteRepo), the
+        iteration must be finished before calling other repository
+        methods.
+
+        """
+
     @notimplemented
     def refs(self, patterns=None, limit_to_heads=False, limit_to_tags=False):
         """
@@ -1,10 +1,11 @@
 
 import os
+from binascii import hexlify
 from os.path import realpath
 from functools import partial
 from subprocess import PIPE, Popen
 
-from bup import git, vfs
+from bup import git, vfs, vfsdb
 from bup.config import ConfigError
 from bup.git import LocalPackStore, PackWriter
 from bup.helpers import stopped
@@ -15,9 +16,14 @@ class LocalRepo(RepoProtocol):
     def __init__(self, repo_dir=None, compression_level=None,
                  max_pack_size=None, max_pack_objects=None,
                  allow_duplicates=None, server=False, run_midx=None,
-                 on_pack_finish=None):
+                 on_pack_finish=None, objcache=None, thread_safe=False):
         """When allow_duplicates is false, (at some cost) avoid
         writing duplicates of objects that already in the repository.
+        See LocalPackStore for objcache.  When thread_safe is true,
+        the repository may be read (e.g. via cat()) by multiple
+        threads at once.  When bup.vfs.persistent-cache is true, the
+        vfs_db will be a vfsdb.VfsDb for the repository (otherwise
+        None).
 
         """
         # allow_duplicates instead of deduplicate_writes so None can
@@ -27,11 +33,20 @@ class LocalRepo(RepoProtocol):
         self._base = _make_base(self.config_get, compression_level,
                                 max_pack_size, max_pack_objects)
         self._on_pack_finish = on_pack_finish
+        self._objcache = objcache
         self._packwriter = None
         self.write_symlink = self.write_data
         self.write_bupm = self.write_data
-        self._cp = git.catpipe(self.repo_dir)
+        if thread_safe:
+            self._cp = git.CatPipePool(self.repo_dir)
+        else:
+            self._cp = git.catpipe(self.repo_dir)
+        self._own_cp = thread_safe
+        self._batch_cp = None # see cat_batch()
         self.rev_list = partial(git.rev_list, repo_dir=self.repo_dir)
+        self.vfs_db = None
+        if self.config_get(b'bup.vfs.persistent-cache', opttype='bool'):
+            self.vfs_db = vfsdb.open_for_repo(self.repo_dir)
 
         if server:
             # Ensure srv_dedup and allow_duplicates agree if server is true
@@ -62,7 +77,15 @@ class LocalRepo(RepoProtocol):
     def close(self):
         if not self.closed:
             self.closed = True
-            self.finish_writing()
+            try:
+                self.finish_writing()
+            finally:
+                if self.vfs_db:
+                    self.vfs_db.close()
+                if self._own_cp:
+                    self._cp.close(wait=True)
+                if self._batch_cp:
+                    self._batch_cp.close(wait=True)
 
     def __del__(self): assert self.closed
     def __enter__(self): return self
@@ -98,7 +121,8 @@ class LocalRepo(RepoProtocol):
         if not self._packwriter:
             store = LocalPackStore(repo_dir=self.repo_dir,
                                    on_pack_finish=self._on_pack_finish,
-                                   run_midx=self.run_midx)
+                                   run_midx=self.run_midx,
+                                   objcache=self._objcache)
             writer = PackWriter(store=store,
                                 compression_level=self._base.compression_level,
                                 max_pack_size=self._base.max_pack_size,
@@ -112,6 +136,24 @@ class LocalRepo(RepoProtocol):
     def cat(self, ref):
         return self._cp.get(ref)
 
+    def cat_batch(self, refs):
+        cp = self._cp
+        if not self._own_cp:
+            # Use a separate pipe so that the refs iterator can call
+            # cat() (the pool provides one per request).
+            if not self._batch_cp:
+                self._batch_cp = git.CatPipe(self.repo_dir)
+            cp = self._batch_cp
+        for oidx, typ, size, data in cp.get_many(refs):
+            yield oidx, typ, size, None if data is None else iter((data,))
+
+    def fetch_tree(self, oidx, exclude=()):
+        for item in git.walk_tree_objects(self._cp.get, oidx, exclude=exclude):
+            if item.data is False:
+                yield hexlify(item.oid), None, None
+            else:
+                yield hexlify(item.oid), item.type, item.data
+
     def join(self, ref):
         return vfs.join(self, ref)
 
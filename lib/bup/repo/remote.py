@@ -1,5 +1,7 @@
 
 from binascii import hexlify
+from functools import wraps
+from itertools import islice
 import re
 
 from bup import client, git
@@ -9,6 +11,57 @@ from bup.repo.base import _make_base, RepoProtocol
 
 _oidx_rx = re.compile(br'[0-9a-fA-F]{40}')
 
+# The most prefetched data RemoteRepo will hold before the objects
+# are requested (see prefetch()).
+_max_prefetch_ahead = 64 * 1024 * 1024
+
+class _ObjectStream:
+    """The objects from a RemoteRepo fetch_tree() iterator, retrieved
+    as they're requested.  Objects the stream provides before they're
+    requested are held (up to max_ahead bytes of them) until they are.
+
+    """
+    def __init__(self, objects, max_ahead):
+        self._objects = objects # None once exhausted
+        self._ahead = {} # oidx -> (kind, data)
+        self._ahead_bytes = 0
+        self._max_ahead = max_ahead
+    def active(self):
+        return self._objects is not None
+    def finish(self):
+        """Discard the rest of the stream so that other requests can
+        be made (objects that have already arrived are kept)."""
+        if self._objects is not None:
+            objects, self._objects = self._objects, None
+            for _ in objects: pass
+    def get(self, oidx):
+        """Return the cat() result for oidx if the stream provides it,
+        otherwise None.  Finish the stream if the search would exceed
+        max_ahead, or if the stream ends."""
+        found = self._ahead.pop(oidx, None)
+        if found:
+            kind, data = found
+            self._ahead_bytes -= len(data)
+            return oidx, kind, len(data), iter((data,))
+        while self._objects is not None:
+            obj = next(self._objects, None)
+            if obj is None:
+                self._objects = None
+                break
+            obj_oidx, kind, data = obj
+            if not kind: # missing; let cat() report it
+                continue
+            if obj_oidx == oidx:
+                return oidx, kind, len(data), iter((data,))
+            if obj_oidx in self._ahead:
+                continue
+            if self._ahead_bytes + len(data) > self._max_ahead:
+                self.finish()
+                break
+            self._ahead[obj_oidx] = kind, data
+            self._ahead_bytes += len(data)
+        return None
+
 class RemoteRepo(RepoProtocol):
     def __init__(self, location, create=False, compression_level=None,
                  max_pack_size=None, max_pack_objects=None):
@@ -26,14 +79,23 @@ class RemoteRepo(RepoProtocol):
                                 max_pack_size, max_pack_objects)
         self.write_symlink = self.write_data
         self.write_bupm = self.write_data
-        self.rev_list = self.client.rev_list
-        self.list_indexes = self.client.list_indexes
-        self.read_ref = self.client.read_ref
-        self.send_index = self.client.send_index
-        self.join = self.client.join
-        self.refs = self.client.refs
-        self.resolve = self.client.resolve
         self._packwriter = None
+        self._prefetched = None
+        # Any prefetch stream must be finished before other requests
+        def after_prefetch(method):
+            @wraps(method)
+            def call(*args, **kwargs):
+                self._finish_prefetch()
+                return method(*args, **kwargs)
+            return call
+        self.config_get = after_prefetch(self.config_get)
+        self.rev_list = after_prefetch(self.client.rev_list)
+        self.list_indexes = after_prefetch(self.client.list_indexes)
+        self.read_ref = after_prefetch(self.client.read_ref)
+        self.send_index = after_prefetch(self.client.send_index)
+        self.join = after_prefetch(self.client.join)
+        self.refs = after_prefetch(self.client.refs)
+        self.resolve = after_prefetch(self.client.resolve)
 
     def __repr__(self):
         cls = self.__class__
@@ -43,6 +105,7 @@ class RemoteRepo(RepoProtocol):
     def close(self):
         if not self.closed:
             self.closed = True
+            self.clear_prefetched()
             self.finish_writing()
             if self.client:
                 self.client.close()
@@ -64,10 +127,12 @@ class RemoteRepo(RepoProtocol):
             raise PermissionError(f'remote access to {name} is not allowed')
 
     def update_ref(self, refname, newval, oldval):
+        self._finish_prefetch()
         self.finish_writing()
         return self.client.update_ref(refname, newval, oldval)
 
     def _ensure_packwriter(self):
+        self._finish_prefetch()
         if not self._packwriter:
             self._packwriter = self.client.new_packwriter(
                                     compression_level=self._base.compression_level,
@@ -76,7 +141,20 @@ class RemoteRepo(RepoProtocol):
 
     def is_remote(self): return True
 
+    def _finish_prefetch(self):
+        if self._prefetched:
+            self._prefetched.finish()
+
+    def _from_prefetch(self, ref):
+        if self._prefetched and _oidx_rx.fullmatch(ref):
+            return self._prefetched.get(ref)
+        return None
+
     def cat(self, ref):
+        found = self._from_prefetch(ref)
+        if found:
+            return found
+        self._finish_prefetch()
         # The data iterator must be consumed before any other client
         # interactions.  If the ref is 40 hex digits, then assume it's
         # an oid, and verify that the data provided by the remote
@@ -100,6 +178,73 @@ class RemoteRepo(RepoProtocol):
             return items
         return *items[:-1], hash_checked_data(typ, size, it, ref, batch)
 
+    def cat_batch(self, refs, window=64):
+        # Request the objects in groups, each read in full, so that
+        # nothing's pending when the caller has control.
+        refs = iter(refs)
+        while True:
+            group = tuple(islice(refs, window))
+            if not group:
+                break
+            results = [self._from_prefetch(ref) for ref in group]
+            needed = [ref for ref, res in zip(group, results) if not res]
+            if needed:
+                self._finish_prefetch()
+                fetched = iter(self.client.cat_batch(needed))
+                for i, ref in enumerate(group):
+                    if results[i]:
+                        continue
+                    oidx, typ, size, it = next(fetched)
+                    if not oidx:
+                        results[i] = None, None, None, None
+                        continue
+                    data = b''.join(it)
+                    if _oidx_rx.fullmatch(ref):
+                        actual_oid = git.calc_hash(typ, data)
+                        if hexlify(actual_oid) != ref:
+                            raise Exception(f'received {actual_oid.hex()}, expected oid {ref}')
+                    results[i] = oidx, typ, size, iter((data,))
+                assert next(fetched, None) is None
+            yield from results
+
+    def fetch_tree(self, oidx, exclude=()):
+        self._finish_prefetch()
+        yield from self._fetch_tree(oidx, exclude)
+
+    def _fetch_tree(self, oidx, exclude=()):
+        for oidx, kind, data in self.client.fetch_tree(oidx, exclude):
+            if kind:
+                actual_oid = git.calc_hash(kind, data)
+                if hexlify(actual_oid) != oidx:
+                    raise Exception(f'received {actual_oid.hex()}, expected oid {oidx}')
+            yield oidx, kind, data
+
+    def prefetch(self, oidx):
+        """Request oidx and everything reachable from it (see
+        fetch_tree) via a single request, replacing any previous
+        prefetch, so that cat() and cat_batch() can provide the
+        objects without a round trip as they arrive.  Since the
+        objects arrive in tree order, they can be consumed while the
+        rest are still being transferred.  Only a bounded amount of
+        data that arrives before it's requested is retained; anything
+        beyond that, or any other request, finishes (discards the rest
+        of) the transfer, and later requests fall back to cat.  Return
+        false if the remote doesn't support this.
+
+        """
+        if not self.client.supports(b'fetch-tree'):
+            return False
+        self.clear_prefetched()
+        self._prefetched = _ObjectStream(self._fetch_tree(oidx),
+                                         _max_prefetch_ahead)
+        return True
+
+    def clear_prefetched(self):
+        """Discard any objects retrieved by prefetch()."""
+        if self._prefetched:
+            self._prefetched.finish()
+            self._prefetched = None
+
     def write_commit(self, tree, parent,
                      author, adate_sec, adate_tz,
                      committer, cdate_sec, cdate_tz,
@@ -128,6 +273,7 @@ class RemoteRepo(RepoProtocol):
 
     def finish_writing(self):
         if self._packwriter:
+            self._finish_prefetch()
             w = self._packwriter
             self._packwriter = None
             return w.close()
@@ -135,4 +281,5 @@ class RemoteRepo(RepoProtocol):
 
     def abort_writing(self):
         if self._packwriter:
+            self._finish_prefetch()
             self._packwriter.abort()
@@ -3,37 +3,61 @@ from binascii import hexlify, unhexlify
 
 from bup import git, vfs
 from bup.client import ClientError
-from bup.git import LocalPackStore, PackWriter, get_commit_items
+from bup.commit import parse_commit
+from bup.git import GitError, LocalPackStore, PackWriter
 from bup.helpers import add_error, die_if_errors, log, saved_errors
 from bup.io import path_msg
 
-def append_commit(hash, parent, cp, writer):
-    ci = get_commit_items(hash, cp.get)
-    tree = unhexlify(ci.tree)
+def _append_commit_info(ci, parent, writer):
     author = b'%s <%s>' % (ci.author_name, ci.author_mail)
     committer = b'%s <%s>' % (ci.committer_name, ci.committer_mail)
-    c = writer.new_commit(tree, parent,
-                          author, ci.author_sec, ci.author_offset,
-                          committer, ci.committer_sec, ci.committer_offset,
-                          ci.message)
-    return c, tree
+    return writer.new_commit(unhexlify(ci.tree), parent,
+                             author, ci.author_sec, ci.author_offset,
+                             committer, ci.committer_sec, ci.committer_offset,
+                             ci.message)
+
+
+def _rewrite_suffix(tip_commit_hex, exclude):
+    """Return (base, commits) where commits is the oldest first list
+    of the commits in the (first parent) history of the tip that
+    must be rewritten to drop the exclude commits, and base is the
+    newest commit that can be retained as is, or None."""
+    remaining = set(exclude)
+    suffix = []
+    base = None
+    # Stop reading the history at the first commit older than all of
+    # the exclusions, i.e. typically only read the newest handful of
+    # a long history.
+    revs = git.rev_list(tip_commit_hex)
+    try:
+        for oidx in revs:
+            oid = unhexlify(oidx)
+            if not remaining:
+                base = oid
+                break
+            remaining.discard(oid)
+            suffix.append(oid)
+    finally:
+        revs.close()
+    if remaining:
+        raise GitError(f'{len(remaining)} commit(s) to remove are not in'
+                       f' the history of {tip_commit_hex.decode("ascii")}')
+    suffix.reverse()
+    return base, suffix
 
 
 def filter_branch(tip_commit_hex, exclude, writer):
-    # May return None if everything is excluded.
-    commits = [unhexlify(x) for x in git.rev_list(tip_commit_hex)]
-    commits.reverse()
-    last_c = None
-    # Rather than assert that we always find an exclusion here, we'll
-    # just let the StopIteration signal the error.
-    first_exclusion = next(i for i, c in enumerate(commits) if exclude(c))
-    if first_exclusion != 0:
-        last_c = commits[first_exclusion - 1]
-        commits = commits[first_exclusion:]
-    for c in commits:
-        if exclude(c):
-            continue
-        last_c, _ = append_commit(hexlify(c), last_c, git.catpipe(), writer)
+    """Write the history of the tip without the exclude commits (a
+    set of oids) via the writer, and return the new tip, or None if
+    everything was excluded.  Read all of the commits that must be
+    rewritten in one batch, rather than one at a time."""
+    last_c, commits = _rewrite_suffix(tip_commit_hex, exclude)
+    keep = [c for c in commits if c not in exclude]
+    cat = git.catpipe()
+    for c, (_, kind, _, data) in zip(keep, cat.get_many(hexlify(c) for c in keep)):
+        if kind != b'commit':
+            raise GitError(f'{c.hex()} is not a commit ({kind!r})')
+        last_c = _append_commit_info(parse_commit(data), last_c, writer)
     return last_c
 
 def commit_oid(item):
@@ -49,9 +73,7 @@ def rm_saves(saves, writer):
         assert(branch == first_branch_item)
     rm_commits = frozenset([commit_oid(save) for save, branch in saves])
     orig_tip = commit_oid(first_branch_item)
-    new_tip = filter_branch(hexlify(orig_tip),
-                            lambda x: x in rm_commits,
-                            writer)
+    new_tip = filter_branch(hexlify(orig_tip), rm_commits, writer)
     assert(orig_tip)
     assert(new_tip != orig_tip)
     return orig_tip, new_tip
@@ -119,6 +141,38 @@ def bup_rm(repo, paths, compression=6, verbosity=None):
         finally:
             writer.close()
 
+    _update_refs(updated_refs, verbosity)
+
+
+def rm_commits(removals, compression=6, verbosity=None):
+    """Remove commits from branches, where removals maps each branch
+    name to (tip oid, set of commit oids to remove).  Like bup_rm(),
+    but for callers that already know the commits, e.g. prune-older,
+    so there's no need to resolve the saves via the VFS.  All of the
+    new commits are written to a single pack, and the refs are only
+    updated at the end, once each."""
+    updated_refs = {}  # ref_name -> (original_ref, tip_commit(bin))
+    writer = None
+    try:
+        for branch, (tip, dead) in removals.items():
+            assert dead
+            if not writer:
+                writer = PackWriter(store=LocalPackStore(),
+                                    compression_level=compression)
+            new_tip = filter_branch(hexlify(tip), dead, writer)
+            assert new_tip != tip
+            updated_refs[b'refs/heads/' + branch] = tip, new_tip
+    except BaseException as ex:
+        if writer:
+            writer.abort()
+        raise ex
+    finally:
+        if writer:
+            writer.close()
+    _update_refs(updated_refs, verbosity)
+
+
+def _update_refs(updated_refs, verbosity):
     # Only update the refs here, at the very end, so that if something
     # goes wrong above, the old refs will be undisturbed.  Make an attempt
     # to update each ref.
@@ -13,7 +13,9 @@ Each path is represented by an item that has least an item.meta which
 may be either a Metadata object, or an integer mode.  Functions like
 item_mode() and item_size() will return the mode and size in either
 case.  Metadata instances must not be modified directly.  Make a copy
-to modify via deepcopy() if needed, or call copy_item().
+to modify via deepcopy() if needed, or call copy_item().  The metadata
+for tree entries will usually be LazyMetadata instances, which aren't
+decoded until one of their fields is needed.
 
 The want_meta argument is advisory for calls that accept it, and it
 may not be honored.  Callers must be able to handle an item.meta value
@@ -68,12 +70,15 @@ item.coid.
 
 """
 
+from array import array
 from binascii import hexlify, unhexlify
-from collections import namedtuple
+from bisect import bisect_right
+from collections import OrderedDict, deque, namedtuple
 from copy import deepcopy
+from io import BytesIO
 from errno import EINVAL, ELOOP, ENOTDIR
 from itertools import tee
-from random import randrange
+from threading import Lock
 from stat import \
     (S_IFDIR,
      S_IFLNK,
@@ -100,13 +105,12 @@ from bup.git import \
      MissingObject,
      GitError,
      find_tree_entry,
-     last_tree_entry,
      parse_commit,
      tree_entries,
      tree_iter)
-from bup.helpers import EXIT_FAILURE, debug2
+from bup.helpers import EXIT_FAILURE, debug1, debug2
 from bup.io import path_msg
-from bup.metadata import Metadata, empty_metadata
+from bup.metadata import LazyMetadata, Metadata, encoded_entries
 
 
 # We currently assume that it's always appropriate to just forward IOErrors
@@ -162,86 +166,103 @@ def get_oidx(repo, oidx, *, throw_missing=True):
         raise MissingObject(unhexlify(oidx))
     return result
 
-def _normal_or_chunked_file_size(repo, oid):
-    """Return the size of the normal or chunked file indicated by oid."""
-    # FIXME: --batch-format CatPipe?
+class _ChunkIndex:
+    """The parsed entries of one level of a chunked file's tree, i.e.
+    the ascending offsets of the entries relative to the start of the
+    tree, their oids, and whether or not each one is a subtree.
+
+    """
+    __slots__ = 'ofs', 'oids', 'trees', 'size'
+    def __init__(self, tree_data):
+        self.ofs = array('Q')
+        self.oids = []
+        trees = bytearray()
+        # name is the chunk's hex offset in the original file
+        for mode, name, oid in tree_entries(tree_data):
+            self.ofs.append(int(name, 16))
+            self.oids.append(oid)
+            trees.append(S_ISDIR(mode))
+        self.trees = bytes(trees)
+        self.size = None # of all the data in the tree, once known
+    def find(self, ofs):
+        """Return the index of the entry that contains ofs."""
+        return max(0, bisect_right(self.ofs, ofs) - 1)
+
+def _persistent_cache(repo):
+    """Return the repo's vfsdb.VfsDb, if it has one, otherwise None."""
+    return getattr(repo, 'vfs_db', None)
+
+def _chunk_node(repo, oid, is_tree=None):
+    """Return a (possibly cached) _ChunkIndex if oid is a tree, or the
+    blob data otherwise.  If is_tree is not None, it indicates which
+    one oid is known to be.
+
+    """
+    if is_tree is not False:
+        index = cache_get(b'cix:' + oid)
+        if index is not None:
+            return index
+    if is_tree is not True:
+        data = cache_get(b'blb:' + oid)
+        if data is not None:
+            return data
     _, obj_t, _, it = get_oidx(repo, hexlify(oid))
-    ofs = 0
-    while obj_t == b'tree':
-        mode_, name, last_oid = last_tree_entry(b''.join(it))
-        ofs += int(name, 16)
-        _, obj_t, _, it = get_oidx(repo, hexlify(last_oid))
-    return ofs + sum(len(b) for b in it)
-
-def _skip_chunks_before_offset(tree_data, offset):
-    entries = tree_entries(tree_data)
-    for i, entry in enumerate(entries):
-        ent_ofs = int(entry[1], 16)
-        if ent_ofs > offset:
-            return entries[i - 1:]
-        if ent_ofs == offset:
-            return entries[i:]
-    return entries[-1:]
-
-def _tree_chunks(repo, tree_data, startofs):
-    assert(startofs >= 0)
-    # name is the chunk's hex offset in the original file
-    for mode, name, oid in _skip_chunks_before_offset(tree_data, startofs):
-        ofs = int(name, 16)
-        skipmore = max(0, startofs - ofs)
-        _, obj_t, _, it = get_oidx(repo, hexlify(oid))
-        data = b''.join(it)
-        if S_ISDIR(mode):
-            assert obj_t == b'tree'
-            yield from _tree_chunks(repo, data, skipmore)
-        else:
-            assert obj_t == b'blob'
-            yield data[skipmore:]
+    data = b''.join(it)
+    if obj_t == b'tree':
+        index = _ChunkIndex(data)
+        cache_notice(b'cix:' + oid, index)
+        return index
+    assert obj_t == b'blob'
+    cache_notice(b'blb:' + oid, data)
+    return data
 
-class _ChunkReader:
-    def __init__(self, repo, oid, startofs):
-        _, obj_t, _, it = get_oidx(repo, hexlify(oid))
-        data = b''.join(it)
-        if obj_t == b'tree':
-            self.it = _tree_chunks(repo, data, startofs)
-            self.blob = None
-            self.blobofs = None
+def _chunk_containing(repo, node, ofs):
+    """Return (data, data_ofs) for the blob containing ofs within the
+    normal or chunked file whose top _chunk_node() is node, or for
+    the last blob if ofs is at or past the end of the file.  The
+    data_ofs is the offset of the blob within the file.
+
+    """
+    data_ofs = 0
+    while isinstance(node, _ChunkIndex):
+        i = node.find(ofs - data_ofs)
+        data_ofs += node.ofs[i]
+        node = _chunk_node(repo, node.oids[i], bool(node.trees[i]))
+    return node, data_ofs
+
+def _chunk_node_size(repo, node):
+    if not isinstance(node, _ChunkIndex):
+        return len(node)
+    if node.size is None:
+        last = _chunk_node(repo, node.oids[-1], bool(node.trees[-1]))
+        node.size = node.ofs[-1] + _chunk_node_size(repo, last)
+    return node.size
+
+def _normal_or_chunked_file_size(repo, oid):
+    """Return the size of the normal or chunked file indicated by oid."""
+    key = b'siz:' + oid
+    size = cache_get(key)
+    if size is not None:
+        return size
+    db = _persistent_cache(repo)
+    size = db.file_size(oid) if db else None
+    if size is None:
+        node = _chunk_node(repo, oid)
+        size = _chunk_node_size(repo, node)
+        if db and isinstance(node, _ChunkIndex):
+            db.add_file_size(oid, size)
+    cache_notice(key, size)
+    return size
+
+def _chunked_file_blob_oids(repo, index):
+    """Yield the oids of all the blobs in the chunked file tree index,
+    in order, reading the subtrees as they're reached."""
+    for oid, is_tree in zip(index.oids, index.trees):
+        if is_tree:
+            yield from _chunked_file_blob_oids(repo,
+                                               _chunk_node(repo, oid, True))
         else:
-            self.it = None
-            self.blob = data
-            self.blobofs = startofs
-        self.ofs = startofs
-
-    def next(self, size): # size=-1 means all data
-        assert size >= -1, size
-        out_parts = []
-        out_len = 0
-        while size == -1 or out_len < size:
-            if self.it and not self.blob:
-                self.blob = next(self.it, None)
-                if self.blob is None:
-                    self.it = None
-                else:
-                    self.blobofs = 0
-            if self.blob:
-                want = size - out_len if size != -1 \
-                    else len(self.blob) - self.blobofs
-                if self.blobofs == 0 and want >= len(self.blob):
-                    out_parts.append(self.blob)
-                    self.blob = self.blobofs = None
-                else:
-                    out_parts.append(self.blob[self.blobofs:self.blobofs + want])
-                    self.blobofs += want
-                    if self.blobofs >= len(self.blob):
-                        self.blob = self.blobofs = None
-                out_len += len(out_parts[-1])
-            if not self.it:
-                break
-        debug2(f'next({size}) returned {out_len}\n')
-        self.ofs += out_len
-        if len(out_parts) == 1:
-            return out_parts[0]
-        return b''.join(out_parts)
+            yield oid
 
 class _FileReader:
     def __init__(self, repo, oid):
@@ -249,13 +270,19 @@ class _FileReader:
         self.closed = False
         self.oid = oid
         self.ofs = 0
-        self.reader = None
         self._repo = repo
         self._size = None
+        self._is_tree = None
+        self._chunk = None # the most recently read (data, data_ofs)
+
+    def _node(self):
+        node = _chunk_node(self._repo, self.oid, self._is_tree)
+        self._is_tree = isinstance(node, _ChunkIndex)
+        return node
 
     def _require_size(self):
         if self._size is None:
-            self._size = _normal_or_chunked_file_size(self._repo, self.oid)
+            self._size = _chunk_node_size(self._repo, self._node())
         return self._size
 
     def seek(self, ofs):
@@ -269,22 +296,33 @@ class _FileReader:
         return self.ofs
 
     def read(self, count=-1):
+        assert count >= -1, count
         if self._size is not None:
             if self.ofs == self._size:
                 return b''
             assert self.ofs < self._size, f'{self.ofs} > {self._size}'
-        if not self.reader or self.reader.ofs != self.ofs:
-            self.reader = _ChunkReader(self._repo, self.oid, self.ofs)
-        try:
-            buf = self.reader.next(count)
-        except:
-            self.reader = None
-            raise  # our offsets will be all screwed up otherwise
-        if not buf:
-            self._size = self.ofs
-        else:
-            self.ofs += len(buf)
-        return buf
+        parts = []
+        remaining = count
+        while remaining:
+            chunk = self._chunk
+            if not chunk or not 0 <= self.ofs - chunk[1] < len(chunk[0]):
+                chunk = _chunk_containing(self._repo, self._node(), self.ofs)
+                self._chunk = chunk
+            data, data_ofs = chunk
+            start = self.ofs - data_ofs
+            end = len(data)
+            if remaining > 0:
+                end = min(end, start + remaining)
+                remaining -= max(0, end - start)
+            if start >= end:
+                self._size = self.ofs
+                break
+            parts.append(data[start:end])
+            self.ofs += end - start
+        debug2(f'read({count}) returned {sum(len(x) for x in parts)}\n')
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
 
     def close(self):
         self.closed = True
@@ -338,19 +376,88 @@ _tags = Tags(meta=default_dir_mode)
 
 ### vfs cache
 
-### A general purpose shared cache with (currently) cheap random
-### eviction.  At the moment there is no weighting so a single commit
-### item is just as likely to be evicted as an entire "rev-list".  See
-### is_valid_cache_key for a description of the expected content.
-
-_cache = {}
-_cache_keys = []
-_cache_max_items = 30000
+### A general purpose shared cache with a separate least recently
+### used (LRU) list for each kind of entry (key prefix), each limited
+### to an estimated number of bytes.  See is_valid_cache_key for a
+### description of the expected content, set_cache_limits to adjust
+### the sizes, and cache_stats for the hit, miss, and eviction counts.
+
+class _CacheKind:
+    __slots__ = 'entries', 'size', 'limit', 'hits', 'misses', 'evictions'
+    def __init__(self, limit):
+        self.entries = OrderedDict() # key -> (value, size)
+        self.size = 0
+        self.limit = limit
+        self.hits = self.misses = self.evictions = 0
+    def evict(self):
+        while self.size > self.limit:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+_cache_default_limits = {b'itm:': 8 << 20, # commits
+                         b'rvl:': 16 << 20, # rev-lists
+                         b'res:': 16 << 20, # resolutions
+                         b'tre:': 24 << 20, # tree data
+                         b'cix:': 8 << 20, # chunked file indexes
+                         b'blb:': 8 << 20, # file blobs
+                         b'siz:': 2 << 20} # file sizes
+_cache = {k: _CacheKind(v) for k, v in _cache_default_limits.items()}
+_cache_lock = Lock() # for (e.g. bup daemon) threads
 
 def clear_cache():
-    global _cache, _cache_keys
-    _cache = {}
-    _cache_keys = []
+    """Drop all of the cache entries (but not the counters)."""
+    with _cache_lock:
+        for kind in _cache.values():
+            kind.entries.clear()
+            kind.size = 0
+
+def set_cache_limits(total=None, **limits):
+    """Set the (estimated) maximum number of bytes the cache may use.
+    When total is specified, divide it among the kinds of entries in
+    proportion to their default limits, and then apply any limits
+    for specific kinds, e.g. set_cache_limits(rvl=1 << 20).  The
+    kinds are itm (commits), rvl (rev-lists), res (resolutions), tre
+    (tree data), cix (chunked file indexes), blb (file blobs), and
+    siz (file sizes).
+
+    """
+    new = {}
+    if total is not None:
+        default_total = sum(_cache_default_limits.values())
+        for prefix, limit in _cache_default_limits.items():
+            new[prefix] = total * limit // default_total
+    for name, limit in limits.items():
+        prefix = name.encode('ascii') + b':'
+        if prefix not in _cache:
+            raise ValueError(f'unknown vfs cache kind {name!r}')
+        new[prefix] = limit
+    with _cache_lock:
+        for prefix, limit in new.items():
+            kind = _cache[prefix]
+            kind.limit = limit
+            kind.evict()
+
+def cache_stats():
+    """Return a dict mapping each kind of cache entry (itm, rvl, res,
+    tre, cix, blb, and siz) to a dict of its current entries, bytes (estimated),
+    limit, hits, misses, and evictions."""
+    with _cache_lock:
+        return {prefix[:-1].decode('ascii'):
+                dict(entries=len(kind.entries), bytes=kind.size,
+                     limit=kind.limit, hits=kind.hits, misses=kind.misses,
+                     evictions=kind.evictions)
+                for prefix, kind in _cache.items()}
+
+def log_cache_stats():
+    """Describe the cache_stats() via debug1()."""
+    for name, st in cache_stats().items():
+        lookups = st['hits'] + st['misses']
+        rate = (100 * st['hits'] / lookups) if lookups else 0
+        debug1(f'vfs cache {name}: {st["entries"]} entries,'
+               f' {st["bytes"]}/{st["limit"]} bytes,'
+               f' {st["hits"]} hits, {st["misses"]} misses ({rate:.1f}% hits),'
+               f' {st["evictions"]} evictions\n')
 
 def is_valid_cache_key(x):
     """Return logically true if x looks like it could be a valid cache key
@@ -358,39 +465,67 @@ def is_valid_cache_key(x):
       res:... -> resolution
       itm:OID -> Commit
       rvl:OID -> {'.', commit, '2012...', next_commit, ...}
+      tre:OID -> tree data (for a tree, or the tree of a commit)
+      cix:OID -> _ChunkIndex (for a chunked file tree)
+      blb:OID -> blob data
+      siz:OID -> size of the normal or chunked file
     """
     # Suspect we may eventually add "(container_oid, name) -> ...", and others.
     if isinstance(x, bytes):
         tag = x[:4]
-        if tag in (b'itm:', b'rvl:') and len(x) == 24:
+        if tag in (b'itm:', b'rvl:', b'tre:', b'cix:', b'blb:', b'siz:') \
+           and len(x) == 24:
             return True
         if tag == b'res:':
             return True
     return False
 
+def _cache_entry_size(key, value):
+    """Return a rough estimate of the memory used by the entry."""
+    overhead = 256 # very approximately, a Commit or Item, with Metadata
+    tag = key[:4]
+    if tag in (b'tre:', b'blb:'):
+        return len(key) + len(value) + 64
+    if tag == b'cix:': # offset, oid bytes object, list slot, and flag
+        return len(key) + 64 + len(value.oids) * (8 + 53 + 8 + 1)
+    if tag == b'rvl:': # names are mostly YYYY-MM-DD-hhmmss
+        return len(key) + len(value) * (overhead + 64)
+    if tag == b'res:':
+        return len(key) + sum(len(name) + overhead for name, _ in value)
+    if tag == b'siz:':
+        return len(key) + 64
+    return len(key) + overhead
+
 def cache_get(key):
-    global _cache
     if not is_valid_cache_key(key):
         raise Exception('invalid cache key: ' + repr(key))
-    return _cache.get(key)
+    with _cache_lock:
+        kind = _cache[key[:4]]
+        entry = kind.entries.get(key)
+        if entry is None:
+            kind.misses += 1
+            return None
+        kind.hits += 1
+        kind.entries.move_to_end(key)
+        return entry[0]
 
 def cache_notice(key, value, overwrite=False):
-    global _cache, _cache_keys, _cache_max_items
     if not is_valid_cache_key(key):
         raise Exception('invalid cache key: ' + repr(key))
-    if key in _cache:
-        if overwrite:
-            _cache[key] = value
-        return
-    if len(_cache) < _cache_max_items:
-        _cache_keys.append(key)
-        _cache[key] = value
-        return
-    victim_i = randrange(0, len(_cache_keys))
-    victim = _cache_keys[victim_i]
-    del _cache[victim]
-    _cache_keys[victim_i] = key
-    _cache[key] = value
+    size = _cache_entry_size(key, value)
+    with _cache_lock:
+        kind = _cache[key[:4]]
+        prev = kind.entries.get(key)
+        if prev is not None:
+            if not overwrite:
+                return
+            kind.size -= prev[1]
+            del kind.entries[key]
+        if size > kind.limit:
+            return
+        kind.entries[key] = value, size
+        kind.size += size
+        kind.evict()
 
 def _has_metadata_if_needed(item, need_meta):
     if not need_meta:
@@ -447,6 +582,10 @@ def _read_dir_meta(bupm):
 
 def _treeish_tree_data(repo, oid):
     assert len(oid) == 20
+    cache_key = b'tre:' + oid
+    data = cache_get(cache_key)
+    if data is not None:
+        return data
     _, item_t, _, it = get_oidx(repo, hexlify(oid))
     data = b''.join(it)
     if item_t == b'commit':
@@ -456,6 +595,7 @@ def _treeish_tree_data(repo, oid):
         assert item_t == b'tree'
     elif item_t != b'tree':
         raise Exception('%s is not a tree or commit' % oid.hex())
+    cache_notice(cache_key, data)
     return data
 
 def tree_data_and_bupm(repo, oid):
@@ -476,11 +616,17 @@ def _find_treeish_oid_metadata(repo, oid):
     has no metadata (i.e. older bup save, or non-bup tree).
 
     """
+    meta = _remembered_dir_meta(repo, oid)
+    if meta is not None:
+        return meta if isinstance(meta, Metadata) else None
     bupm_ent = find_tree_entry(b'.bupm', _treeish_tree_data(repo, oid))
     if bupm_ent:
         with _FileReader(repo, bupm_ent[2]) as meta_stream:
-            return _read_dir_meta(meta_stream)
-    return None
+            meta = _read_dir_meta(meta_stream)
+    else:
+        meta = None
+    _remember_dir_meta(repo, oid, meta or default_dir_mode)
+    return meta
 
 def _readlink(repo, oid):
     # symlink blobs are never split
@@ -534,6 +680,42 @@ def fopen(repo, item):
     assert S_ISREG(item_mode(item))
     return tree_data_reader(repo, item.oid)
 
+def file_blob_oids(repo, item):
+    """Yield the oids of the blobs that contain the data in the given
+    file item, in order."""
+    assert S_ISREG(item_mode(item))
+    if not isinstance(item, Chunky):
+        yield item.oid
+        return
+    yield from _chunked_file_blob_oids(repo,
+                                       _chunk_node(repo, item.oid, True))
+
+def file_chunks(repo, item):
+    """Yield all of the data in the given file item, chunk by chunk.
+    Retrieve the upcoming chunks (via repo.cat_batch()) while the
+    caller is handling the current one, walking the file's tree as
+    the requests are made, so that only a bounded number of them are
+    outstanding at any one time.  The caller must not call other repo
+    methods until the iteration is finished.
+
+    """
+    assert S_ISREG(item_mode(item))
+    node = _chunk_node(repo, item.oid)
+    if not isinstance(node, _ChunkIndex):
+        yield node
+        return
+    requested = deque()
+    def refs():
+        for oid in _chunked_file_blob_oids(repo, node):
+            requested.append(oid)
+            yield hexlify(oid)
+    for oidx, obj_t, _, it in repo.cat_batch(refs()):
+        oid = requested.popleft()
+        if not oidx:
+            raise MissingObject(oid)
+        assert obj_t == b'blob'
+        yield from it
+
 def _commit_item_from_data(oid, data):
     info = parse_commit(data)
     return Commit(meta=default_dir_mode,
@@ -649,11 +831,9 @@ def _validated_meta_ents(oid, tree_ents, bupm, repair):
     # (before 0.31) might rarely drop a bupm entry, so check.
     if not bupm:
         return None
-    meta_entries = []
-    m = Metadata.read(bupm)
-    while m:
-        meta_entries.append(None if m is empty_metadata else m)
-        m = Metadata.read(bupm)
+    # Each entry is only decoded if something asks for its fields
+    meta_entries = [None if x == b'\0' else LazyMetadata(x)
+                    for x in encoded_entries(bupm.read())]
     exp_meta_n = 0
     for ent in tree_ents:
         if ent[1] != b'.bupm' and (ent[2] == BUP_CHUNKED or not S_ISDIR(ent[3])):
@@ -801,6 +981,24 @@ def _parse_tree_depth(mangled_name):
     assert depth > 0
     return depth
 
+def _remember_dir_meta(repo, oid, meta):
+    """Record the metadata for tree oid in the persistent cache, if
+    any, where a plain mode means the tree has no metadata."""
+    db = _persistent_cache(repo)
+    if db:
+        db.add_dir_meta(oid, meta.encode() if isinstance(meta, Metadata) else b'')
+
+def _remembered_dir_meta(repo, oid):
+    """Return the metadata for tree oid (Metadata, or a mode if it
+    has none) from the persistent cache, or None if it's not known."""
+    db = _persistent_cache(repo)
+    encoded = db.dir_meta(oid) if db else None
+    if encoded is None:
+        return None
+    if not encoded:
+        return default_dir_mode
+    return _read_dir_meta(BytesIO(encoded))
+
 def tree_items(repo, oid, tree_data, names, *, want_meta=True, repair=False):
     # For now, the .bupm order doesn't quite match git's, and we don't
     # load the tree data incrementally anyway, so we just work in RAM
@@ -844,18 +1042,24 @@ def tree_items(repo, oid, tree_data, names, *, want_meta=True, repair=False):
                     if not Metadata.read(bupm):
                         raise EOFError('EOF while skipping directory metadata')
                 else:
-                    yield b'.', Item(oid=oid, meta=_read_dir_meta(bupm))
+                    meta = _read_dir_meta(bupm)
+                    _remember_dir_meta(repo, oid, meta)
+                    yield b'.', Item(oid=oid, meta=meta)
                 yield from _tree_items_except_dot(oid, entries, names, bupm,
                                                   repair=repair)
         else:
             if dot_requested:
                 with _FileReader(repo, bupm_oid) as bupm:
-                    yield b'.', Item(oid=oid, meta=_read_dir_meta(bupm))
+                    meta = _read_dir_meta(bupm)
+                _remember_dir_meta(repo, oid, meta)
+                yield b'.', Item(oid=oid, meta=meta)
             yield from _split_subtree_items(repo, depth, oid, entries, names,
                                             True)
         return
 
     if dot_requested:
+        if want_meta:
+            _remember_dir_meta(repo, oid, default_dir_mode)
         yield b'.', Item(oid=oid, meta=default_dir_mode)
     if not depth:
         yield from _tree_items_except_dot(oid, entries, names, repair=repair)
@@ -900,6 +1104,12 @@ def parse_rev(f):
     tree, auth_sec = items
     return unhexlify(tree), int(auth_sec)
 
+def _parse_rev_with_parents(f):
+    items = f.readline().split(None)
+    assert len(items) >= 2
+    tree, auth_sec, *parents = items
+    return unhexlify(tree), int(auth_sec), [unhexlify(x) for x in parents]
+
 def _item_for_rev(rev):
     commit_oidx, (tree_oid, utc_) = rev
     coid = unhexlify(commit_oidx)
@@ -921,8 +1131,19 @@ def cache_commit(repo, oid, require_meta=True):
     """
     entries = {}
     entries[b'.'] = _revlist_item_from_oid(repo, oid, require_meta)
-    revs = repo.rev_list((hexlify(oid),), format=b'%T %at',
-                         parse=parse_rev)
+    db = _persistent_cache(repo)
+    revs = db.rev_list(oid) if db else None
+    if revs is not None:
+        revs = ((hexlify(coid), (tree, utc)) for coid, tree, utc in revs)
+    elif db:
+        revs = tuple(repo.rev_list((hexlify(oid),), format=b'%T %at %P',
+                                   parse=_parse_rev_with_parents))
+        db.add_commits((unhexlify(coidx), parents, tree, utc)
+                       for coidx, (tree, utc, parents) in revs)
+        revs = ((coidx, (tree, utc)) for coidx, (tree, utc, _) in revs)
+    else:
+        revs = repo.rev_list((hexlify(oid),), format=b'%T %at',
+                             parse=parse_rev)
     rev_items, rev_names = tee(revs)
     revs = None  # Don't disturb the tees
     rev_names = save_names_for_commit_utcs(x[1][1] for x in rev_names)
@@ -1060,6 +1281,11 @@ def contents(repo, item, names=None, want_meta=True, repair=False):
     assert repo
     assert S_ISDIR(item_mode(item))
     if isinstance(item, real_tree_types):
+        if want_meta and names and all(x == b'.' for x in names):
+            meta = _remembered_dir_meta(repo, item.oid)
+            if meta is not None:
+                yield b'.', Item(oid=item.oid, meta=meta)
+                return
         _, obj_t, _, it = get_oidx(repo, hexlify(item.oid))
         data = b''.join(it)
         if obj_t != b'tree':
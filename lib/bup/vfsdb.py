@@ -0,0 +1,171 @@
+"""Persistent VFS cache
+
+Since git objects are immutable, information the VFS derives from
+them (the size of a chunked file, a directory's own metadata, or the
+history of a commit) never changes, and can be kept across
+processes.  When bup.vfs.persistent-cache is true, LocalRepo keeps
+it in an sqlite database in the repository (see db_path()), keyed by
+oid, that's shared by all of the processes using the repository.
+
+The database is only a cache.  Any failure to open, read, or update
+it is ignored (with a debug message), and since objects can only
+disappear via gc, gc removes the database via clear().
+
+"""
+
+from threading import Lock
+import os, sqlite3
+
+from bup.helpers import debug1, unlink
+from bup.io import path_msg
+
+
+_format_version = 1
+
+
+def db_path(repo_dir):
+    return os.path.join(repo_dir, b'vfs-cache.sqlite3')
+
+def clear(repo_dir):
+    """Remove the persistent VFS cache for the repository, if any."""
+    path = db_path(repo_dir)
+    for suffix in (b'', b'-wal', b'-shm', b'-journal'):
+        unlink(path + suffix)
+
+
+class VfsDb:
+    def __init__(self, path):
+        """Open (creating if needed) the cache at path.  Raise
+        sqlite3.Error if that's not possible."""
+        self.closed = True
+        self._path = path
+        self._lock = Lock() # the connection may be shared by threads
+        self._db = sqlite3.connect(path, timeout=1, isolation_level=None,
+                                   check_same_thread=False)
+        try:
+            self._db.execute('pragma journal_mode = wal')
+            self._db.execute('pragma synchronous = normal')
+            self._prepare()
+        except:
+            self._db.close()
+            raise
+        self.closed = False
+
+    def _prepare(self):
+        db = self._db
+        db.execute('create table if not exists info'
+                   ' (name text primary key, value integer)')
+        row = db.execute("select value from info where name = 'version'") \
+                .fetchone()
+        if row and row[0] == _format_version:
+            return
+        with db: # i.e. in a transaction
+            db.execute('begin immediate')
+            for table in ('file_size', 'dir_meta', 'commit_info'):
+                db.execute(f'drop table if exists {table}')
+            db.execute('create table file_size'
+                       ' (oid blob primary key, size integer not null)'
+                       ' without rowid')
+            db.execute('create table dir_meta'
+                       ' (oid blob primary key, meta blob not null)'
+                       ' without rowid')
+            # parents is the concatenation of the parent oids
+            db.execute('create table commit_info'
+                       ' (oid blob primary key, parents blob not null,'
+                       '  tree blob not null, utc integer not null)'
+                       ' without rowid')
+            db.execute("insert or replace into info values ('version', ?)",
+                       (_format_version,))
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._db.close()
+
+    def __del__(self): assert self.closed
+    def __enter__(self): return self
+    def __exit__(self, type, value, traceback): self.close()
+
+    def _get(self, table, column, oid):
+        try:
+            with self._lock:
+                row = self._db.execute(f'select {column} from {table}'
+                                       ' where oid = ?', (oid,)).fetchone()
+        except sqlite3.Error as ex:
+            debug1(f'vfs: unable to read {path_msg(self._path)}: {ex}\n')
+            return None
+        return row[0] if row else None
+
+    def _put(self, table, oid, value):
+        try:
+            with self._lock:
+                self._db.execute(f'insert or ignore into {table} values (?, ?)',
+                                 (oid, value))
+        except sqlite3.Error as ex:
+            debug1(f'vfs: unable to update {path_msg(self._path)}: {ex}\n')
+
+    def file_size(self, oid):
+        """Return the size of the chunked file oid, or None."""
+        return self._get('file_size', 'size', oid)
+
+    def add_file_size(self, oid, size):
+        self._put('file_size', oid, size)
+
+    def dir_meta(self, oid):
+        """Return the encoded metadata for the tree oid, b'' if the
+        tree has none, or None if it's not known."""
+        return self._get('dir_meta', 'meta', oid)
+
+    def add_dir_meta(self, oid, encoded_meta):
+        self._put('dir_meta', oid, encoded_meta)
+
+    def rev_list(self, oid):
+        """Return a list of (commit_oid, tree_oid, author_time) for
+        the history of commit oid, newest first, or None if any of it
+        isn't known, or if it includes a merge."""
+        try:
+            with self._lock:
+                rows = self._db.execute(
+                    'with recursive history(depth, oid, parents, tree, utc) as'
+                    ' (select 0, oid, parents, tree, utc from commit_info'
+                    '   where oid = ?'
+                    '  union all'
+                    '  select depth + 1, c.oid, c.parents, c.tree, c.utc'
+                    '   from commit_info c, history h'
+                    '   where length(h.parents) = 20 and c.oid = h.parents)'
+                    ' select oid, parents, tree, utc from history'
+                    ' order by depth',
+                    (oid,)).fetchall()
+        except sqlite3.Error as ex:
+            debug1(f'vfs: unable to read {path_msg(self._path)}: {ex}\n')
+            return None
+        # Complete only if the walk reached a root commit
+        if not rows or rows[-1][1]:
+            return None
+        return [(coid, tree, utc) for coid, parents_, tree, utc in rows]
+
+    def add_commits(self, commits):
+        """Remember the (commit_oid, parent_oids, tree_oid,
+        author_time) for each of the commits.  Since each commit is
+        stored once, the histories of all the commits that share it
+        share the storage."""
+        try:
+            with self._lock, self._db:
+                self._db.execute('begin')
+                self._db.executemany(
+                    'insert or ignore into commit_info values (?, ?, ?, ?)',
+                    ((coid, b''.join(parents), tree, utc)
+                     for coid, parents, tree, utc in commits))
+        except sqlite3.Error as ex:
+            debug1(f'vfs: unable to update {path_msg(self._path)}: {ex}\n')
+
+
+def open_for_repo(repo_dir):
+    """Return a VfsDb for the repository, or None if it can't be
+    opened."""
+    path = db_path(repo_dir)
+    try:
+        return VfsDb(path)
+    except sqlite3.Error as ex:
+        debug1(f'vfs: unable to open {path_msg(path)}: {ex}\n')
+        return None
@@ -258,6 +258,10 @@ def _run_get(disposition, method, what, rewrite=None):
     if disposition == 'get':
         get_cmd = (bup_cmd, b'-d', b'get-dest',
                    b'get', b'-vvct', b'--print-tags', b'-s', b'get-src')
+    elif disposition == 'get-jobs':
+        get_cmd = (bup_cmd, b'-d', b'get-dest',
+                   b'get', b'-vvct', b'--print-tags', b'-s', b'get-src',
+                   b'--jobs', b'3')
     elif disposition == 'get-on':
         get_cmd = (bup_cmd, b'-d', b'get-dest',
                    b'on', b'-', b'get', b'-vvct', b'--print-tags', b'-s', b'get-src')
@@ -1126,7 +1130,7 @@ def create_get_src():
 dispositions_to_test = ('get',)
 
 if int(environ.get(b'BUP_TEST_LEVEL', b'0')) >= 11:
-    dispositions_to_test += ('get-on', 'get-to', 'get-from')
+    dispositions_to_test += ('get-jobs', 'get-on', 'get-to', 'get-from')
 
 categories = ('replace', 'universal', 'ff', 'append', 'pick_force', 'pick_noforce', 'new_tag', 'unnamed')
 
@@ -1138,3 +1142,63 @@ def test_get(tmpdir, disposition, category):
         globals().get('_test_' + category)(disposition, src_info)
     finally:
         chdir(top)
+
+# Always exercise --jobs for at least the methods that reach each of
+# the get_random_item() callers.
+@pytest.mark.parametrize("category", ('append', 'ff', 'new_tag', 'replace'))
+def test_get_jobs(tmpdir, category):
+    if 'get-jobs' in dispositions_to_test:
+        pytest.skip('covered by test_get')
+    chdir(tmpdir)
+    try:
+        src_info = create_get_src()
+        globals().get('_test_' + category)('get-jobs', src_info)
+    finally:
+        chdir(top)
+
+def test_get_jobs_shared_objects(tmpdir):
+    # Every object must be written after everything it refers to,
+    # even when several trees share a subtree or blob.
+    chdir(tmpdir)
+    try:
+        ex((bup_cmd, b'-d', b'get-src', b'init'))
+        mkdir(b'src')
+        mkdir(b'src/shared')
+        for i in range(20):
+            ex(bup_cmd + b' -d get-src random --seed %d 20k > src/shared/%d'
+               % (i, i), shell=True)
+        for i in range(8):
+            ex((b'cp', b'-R', b'src/shared', b'src/copy-%d' % i))
+            ex((b'cp', b'src/shared/0', b'src/copy-%d/dup' % i))
+        ex((bup_cmd, b'-d', b'get-src', b'index', b'src'))
+        ex((bup_cmd, b'-d', b'get-src', b'save', b'-n', b'src', b'--strip',
+            b'src'))
+        ex((bup_cmd, b'-d', b'get-dest', b'init'))
+        ex((bup_cmd, b'-d', b'get-dest', b'get', b'-s', b'get-src',
+            b'--jobs', b'4', b'--append:', b'src', b'src'))
+        validate_clean_repo()
+        idxs = [x for x in os.listdir(b'get-dest/objects/pack')
+                if x.endswith(b'.idx')]
+        wvpasseq(1, len(idxs))
+        with open(b'get-dest/objects/pack/' + idxs[0], 'rb') as idx:
+            out = exo((b'git', b'show-index'), stdin=idx).out
+        offset = {}
+        for line in out.splitlines():
+            ofs, oid = line.split()[:2]
+            offset[oid] = int(ofs)
+        for oid, ofs in offset.items():
+            kind = exo((b'git', b'--git-dir', b'get-dest', b'cat-file',
+                        b'-t', oid)).out.strip()
+            if kind == b'tree':
+                refs = [x.split()[2] for x in
+                        exo((b'git', b'--git-dir', b'get-dest', b'ls-tree',
+                             oid)).out.splitlines()]
+            elif kind == b'commit':
+                refs = [exo((b'git', b'--git-dir', b'get-dest', b'rev-parse',
+                             oid + b'^{tree}')).out.strip()]
+            else:
+                refs = []
+            for ref in refs:
+                wvcheck(offset[ref] < ofs, f'{ref} written before {oid}')
+    finally:
+        chdir(top)
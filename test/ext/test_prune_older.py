@@ -266,6 +266,31 @@ def test_random_keeps(tmpdir):
            + (b'main',))
         check_prune_result(b'main', [utc for keep, utc in expected if keep])
 
+def test_estimate(tmpdir):
+    bup_cmd = bup.path.exe()
+    environ[b'BUP_DIR'] = tmpdir + b'/bup'
+    environ[b'GIT_DIR'] = tmpdir + b'/bup'
+    chdir(tmpdir)
+    ex((bup_cmd, b'init'))
+    now = int(time())
+    # Each save replaces the (incompressible) data, so removing all
+    # but the newest should reclaim roughly two saves' worth.
+    for i in range(3):
+        with open(b'data', 'wb') as f:
+            f.write(random.randbytes(100_000))
+        ex((bup_cmd, b'index', b'data'))
+        ex((bup_cmd, b'save', b'-n', b'main', b'-d', b'%d' % (now - 3 + i),
+            b'data'))
+    cp = ex((bup_cmd, b'prune-older', b'--unsafe', b'--pretend', b'--estimate',
+             b'--wrt', b'%d' % now, b'--keep-all-for', b'1s', b'main'),
+            stdout=PIPE, stderr=PIPE)
+    assert cp.out.count(b'- main/') == 2
+    assert cp.out.count(b'+ main/') == 1
+    m = re.search(br'(?m)^main: about ([0-9.]+)KB reclaimable$', cp.err)
+    assert m, cp.err
+    assert 195 < float(m.group(1)) < 260
+
+
 def test_argument_validation(tmpdir):
     rxs = re.search
     environ[b'BUP_DIR'] = tmpdir + b'/bup'
@@ -289,6 +314,12 @@ def test_argument_validation(tmpdir):
     assert cp.rc
     assert b'\nerror: at least one keep argument is required\n' in cp.err
 
+    wvstart('--estimate without --pretend')
+    cp = ex((bup.path.exe(), b'prune-older', b'--unsafe', b'--estimate',
+             b'--keep-all-for', b'forever'), check=False, stderr=PIPE)
+    assert cp.rc
+    assert b'\nerror: --estimate requires --pretend\n' in cp.err
+
     wvstart('--wrt non-integer')
     cp = prune(b'--unsafe', b'--wrt', b'x', b'main')
     assert cp.rc
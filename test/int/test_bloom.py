@@ -1,10 +1,19 @@
 
+from itertools import product
 import errno, os, sys
 
 import pytest
 
-from bup.bloom import BloomReader, BloomWriter
-from bup.compat import dataclass
+from bup import bloom, git
+from bup.bloom import \
+    (BloomReader,
+     BloomWriter,
+     SegmentedBloomReader,
+     clear_bloom,
+     pfalse_positive,
+     segment_path)
+from bup.cmd.bloom import do_bloom
+from bup.compat import dataclass, environ
 
 
 def test_bloom(tmpdir):
@@ -14,28 +23,118 @@ def test_bloom(tmpdir):
         name: bytes
         shatable: bytes
     ix = Idx(name=b'dummy.idx', shatable=b''.join(hashes))
-    for k in (4, 5):
-        with BloomWriter(tmpdir + b'/pybuptest.bloom', 'w+b', expected=100, k=k) as b:
+    for version, k in product((2, 3), (4, 5)):
+        with BloomWriter(tmpdir + b'/pybuptest.bloom', 'w+b', expected=100,
+                         k=k, version=version) as b:
             b.add_idx(ix)
-            assert b.pfalse_positive() < .1
+            # The blocked layout is less accurate with very few blocks
+            assert b.pfalse_positive() < (.1 if version == 2 else .2)
         with BloomReader(tmpdir + b'/pybuptest.bloom') as b:
+            assert b.version == version
             all_present = True
             for h in hashes:
                 all_present &= (b.exists(h) or False)
             assert all_present
+            assert b.exists_many(b''.join(hashes)) == b'\1' * len(hashes)
             false_positives = 0
-            for h in [os.urandom(20) for i in range(1000)]:
+            others = [os.urandom(20) for i in range(1000)]
+            for h in others:
                 if b.exists(h):
                     false_positives += 1
             assert false_positives < 10
+            found = b.exists_many(b''.join(others))
+            assert found == bytes(1 if b.exists(h) else 0 for h in others)
         os.unlink(tmpdir + b'/pybuptest.bloom')
 
     os.chdir(tmpdir)
     with BloomWriter(b'bup.bloom', 'w+b', expected=100) as b:
         assert b.path == b'bup.bloom'
+        assert b.version == 3
         assert b.k == 5
 
 
+def test_bloom_version_update(tmpdir):
+    @dataclass(slots=True)
+    class Idx:
+        name: bytes
+        shatable: bytes
+    path = tmpdir + b'/bup.bloom'
+    hashes = [os.urandom(20) for i in range(200)]
+    with BloomWriter(path, 'w+b', expected=200, version=2) as b:
+        b.add_idx(Idx(name=b'0.idx', shatable=b''.join(hashes[:100])))
+    # Updating an existing filter preserves its version
+    with BloomWriter(path, 'wb', expected=100) as b:
+        assert b.version == 2
+        b.add_idx(Idx(name=b'1.idx', shatable=b''.join(hashes[100:])))
+    with BloomReader(path) as b:
+        assert b.version == 2
+        assert len(b) == 200
+        assert all(b.exists(h) for h in hashes)
+
+
+def test_blocked_pfalse_positive():
+    # The blocked layout costs a little accuracy, but not much.
+    for bits, entries in ((16, 2**14), (20, 2**18), (20, 2**20)):
+        v2 = pfalse_positive(2, bits, 5, entries)
+        v3 = pfalse_positive(3, bits, 5, entries)
+        assert v2 < v3 < 2 * v2 + .01
+    assert pfalse_positive(3, 20, 5, 0) == 0
+    assert 99 < pfalse_positive(3, 6, 5, 10000) <= 100
+
+
+def test_segmented_bloom(tmpdir):
+    @dataclass(slots=True)
+    class Idx:
+        name: bytes
+        shatable: bytes
+    path = tmpdir + b'/bup.bloom'
+    assert segment_path(path, 0) == path
+    assert segment_path(path, 2) == tmpdir + b'/bup.2.bloom'
+    hashes = []
+    for n, count in enumerate((10, 100, 1000)):
+        hs = [os.urandom(20) for i in range(count)]
+        hashes.extend(hs)
+        with BloomWriter(segment_path(path, n), 'w+b', expected=count) as b:
+            b.add_idx(Idx(name=b'%d.idx' % n, shatable=b''.join(hs)))
+    # a stray segment after a gap should be ignored
+    with BloomWriter(segment_path(path, 4), 'w+b', expected=1) as b:
+        pass
+    with SegmentedBloomReader(path) as b:
+        assert len(b.segments) == 3
+        assert len(b) == 1110
+        assert b.idxnames == [b'0.idx', b'1.idx', b'2.idx']
+        assert all(b.exists(h) for h in hashes)
+        false_positives = sum(1 for _ in range(1000)
+                              if b.exists(os.urandom(20)))
+        assert false_positives < 30
+        assert b.pfalse_positive() > max(x.pfalse_positive() for x in b.segments)
+    clear_bloom(tmpdir)
+    assert not [x for x in os.listdir(tmpdir) if x.endswith(b'.bloom')]
+
+
+def test_bloom_adds_segment_at_max_size(tmpdir, monkeypatch):
+    environ[b'BUP_DIR'] = environ[b'GIT_DIR'] = tmpdir
+    git.init_repo(tmpdir)
+    pack_dir = git.repo(b'objects/pack')
+    path = pack_dir + b'/bup.bloom'
+    with git.PackWriter(store=git.LocalPackStore(run_midx=False)) as w:
+        w.new_blob(b'first')
+    do_bloom(pack_dir, path, None, False)
+    with BloomReader(path) as b:
+        bits = b.bits
+    # Even when the existing filter is as large as it can be, too
+    # many new entries should produce a new segment.
+    monkeypatch.setattr(bloom, 'max_bits', lambda version, k: bits)
+    with git.PackWriter(store=git.LocalPackStore(run_midx=False)) as w:
+        for i in range(1000):
+            w.new_blob(b'%d' % i)
+    do_bloom(pack_dir, path, None, False)
+    with SegmentedBloomReader(path) as b:
+        assert len(b.segments) == 2
+        assert len(b.segments[0]) == 1
+        assert len(b) == 1001
+
+
 # pylint: disable-next=unused-argument
 def test_large_bloom(tmpdir):
     # Test large (~1GiB) filter.  This may fail on s390 (31-bit
@@ -43,8 +142,11 @@ def test_large_bloom(tmpdir):
     # sufficiently limited.
     try:
         with BloomWriter(tmpdir + b'/bup.bloom', 'w+b', expected=2**28,
-                          delaywrite=False) as b:
+                          delaywrite=False, version=2) as b:
             assert b.k == 4
+        with BloomWriter(tmpdir + b'/bup.bloom', 'w+b', expected=2**28,
+                          delaywrite=False) as b:
+            assert b.k == 5
     except EnvironmentError as ex:
         if sys.maxsize > 2**32 or ex.errno != errno.ENOMEM:
             raise
@@ -1,15 +1,17 @@
 
+from io import BytesIO
 import os, time, random, subprocess, glob
 
 from buptest import exc as ex
 from pytest import raises
 import pytest
 
-from bup import client, git
+from bup import client, git, protocol
 from bup.compat import environ
 from bup.config import ConfigError
-from bup.repo import LocalRepo
+from bup.repo import LocalRepo, RemoteRepo
 from bup.url import URL
+from bup.vint import write_vuint
 import bup.path
 
 
@@ -139,6 +141,159 @@ def test_server_deduplicate_writes(deduplicate_mode, tmpdir):
     assert len(glob.glob(c.cachedir+IDX_PAT)) == 2
 
 
+def test_server_have_oids(tmpdir):
+    environ[b'GIT_DIR'] = bupdir = tmpdir
+    environ[b'BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    ex((b'git', b'config', b'bup.server.have-oids', b'true'))
+    with local_writer() as lw:
+        s1sha = lw.new_blob(s1)
+    s2sha = git.calc_hash(b'blob', s2)
+    with subproc_client(bupdir) as c:
+        assert c.have_oids(()) == []
+        assert c.have_oids((s2sha, s1sha, s2sha)) == [False, True, False]
+        queries = []
+        have_oids = c.have_oids
+        def counted_have_oids(oids):
+            queries.append(len(oids))
+            return have_oids(oids)
+        c.have_oids = counted_have_oids
+        with c.new_packwriter() as rw:
+            # The existence checks are deferred and batched
+            rw.new_blob(s1)
+            rw.new_blob(s2)
+            assert rw.object_count() == 0
+            assert rw.exists(s1sha) and rw.exists(s2sha)
+            assert queries == []
+            s3sha = git.calc_hash(b'blob', s3)
+            rw.just_write(s3sha, b'blob', s3)
+            assert rw.object_count() == 1
+            # query while suspended, and then resume
+            assert have_oids((s1sha, s2sha)) == [True, False]
+        assert queries == [2]
+        assert rw.object_count() == 2
+        assert have_oids((s1sha, s2sha, s3sha)) == [True, True, True]
+        # Queries larger than the server's limit are split
+        many = [s1sha, s2sha] * protocol.max_have_oids + [s3sha]
+        assert c.have_oids(many) == [True] * len(many)
+        assert len(glob.glob(c.cachedir+IDX_PAT)) == 0
+    assert len(glob.glob(git.repo(b'objects/pack'+IDX_PAT))) == 2
+
+
+def test_server_have_oids_limit(tmpdir):
+    environ[b'GIT_DIR'] = bupdir = tmpdir
+    environ[b'BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    def request(n):
+        req = BytesIO()
+        write_vuint(req, n)
+        req.write(b'\0' * 20 * n)
+        return BytesIO(req.getvalue())
+    with protocol.Server(None, LocalRepo) as server:
+        server.conn = request(protocol.max_have_oids + 1)
+        with raises(Exception, match='exceeds limit'):
+            server.have_oids(b'')
+
+
+@pytest.mark.parametrize("level", (None, b'0', b'6'))
+def test_server_compress(level, tmpdir):
+    environ[b'GIT_DIR'] = bupdir = tmpdir
+    environ[b'BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    if level is not None:
+        ex((b'git', b'config', b'bup.server.compress', level))
+    with local_writer() as lw:
+        lw.new_blob(s1)
+    with subproc_client(bupdir) as c:
+        assert isinstance(c.conn, client.CompressedConn) == (level == b'6')
+        with c.new_packwriter() as rw:
+            s2sha = rw.new_blob(s2)
+            s3sha = rw.new_blob(s3 * 10)
+        refs = (s2sha.hex().encode(), s3sha.hex().encode())
+        expected = zip(refs, (s2, s3 * 10))
+        for oidx, kind, size, it in c.cat_batch(refs):
+            ref, data = next(expected)
+            assert (oidx, kind, size) == (ref, b'blob', len(data))
+            assert b''.join(it) == data
+        assert len(glob.glob(c.cachedir+IDX_PAT)) == 1
+
+
+def test_fetch_tree(tmpdir):
+    environ[b'GIT_DIR'] = bupdir = tmpdir
+    environ[b'BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    missing = git.calc_hash(b'blob', s3)
+    with local_writer() as lw:
+        s1sha = lw.new_blob(s1)
+        s2sha = lw.new_blob(s2)
+        sub = lw.new_tree(((0o100644, b'a', s1sha), (0o100644, b'b', s2sha)))
+        top = lw.new_tree(((0o100644, b'a', s1sha),
+                           (0o100644, b'c', missing),
+                           (0o40000, b'd', sub)))
+        commit = lw.new_commit(top, None, b'x <x@y>', 0, 0, b'x <x@y>', 0, 0,
+                               b'message\n')
+    def fetched(repo, oid, exclude=()):
+        return {oidx: kind for oidx, kind, data
+                in repo.fetch_tree(oid.hex().encode(), exclude=exclude)}
+    everything = {commit: b'commit', top: b'tree', sub: b'tree',
+                  s1sha: b'blob', s2sha: b'blob', missing: None}
+    everything = {k.hex().encode(): v for k, v in everything.items()}
+    with LocalRepo() as repo:
+        assert fetched(repo, commit) == everything
+    with subproc_client(bupdir) as c:
+        assert fetched(c, commit) == everything
+        # Each tree precedes its entries, which are in tree order
+        assert [oidx for oidx, kind, data
+                in c.fetch_tree(commit.hex().encode())] \
+            == [x.hex().encode()
+                for x in (commit, top, s1sha, missing, sub, s2sha)]
+        assert fetched(c, sub) == {sub.hex().encode(): b'tree',
+                                   s1sha.hex().encode(): b'blob',
+                                   s2sha.hex().encode(): b'blob'}
+        assert fetched(c, top, exclude=(sub.hex().encode(),)) \
+            == {top.hex().encode(): b'tree',
+                s1sha.hex().encode(): b'blob',
+                missing.hex().encode(): None}
+        assert fetched(c, missing) == {missing.hex().encode(): None}
+    with RemoteRepo(URL(scheme=b'ssh', path=bupdir)) as repo:
+        assert repo.prefetch(sub.hex().encode())
+        oidx, kind, size, it = repo.cat(s2sha.hex().encode())
+        assert (oidx, kind, size) == (s2sha.hex().encode(), b'blob', len(s2))
+        assert b''.join(it) == s2
+        oidx, kind, size, it = repo.cat(top.hex().encode())
+        assert (oidx, kind) == (top.hex().encode(), b'tree')
+        assert len(b''.join(it)) == size
+
+
+def test_cat_batch(tmpdir):
+    environ[b'GIT_DIR'] = bupdir = tmpdir
+    environ[b'BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    blobs = [b'%d' % i * i for i in range(1, 200)]
+    with local_writer() as lw:
+        oidxs = [lw.new_blob(b).hex().encode() for b in blobs]
+    missing = git.calc_hash(b'blob', s3).hex().encode()
+    refs = oidxs[:100] + [missing] + oidxs[100:]
+    expected = [(oidx, b'blob', len(b), b) for oidx, b in zip(oidxs, blobs)]
+    expected = expected[:100] + [(None, None, None, None)] + expected[100:]
+    def cat_batch(repo, refs):
+        return [(oidx, kind, size, it and b''.join(it))
+                for oidx, kind, size, it in repo.cat_batch(refs)]
+    with LocalRepo() as repo:
+        assert cat_batch(repo, refs) == expected
+        # abandoning a batch doesn't disrupt later requests
+        batch = repo.cat_batch(refs)
+        next(batch)
+        del batch
+        assert b''.join(repo.cat(oidxs[3])[3]) == blobs[3]
+        assert cat_batch(repo, iter(refs[:3])) == expected[:3]
+    with LocalRepo(thread_safe=True) as repo:
+        assert cat_batch(repo, refs) == expected
+    with RemoteRepo(URL(scheme=b'ssh', path=bupdir)) as repo:
+        assert cat_batch(repo, refs) == expected
+        assert b''.join(repo.cat(oidxs[3])[3]) == blobs[3]
+
+
 def test_midx_refreshing(tmpdir):
     environ[b'BUP_DIR'] = bupdir = tmpdir
     git.init_repo(bupdir)
@@ -0,0 +1,76 @@
+
+import os
+
+from bup import du, git
+from bup.compat import environ
+from bup.du import SpaceUsage, UsageCache
+
+
+def _write_saves(bupdir):
+    with git.PackWriter(store=git.LocalPackStore()) as w:
+        a, b, c = (w.new_blob(os.urandom(5000)) for i in range(3))
+        dir1_1 = w.new_tree(((0o100644, b'a', a), (0o100644, b'b', b)))
+        dir2 = w.new_tree(((0o100644, b'b', b),))
+        root1 = w.new_tree(((0o40000, b'dir1', dir1_1),
+                            (0o40000, b'dir2', dir2)))
+        dir1_2 = w.new_tree(((0o100644, b'a', a),))
+        dir3 = w.new_tree(((0o100644, b'c', c),))
+        root2 = w.new_tree(((0o40000, b'dir1', dir1_2),
+                            (0o40000, b'dir3', dir3)))
+        commits = []
+        for i, root in enumerate((root1, root2)):
+            commits.append(w.new_commit(root, None,
+                                        b'someone <x@y>', i, None,
+                                        b'someone <x@y>', i, None,
+                                        b'save'))
+    return dict(a=a, b=b, c=c, dir1_1=dir1_1, dir1_2=dir1_2, dir2=dir2,
+                dir3=dir3, root1=root1, root2=root2, commits=commits)
+
+
+def _check_usage(bupdir, objs, cache=None):
+    with git.PackIdxList(git.repo(b'objects/pack')) as idxs, \
+         git.PackedSizes(idxs) as sizes:
+        def size(*names): return sum(sizes.size(objs[x]) for x in names)
+        usage = SpaceUsage(sizes, git.catpipe().get, cache)
+        save1 = usage.add_save(objs['commits'][0], objs['root1'])
+        save2 = usage.add_save(objs['commits'][1], objs['root2'])
+        assert usage.add_save(objs['commits'][0], objs['root1']) is save1
+        assert [d.name for d in save1.dirs] == [b'dir1', b'dir2']
+        assert [d.name for d in save2.dirs] == [b'dir1', b'dir3']
+        commit1, commit2 = (sizes.size(x) for x in objs['commits'])
+
+        assert save1.total.size \
+            == commit1 + size('root1', 'dir1_1', 'dir2', 'a', 'b')
+        assert save1.total.objects == 6
+        assert usage.exclusive(save1).size \
+            == commit1 + size('root1', 'dir1_1', 'dir2', 'b')
+        dir1, dir2 = save1.dirs
+        assert dir1.total.size == size('dir1_1', 'a', 'b')
+        assert usage.exclusive(save1, dir1).size == size('dir1_1')
+        assert dir2.total.size == size('dir2', 'b')
+        assert usage.exclusive(save1, dir2).size == size('dir2')
+
+        assert usage.exclusive(save2).size \
+            == commit2 + size('root2', 'dir1_2', 'dir3', 'c')
+        dir1, dir3 = save2.dirs
+        assert usage.exclusive(save2, dir1).size == size('dir1_2')
+        assert usage.exclusive(save2, dir3).size == size('dir3', 'c')
+
+        assert usage.shared().size == size('a')
+        assert usage.unique().size == save1.total.size + save2.total.size \
+            - size('a')
+        assert not usage.unpacked
+
+
+def test_space_usage(tmpdir):
+    environ[b'BUP_DIR'] = environ[b'GIT_DIR'] = bupdir = tmpdir + b'/bup'
+    git.init_repo(bupdir)
+    objs = _write_saves(bupdir)
+    _check_usage(bupdir, objs)
+    with UsageCache(du.cache_path(bupdir)) as cache:
+        _check_usage(bupdir, objs, cache)
+        assert cache.tree_usage(objs['dir2']).objects == 2
+        # Results from the cache should be the same
+        _check_usage(bupdir, objs, cache)
+    du.clear(bupdir)
+    assert not os.path.exists(du.cache_path(bupdir))
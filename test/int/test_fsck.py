@@ -0,0 +1,100 @@
+from glob import glob
+import os, subprocess
+
+from bup import git
+from bup.compat import environ
+from bup.fsck \
+    import (Ledger, ledger_path, pack_fingerprint, packs_to_verify,
+            verify_pack)
+from bup.helpers import log
+
+
+def _write_pack(bupdir):
+    with git.PackWriter(store=git.LocalPackStore()) as w:
+        # Similar blobs, so that git repack will produce deltas
+        base = os.urandom(8192)
+        oids = [w.new_blob(base[:i * 50] + b'%d' % i + base[i * 50:])
+                for i in range(100)]
+        oids.append(w.new_blob(b''))
+        return w.close(), oids
+
+
+def test_verify_pack(tmpdir):
+    environ[b'BUP_DIR'] = environ[b'GIT_DIR'] = bupdir = tmpdir + b'/bup'
+    git.init_repo(bupdir)
+    stem, _ = _write_pack(bupdir)
+    result = verify_pack(stem)
+    assert result.ok
+    assert result.objects == 101
+    assert result.size == os.path.getsize(stem + b'.pack') \
+        + os.path.getsize(stem + b'.idx')
+    result = verify_pack(stem, quick=True)
+    assert result.ok
+    assert result.objects == 0
+
+    # Damage an object in the middle of the pack, and fix the
+    # trailing checksum so that only the object checks notice.
+    os.chmod(stem + b'.pack', 0o644)
+    os.chmod(stem + b'.idx', 0o644)
+    with open(stem + b'.pack', 'r+b') as f:
+        data = bytearray(f.read())
+        data[len(data) // 2] ^= 0xff
+        data[-20:] = git.Sha1(data[:-20]).digest()
+        f.seek(0)
+        f.write(data)
+    with open(stem + b'.idx', 'r+b') as f:
+        idx = bytearray(f.read())
+        idx[-40:-20] = data[-20:]
+        idx[-20:] = git.Sha1(idx[:-20]).digest()
+        f.seek(0)
+        f.write(idx)
+    assert verify_pack(stem, quick=True).ok
+    log('expect CRC mismatch error:\n')
+    assert not verify_pack(stem).ok
+
+    os.unlink(stem + b'.idx')
+    assert not verify_pack(stem).ok
+    assert not verify_pack(stem, quick=True).ok
+
+
+def test_verify_pack_deltas(tmpdir):
+    environ[b'BUP_DIR'] = environ[b'GIT_DIR'] = bupdir = tmpdir + b'/bup'
+    git.init_repo(bupdir)
+    _, oids = _write_pack(bupdir)
+    # Have git write the same objects (as deltas) to another pack
+    subprocess.run((b'git', b'--git-dir', bupdir, b'pack-objects', b'-q',
+                    tmpdir + b'/repacked'),
+                   input=b''.join(oid.hex().encode('ascii') + b'\n'
+                                  for oid in oids),
+                   stdout=subprocess.DEVNULL, check=True)
+    packs = glob(tmpdir + b'/repacked-*.pack')
+    assert len(packs) == 1
+    result = verify_pack(packs[0][:-5])
+    assert result.ok
+    assert result.objects == 101
+
+
+def test_ledger(tmpdir):
+    environ[b'BUP_DIR'] = environ[b'GIT_DIR'] = bupdir = tmpdir + b'/bup'
+    git.init_repo(bupdir)
+    stems = [_write_pack(bupdir)[0] for i in range(4)]
+    day = 24 * 60 * 60
+    now = 1_000_000_000
+    with Ledger(ledger_path(bupdir)) as ledger:
+        assert packs_to_verify(ledger, stems, now, 4) == stems
+        for stem in stems[:3]:
+            ledger.record(stem, pack_fingerprint(stem), now)
+        ledger.set_last_run(now)
+        assert packs_to_verify(ledger, stems, now + 60, 4) == stems[3:]
+        ledger.record(stems[3], pack_fingerprint(stems[3]), now + 60)
+        ledger.set_last_run(now + 60)
+        # A day later, a quarter of the packs are due
+        assert len(packs_to_verify(ledger, stems, now + day, 4)) == 1
+        # Packs are due after max-age
+        assert packs_to_verify(ledger, stems, now + 5 * day, 4) == stems
+        # and when they change
+        os.utime(stems[1] + b'.pack', ns=(0, 0))
+        assert packs_to_verify(ledger, stems, now + 60, 4) == stems[1:2]
+        ledger.forget_except(stems[2:])
+        assert sorted(ledger.entries()) \
+            == sorted(os.path.basename(x) + b'.pack' for x in stems[2:])
@@ -1,7 +1,9 @@
 
 from binascii import hexlify, unhexlify
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
 from functools import partial
+from io import BytesIO
 from time import localtime
 import struct, os
 import pytest
@@ -411,6 +413,70 @@ def test_cat_pipe(tmpdir):
     assert info[3] is None
 
 
+def test_cat_pipe_pool(tmpdir):
+    environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+    git.init_repo(bupdir)
+    blobs = [b'%d' % i * i for i in range(1, 50)]
+    with local_writer() as w:
+        oids = [w.new_blob(b) for b in blobs]
+    with git.CatPipePool(bupdir) as pool:
+        info = pool.get(b'0' * 40)
+        WVPASSEQ((None, None, None, None), info)
+        # data has already been read, so the pipe can be reused
+        first = pool.get(hexlify(oids[0]))
+        second = pool.get(hexlify(oids[1]))
+        WVPASSEQ(blobs[1], b''.join(second[3]))
+        WVPASSEQ(blobs[0], b''.join(first[3]))
+        WVPASSEQ(1, len(pool._all))
+        def check(i):
+            oidx, typ, size, it = pool.get(hexlify(oids[i]))
+            return typ, size, b''.join(it)
+        with ThreadPoolExecutor(max_workers=4) as ex:
+            results = list(ex.map(check, range(len(oids))))
+        WVPASSEQ([(b'blob', len(b), b) for b in blobs], results)
+        WVPASSLE(len(pool._all), 4)
+        WVPASSEQ((hexlify(oids[0]), b'blob', 1),
+                 pool.get(hexlify(oids[0]), include_data=False)[:3])
+        # A pipe whose request failed is returned, and then restarted
+        cp = pool._all[0]
+        pool._idle.remove(cp)
+        pool._idle.append(cp) # the one the next get() will use
+        stdout, cp.p.stdout = cp.p.stdout, BytesIO(b'bogus\n')
+        try:
+            with raises(git.GitError):
+                pool.get(hexlify(oids[0]))
+        finally:
+            stdout.close()
+        WVPASSEQ(cp, pool._idle[-1])
+        oidx, typ, size, it = pool.get(hexlify(oids[0]))
+        WVPASSEQ(blobs[0], b''.join(it))
+        WVPASSEQ(cp, pool._idle[-1])
+
+
+def test_stored_blob_finder(tmpdir):
+    environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+    git.init_repo(bupdir)
+    blobs = [b'', b'x', b'stored' * 1000, os.urandom(200000)]
+    with git.PackWriter(store=git.LocalPackStore(), compression_level=0) as w:
+        stored = [w.new_blob(b) for b in blobs]
+    with local_writer() as w:
+        compressed = w.new_blob(b'compressed' * 1000)
+    with git.StoredBlobFinder(bupdir) as finder:
+        for oid, blob in zip(stored, blobs):
+            fd, extents = finder.find(oid)
+            WVPASSEQ(len(blob), sum(n for ofs, n in extents))
+            WVPASSEQ(blob, b''.join(os.pread(fd, n, ofs) for ofs, n in extents))
+        WVPASSEQ(None, finder.find(compressed))
+        WVPASSEQ(None, finder.find(git.calc_hash(b'blob', b'missing')))
+    # The blobs should still be found once the packs are covered by a midx
+    exc(bup_exe, b'midx', b'-f')
+    with git.StoredBlobFinder(bupdir) as finder:
+        for oid, blob in zip(stored, blobs):
+            fd, extents = finder.find(oid)
+            WVPASSEQ(blob, b''.join(os.pread(fd, n, ofs) for ofs, n in extents))
+        WVPASSEQ(None, finder.find(compressed))
+
+
 def _create_idx(d, i):
     idx = git.PackIdxV2Writer()
     # add 255 vaguely reasonable entries
@@ -470,6 +536,30 @@ def test_midx_close(tmpdir):
             WVPASSEQ(False, b'deleted' in fn)
 
 
+def test_shared_pack_idx_list(tmpdir):
+    environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+    git.init_repo(bupdir)
+    packdir = git.repo(b'objects/pack')
+    with git.SharedPackIdxList(packdir, refresh_interval=0) as shared:
+        def shared_writer():
+            return git.PackWriter(store=git.LocalPackStore(objcache=shared))
+        with shared_writer() as w:
+            oid1 = w.new_blob(b'1')
+        # visible after pack_finished()
+        WVPASS(shared.exists(oid1))
+        with shared_writer() as w:
+            WVPASSEQ(oid1, w.new_blob(b'1'))
+            WVPASSEQ(0, w.object_count())
+        # writers don't close the shared view
+        WVPASS(shared.exists(oid1))
+        # noticed via the pack directory mtime
+        oid2 = git.calc_hash(b'blob', b'2')
+        with local_writer() as w:
+            w.just_write(oid2, b'blob', b'2')
+        os.utime(packdir, ns=(0, 0))
+        WVPASS(shared.exists(oid2))
+
+
 def test_parse_git_int():
     parse = git.parse_git_int
     with raises(ConfigError, match="unrecognized --type int value ''"):
@@ -2,15 +2,18 @@
 from signal import SIG_IGN, SIGKILL, SIGTERM, signal
 from subprocess import Popen
 from threading import current_thread, main_thread
+from io import BytesIO
 from time import tzset
-import os, os.path
+import os, os.path, struct, zlib
 
 from wvpytest import *
 
 from bup import helpers
 from bup.compat import environ
 from bup.helpers import \
-    (atomically_replaced_file,
+    (CompressedConn,
+     Conn,
+     atomically_replaced_file,
      detect_fakeroot,
      finalized,
      grafted_path_components,
@@ -313,3 +316,40 @@ def test_valid_save_name():
     WVFAIL(valid(b'foo/bar.lock/baz'))
     WVFAIL(valid(b'.bar/baz'))
     WVFAIL(valid(b'foo/.bar/baz'))
+
+
+def _compressed_stream(data):
+    out = BytesIO()
+    with Conn(BytesIO(), out) as conn, CompressedConn(conn, 1) as cc:
+        cc.write(data)
+    return out.getvalue()
+
+def test_compressed_conn():
+    lines = [b'%d\n' % i for i in range(100000)]
+    data = b''.join(lines) + os.urandom(3 * CompressedConn.max_inflate)
+    stream = _compressed_stream(data)
+    with Conn(BytesIO(stream), BytesIO()) as conn, \
+         CompressedConn(conn, 1) as cc:
+        for line in lines:
+            WVPASSEQ(line, cc.readline())
+        rest = data[len(b''.join(lines)):]
+        WVPASSEQ(rest, cc.read(len(rest) + 1))
+        WVPASSEQ(b'', cc.read(1))
+
+def test_compressed_conn_limits():
+    # A small frame that would expand enormously is decompressed
+    # incrementally.
+    bomb = _compressed_stream(b'\0' * (64 * CompressedConn.max_inflate))
+    with Conn(BytesIO(bomb), BytesIO()) as conn, \
+         CompressedConn(conn, 1) as cc:
+        WVPASSEQ(b'\0' * 10, cc.read(10))
+        WVPASSLE(len(cc._buf), CompressedConn.max_inflate)
+        WVPASSEQ(b'\0' * (64 * CompressedConn.max_inflate - 10),
+                 cc.readline())
+    # An oversized frame is rejected
+    frame = zlib.compress(b'x')
+    header = struct.pack('!I', helpers._DeflatingWriter.max_frame + 1)
+    with Conn(BytesIO(header + frame), BytesIO()) as conn, \
+         CompressedConn(conn, 1) as cc:
+        with pytest.raises(Exception, match='frame size'):
+            cc.read(1)
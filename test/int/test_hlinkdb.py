@@ -0,0 +1,64 @@
+
+import os, pickle
+
+from bup import hlinkdb
+from bup.hlinkdb import HLinkDB
+
+
+def test_hlinkdb(tmpdir):
+    db_path = tmpdir + b'/hlinks'
+    with HLinkDB(db_path) as db:
+        assert db.node_paths(1, 2) == []
+        db.add_path(b'/a', 1, 2)
+        db.add_path(b'/b', 1, 2)
+        db.add_path(b'/c', 1, 1)
+        db.add_path(b'/d', 2**64 - 1, 2**64 - 1)
+        assert db.node_paths(1, 2) == [b'/a', b'/b']
+        db.prepare_save()
+        db.commit_save()
+    with open(db_path, 'rb') as f:
+        assert f.read(4) == hlinkdb.HLINK_HEADER
+    with HLinkDB(db_path) as db:
+        assert db.node_paths(1, 2) == [b'/a', b'/b']
+        assert db.node_paths(1, 1) == [b'/c']
+        assert db.node_paths(2**64 - 1, 2**64 - 1) == [b'/d']
+        assert db.node_paths(1, 3) == []
+        db.del_path(b'/a', 1, 2)
+        db.add_path(b'/e', 1, 2)
+        db.del_path(b'/c', 1, 1)
+        db.del_path(b'/x', 1, 1) # not present
+        db.add_path(b'/f', 0, 7)
+        assert db.node_paths(1, 2) == [b'/b', b'/e']
+        assert db.node_paths(1, 1) == []
+        db.prepare_save()
+        db.commit_save()
+    with HLinkDB(db_path) as db:
+        assert db.node_paths(1, 2) == [b'/b', b'/e']
+        assert db.node_paths(1, 1) == []
+        assert db.node_paths(0, 7) == [b'/f']
+        # Changes are discarded without a save
+        db.del_path(b'/f', 0, 7)
+    with HLinkDB(db_path) as db:
+        assert db.node_paths(0, 7) == [b'/f']
+        for path, dev, ino in ((b'/b', 1, 2), (b'/e', 1, 2), (b'/f', 0, 7),
+                               (b'/d', 2**64 - 1, 2**64 - 1)):
+            db.del_path(path, dev, ino)
+        db.prepare_save()
+        db.commit_save()
+    assert not os.path.exists(db_path)
+
+
+def test_hlinkdb_pickle(tmpdir):
+    db_path = tmpdir + b'/hlinks'
+    with open(db_path, 'wb') as f:
+        pickle.dump({b'1:2': [b'/a', b'/b'], b'3:4': [b'/c', b'/d']}, f, 2)
+    with HLinkDB(db_path) as db:
+        assert db.node_paths(1, 2) == [b'/a', b'/b']
+        assert db.node_paths(3, 4) == [b'/c', b'/d']
+        db.del_path(b'/c', 3, 4)
+        db.prepare_save()
+        db.commit_save()
+    with HLinkDB(db_path) as db:
+        assert db.node_paths(1, 2) == [b'/a', b'/b']
+        assert db.node_paths(3, 4) == [b'/d']
+        db.abort_save()
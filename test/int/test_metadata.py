@@ -1,5 +1,7 @@
 
+from copy import deepcopy
 from errno import ENOTSUP
+from io import BytesIO
 import errno, stat, subprocess
 import os, sys
 import pytest
@@ -8,7 +10,7 @@ from buptest import exc
 from wvpytest import *
 import buptest
 
-from bup import git, helpers, metadata
+from bup import git, helpers, metadata, vint
 from bup import vfs
 from bup.compat import fsencode
 from bup.helpers import \
@@ -375,3 +377,107 @@ def test_maximal_metadata(tmpdir):
         assert isinstance(hash(m), int)
     finally:
         cleanup_testfs(b'testfs.img', b'testfs')
+
+
+def _codec_test_metadata():
+    def meta(**kwargs):
+        m = metadata.Metadata(frozen=False)
+        for k, v in kwargs.items():
+            setattr(m, k, v)
+        return m.freeze()
+    common = dict(mode=0o100644, uid=1000, user=b'user', gid=100,
+                  group=b'group', rdev=0,
+                  atime=1_700_000_000_123_456_789, mtime=-1, ctime=0)
+    return (metadata.Metadata(),
+            meta(path=b'some/path'),
+            meta(path=b'x', **common),
+            meta(**common, size=0),
+            meta(**common, size=2**40),
+            meta(**dict(common, mode=0o120777), size=6, symlink_target=b'target'),
+            meta(**common, hardlink_target=b'other/path'),
+            meta(**common, posix1e_acl=(b'u::rw-', b'u::rw-')),
+            meta(**common, posix1e_acl=(b'u::rwx', b'u::rwx', b'u::r-x', b'u::r-x')),
+            meta(**common, linux_attr=0x80000),
+            meta(**common, linux_xattr=[(b'user.a', b''), (b'user.b', b'\0x')]),
+            meta(**dict(common, atime=-2**63, mtime=2**63 - 1, uid=2**62)),
+            # Beyond the range of the C code
+            meta(**dict(common, mtime=2**80, uid=2**64), size=2**70,
+                 linux_attr=2**65))
+
+
+def test_metadata_codec():
+    entries = _codec_test_metadata()
+    for m in entries:
+        for include_path in (True, False):
+            encoded = m._encode_records(include_path)
+            assert m.encode(include_path=include_path) == encoded
+            expected = metadata.Metadata.read(BytesIO(encoded))
+            if expected is metadata.empty_metadata:
+                assert metadata.decode(encoded) == (expected, len(encoded))
+                continue
+            decoded, end = metadata.decode(encoded)
+            assert end == len(encoded)
+            assert decoded == expected
+            assert decoded.linux_xattr == expected.linux_xattr
+            assert decoded.posix1e_acl == expected.posix1e_acl
+            # Truncation is an error, as it is for read()
+            with pytest.raises(EOFError):
+                metadata.decode(encoded[:-1])
+    assert metadata.decode(b'') is None
+    assert metadata.decode(b'\0', 1) is None
+    assert metadata.decode(b'\0', empty=None) == (None, 1)
+
+    data = b''.join(m.encode() for m in entries)
+    decoded = metadata.decode_all(data)
+    assert decoded == [metadata.Metadata.read(BytesIO(m.encode()))
+                       for m in entries]
+    assert metadata.decode_all(b'') == []
+    # Offsets in the middle of the stream
+    ofs = 0
+    for m in decoded:
+        result, ofs = metadata.decode(data, ofs)
+        assert result == m
+    assert ofs == len(data)
+
+
+def test_metadata_codec_acl_v1():
+    # Legacy records are decoded by the Python code
+    acl = vint.pack('ssss', b'u::rw-\ng::r--', b'u::rw-\ng::r--', b'', b'')
+    encoded = vint.pack('V', 4) + vint.encode_bvec(acl) + b'\0'
+    for m, end in (metadata.decode(encoded),
+                   metadata.decode(b'\0' + encoded, 1)):
+        assert m.posix1e_acl == (b'u::rw-,g::r--', b'u::rw-,g::r--')
+    assert end == len(encoded) + 1
+    assert metadata.decode_all(b'\0' + encoded) \
+        == [metadata.empty_metadata, m]
+
+
+def test_lazy_metadata():
+    entries = _codec_test_metadata()
+    data = b''.join(m.encode() for m in entries)
+    encoded = metadata.encoded_entries(data)
+    assert encoded == [m.encode() for m in entries]
+    assert metadata.encoded_entries(b'') == []
+    with pytest.raises(EOFError):
+        metadata.encoded_entries(data[:-1])
+    for m, enc in zip(entries, encoded):
+        lazy = metadata.LazyMetadata(enc)
+        assert isinstance(lazy, metadata.Metadata)
+        assert lazy == metadata.decode(enc)[0]
+        assert lazy.linux_xattr == m.linux_xattr
+        assert lazy.encode() == enc
+
+    lazy = metadata.LazyMetadata(entries[2].encode())
+    assert lazy.mode == 0o100644
+    copied = deepcopy(lazy)
+    assert type(copied) is metadata.Metadata
+    assert copied == lazy
+    copied.thaw().uid = 1
+    assert lazy.uid == 1000
+    # Changes after a thaw aren't replaced by the decoding
+    lazy = metadata.LazyMetadata(entries[2].encode()).thaw()
+    lazy.uid = 1
+    assert lazy.user == b'user'
+    assert lazy.uid == 1
+    with pytest.raises(AttributeError):
+        lazy.not_a_field
@@ -4,7 +4,7 @@ from os import symlink
 from random import Random, randint
 from stat import S_IFDIR, S_IFLNK, S_IFREG, S_ISDIR, S_ISREG
 from time import localtime, strftime, tzset
-import os, sys
+import os, sqlite3, sys
 
 import pytest
 
@@ -13,7 +13,7 @@ from buptest.vfs import tree_dict
 from wvpytest import *
 
 from bup._helpers import write_random
-from bup import git, metadata, vfs
+from bup import git, metadata, vfs, vfsdb
 from bup.compat import environ, fsencode
 from bup.metadata import Metadata
 from bup.repo import LocalRepo
@@ -28,38 +28,62 @@ def test_default_modes():
     wvpasseq(S_IFLNK | 0o755, vfs.default_symlink_mode)
 
 def test_cache_behavior():
-    orig_max = vfs._cache_max_items
+    key_0 = b'itm:' + b'\0' * 20
+    key_1 = b'itm:' + b'\1' * 20
+    key_2 = b'itm:' + b'\2' * 20
+    tree_key = b'tre:' + b'\0' * 20
+    entry_size = vfs._cache_entry_size(key_0, b'x')
     try:
-        vfs._cache_max_items = 2
         vfs.clear_cache()
-        wvpasseq({}, vfs._cache)
-        wvpasseq([], vfs._cache_keys)
-        wvfail(vfs._cache_keys)
+        vfs.set_cache_limits(itm=2 * entry_size)
+        before = vfs.cache_stats()['itm']
+        wvpasseq(0, before['entries'])
+        wvpasseq(0, before['bytes'])
         wvexcept(Exception, vfs.cache_notice, b'x', 1)
-        key_0 = b'itm:' + b'\0' * 20
-        key_1 = b'itm:' + b'\1' * 20
-        key_2 = b'itm:' + b'\2' * 20
-        vfs.cache_notice(key_0, b'something')
-        wvpasseq({key_0 : b'something'}, vfs._cache)
-        wvpasseq([key_0], vfs._cache_keys)
-        vfs.cache_notice(key_1, b'something else')
-        wvpasseq({key_0 : b'something', key_1 : b'something else'}, vfs._cache)
-        wvpasseq(frozenset([key_0, key_1]), frozenset(vfs._cache_keys))
-        vfs.cache_notice(key_2, b'and also')
-        wvpasseq(2, len(vfs._cache))
-        wvpass(frozenset(vfs._cache.items())
-               < frozenset({key_0 : b'something',
-                            key_1 : b'something else',
-                            key_2 : b'and also'}.items()))
-        wvpasseq(2, len(vfs._cache_keys))
-        wvpass(frozenset(vfs._cache_keys) < frozenset([key_0, key_1, key_2]))
+        wvexcept(ValueError, vfs.set_cache_limits, nope=1)
+        vfs.cache_notice(key_0, b'0' * 10)
+        vfs.cache_notice(key_1, b'1' * 10)
+        wvpasseq(b'0' * 10, vfs.cache_get(key_0)) # key_1 now least recent
+        vfs.cache_notice(key_2, b'2' * 10)
+        wvpasseq(None, vfs.cache_get(key_1))
+        wvpasseq(b'0' * 10, vfs.cache_get(key_0))
+        wvpasseq(b'2' * 10, vfs.cache_get(key_2))
+        # no overwrite by default
+        vfs.cache_notice(key_2, b'3' * 10)
+        wvpasseq(b'2' * 10, vfs.cache_get(key_2))
+        vfs.cache_notice(key_2, b'3' * 10, overwrite=True)
+        wvpasseq(b'3' * 10, vfs.cache_get(key_2))
+        # kinds are independent, and entries may be too big to cache
+        vfs.set_cache_limits(tre=1000)
+        vfs.cache_notice(tree_key, b't' * 1000)
+        wvpasseq(None, vfs.cache_get(tree_key))
+        vfs.cache_notice(tree_key, b't')
+        wvpasseq(b't', vfs.cache_get(tree_key))
+        stats = vfs.cache_stats()['itm']
+        wvpasseq(2, stats['entries'])
+        wvpasseq(2 * entry_size, stats['bytes'])
+        wvpasseq(2 * entry_size, stats['limit'])
+        wvpasseq(before['hits'] + 5, stats['hits'])
+        wvpasseq(before['misses'] + 1, stats['misses'])
+        wvpasseq(before['evictions'] + 1, stats['evictions'])
+        vfs.set_cache_limits(itm=entry_size)
+        stats = vfs.cache_stats()['itm']
+        wvpasseq(1, stats['entries'])
+        wvpasseq(before['evictions'] + 2, stats['evictions'])
+        wvpasseq(b'3' * 10, vfs.cache_get(key_2))
         vfs.clear_cache()
-        wvpasseq({}, vfs._cache)
-        wvpasseq([], vfs._cache_keys)
+        wvpasseq(0, vfs.cache_stats()['itm']['entries'])
+        wvpasseq(0, vfs.cache_stats()['tre']['bytes'])
+        vfs.set_cache_limits(1000)
+        limits = [x['limit'] for x in vfs.cache_stats().values()]
+        wvpass(sum(limits) <= 1000)
+        wvpass(all(limits))
     finally:
-        vfs._cache_max_items = orig_max
+        vfs.set_cache_limits(**{k[:-1].decode('ascii'): v for k, v
+                                in vfs._cache_default_limits.items()})
         vfs.clear_cache()
 
+
 ## The clear_cache() calls below are to make sure that the test starts
 ## from a known state since at the moment the cache entry for a given
 ## item (like a commit) can change.  For example, its meta value might
@@ -177,6 +201,10 @@ def test_misc(tmpdir):
 
         wvpasseq(4, vfs.item_size(repo, link_item))
         wvpasseq(7, vfs.item_size(repo, file_item))
+        wvpasseq(7, vfs.cache_get(b'siz:' + file_item.oid))
+        hits = vfs.cache_stats()['siz']['hits']
+        wvpasseq(7, vfs.item_size(repo, file_item))
+        wvpasseq(hits + 1, vfs.cache_stats()['siz']['hits'])
         meta = metadata.from_path(fsencode(__file__))
         meta.thaw().size = 42
         fake_item = file_item._replace(meta=meta.freeze())
@@ -192,6 +220,7 @@ def test_misc(tmpdir):
         # FIXME: this caused StopIteration
         #_, file_item = vfs.resolve(repo, '/file')[-1]
         _, file_item = vfs.resolve(repo, b'/test/latest/file')[-1]
+        wvpass(isinstance(file_item.meta, metadata.LazyMetadata))
         file_copy = vfs.copy_item(file_item)
         wvpass(file_copy is not file_item)
         wvpass(file_copy.meta is not file_item.meta)
@@ -251,6 +280,20 @@ def validate_vfs_seeking_read(repo, item, expected_path, read_sizes):
             wvpasseq(b'', ex_buf)
             wvpasseq(b'', act_buf)
 
+def validate_vfs_random_reads(repo, item, expected_path, rand, count):
+    with open(expected_path, 'rb') as expected, \
+         vfs.fopen(repo, item) as actual:
+        size = vfs.item_size(repo, item)
+        for _ in range(count):
+            pos = rand.randint(0, size)
+            read_size = rand.randint(0, 200000)
+            expected.seek(pos)
+            actual.seek(pos)
+            wvpasseq(pos, actual.tell())
+            ex_buf = expected.read(read_size)
+            wvpass(ex_buf == actual.read(read_size))
+            wvpasseq(pos + len(ex_buf), actual.tell())
+
 def test_read_and_seek(tmpdir):
     # Write a set of randomly sized files containing random data whose
     # names are their sizes, and then verify that what we get back
@@ -287,12 +330,96 @@ def test_read_and_seek(tmpdir):
             res = resolve(repo, b'/test/latest/' + str(size).encode('ascii'))
             _, item = res[-1]
             wvpasseq(size, vfs.item_size(repo, res[-1][1]))
+            with open(b'%s/%d' % (data_path, size), 'rb') as f:
+                wvpass(f.read() == b''.join(vfs.file_chunks(repo, item)))
             validate_vfs_streaming_read(repo, item,
                                         b'%s/%d' % (data_path, size),
                                         read_sizes)
             validate_vfs_seeking_read(repo, item,
                                       b'%s/%d' % (data_path, size),
                                       read_sizes)
+            validate_vfs_random_reads(repo, item,
+                                      b'%s/%d' % (data_path, size),
+                                      rand, 50)
+
+def test_persistent_cache(tmpdir):
+    bup_dir = tmpdir + b'/bup'
+    environ[b'GIT_DIR'] = bup_dir
+    environ[b'BUP_DIR'] = bup_dir
+    git.repodir = bup_dir
+    data_path = tmpdir + b'/src'
+    os.makedirs(data_path + b'/dir')
+    with open(data_path + b'/big', 'wb') as f:
+        write_random(f.fileno(), 1024 * 1024, 7, 0)
+    ex((bup_path, b'init'))
+    ex((bup_path, b'index', data_path))
+    for _ in range(2):
+        ex((bup_path, b'save', b'-n', b'test', b'--strip', data_path))
+    ex((b'git', b'--git-dir', bup_dir, b'config',
+        b'bup.vfs.persistent-cache', b'true'))
+
+    def summary(repo):
+        vfs.clear_cache()
+        saves = tuple(name for name, _ in
+                      vfs.contents(repo, vfs.resolve(repo, b'/test')[-1][1]))
+        res = vfs.resolve(repo, b'/test/latest')
+        items = dict(vfs.contents(repo, res[-1][1]))
+        big = items[b'big']
+        dir_item = vfs.ensure_item_has_metadata(repo, items[b'dir'])
+        return saves, vfs.item_size(repo, big), dir_item.meta
+
+    with LocalRepo() as repo:
+        wvpass(repo.vfs_db)
+        expected = summary(repo)
+        wvpasseq(1024 * 1024, expected[1])
+    wvpass(os.path.exists(bup_dir + b'/vfs-cache.sqlite3'))
+
+    with LocalRepo() as repo:
+        revs = repo.vfs_db.rev_list(repo.read_ref(b'refs/heads/test'))
+        wvpasseq(2, len(revs))
+        def no_rev_list(*args, **kwargs):
+            raise AssertionError('unexpected rev-list')
+        repo.rev_list = no_rev_list
+        orig_chunk_node_size = vfs._chunk_node_size
+        try:
+            vfs._chunk_node_size = None # sizes must come from the db
+            wvpasseq(expected, summary(repo))
+        finally:
+            vfs._chunk_node_size = orig_chunk_node_size
+
+    # Each commit is stored once, no matter how many histories share it
+    ex((bup_path, b'save', b'-n', b'test', b'--strip', data_path))
+    with LocalRepo() as repo:
+        summary(repo)
+        revs = repo.vfs_db.rev_list(repo.read_ref(b'refs/heads/test'))
+        wvpasseq(3, len(revs))
+        wvpasseq(revs[1:], repo.vfs_db.rev_list(revs[1][0]))
+    db = sqlite3.connect(bup_dir + b'/vfs-cache.sqlite3')
+    try:
+        wvpasseq((3,), db.execute('select count(*) from commit_info')
+                 .fetchone())
+    finally:
+        db.close()
+
+    ex((bup_path, b'rm', b'--unsafe', b'/test'))
+    ex((bup_path, b'gc', b'--unsafe'))
+    wvpass(not os.path.exists(bup_dir + b'/vfs-cache.sqlite3'))
+
+def test_vfsdb_rev_list(tmpdir):
+    a, b, c, d, e, tree = (bytes([i]) * 20 for i in range(6))
+    with vfsdb.VfsDb(tmpdir + b'/vfs-cache.sqlite3') as db:
+        wvpasseq(None, db.rev_list(a))
+        db.add_commits(((a, [], tree, 1), (b, [a], tree, 2)))
+        wvpasseq([(b, tree, 2), (a, tree, 1)], db.rev_list(b))
+        # Incomplete history
+        db.add_commits(((d, [c], tree, 4),))
+        wvpasseq(None, db.rev_list(d))
+        db.add_commits(((c, [b], tree, 3),))
+        wvpasseq([(d, tree, 4), (c, tree, 3), (b, tree, 2), (a, tree, 1)],
+                 db.rev_list(d))
+        # Merges aren't handled
+        db.add_commits(((e, [d, a], tree, 5),))
+        wvpasseq(None, db.rev_list(e))
 
 def test_contents_with_mismatched_bupm_git_ordering(tmpdir):
     bup_dir = tmpdir + b'/bup'
@@ -382,3 +509,37 @@ def test_tree_depth_parsing():
         with pytest.raises(Exception) as exinfo:
             vfs._parse_tree_depth(x)
         assert 'Could not parse split tree depth' in str(exinfo.value)
+
+def test_file_chunks_streaming(tmpdir):
+    bup_dir = tmpdir + b'/bup'
+    environ[b'GIT_DIR'] = bup_dir
+    environ[b'BUP_DIR'] = bup_dir
+    git.repodir = bup_dir
+    data_path = tmpdir + b'/src'
+    os.mkdir(data_path)
+    size = 8 * 1024 * 1024
+    write_sized_random_content(data_path, size, 7)
+    ex((bup_path, b'init'))
+    ex((bup_path, b'index', data_path))
+    ex((bup_path, b'save', b'-n', b'test', b'--strip', data_path))
+    with open(b'%s/%d' % (data_path, size), 'rb') as f:
+        expected = f.read()
+    for thread_safe in (False, True):
+        with LocalRepo(thread_safe=thread_safe) as repo:
+            # Start cold, so that the subtrees are read while the
+            # chunks are being retrieved.
+            vfs.clear_cache()
+            _, item = vfs.resolve(repo, b'/test/latest/%d' % size)[-1]
+            assert isinstance(item, vfs.Chunky)
+            top = vfs._chunk_node(repo, item.oid, True)
+            assert any(top.trees), 'expected a multi-level chunk tree'
+            vfs.clear_cache()
+            wvpass(expected == b''.join(vfs.file_chunks(repo, item)))
+            vfs.clear_cache()
+            oids = vfs.file_blob_oids(repo, item)
+            assert not isinstance(oids, list)
+            data = []
+            for oid in oids:
+                _, _, _, it = vfs.get_oidx(repo, oid.hex().encode('ascii'))
+                data.extend(it)
+            wvpass(expected == b''.join(data))
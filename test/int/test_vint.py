@@ -32,7 +32,7 @@ def encode_and_decode_vint(x):
 
 
 def test_vint():
-    values = (0, 1, 42, 64, 10**16, 10**100)
+    values = (0, 1, 42, 64, 10**16, 2**63 - 1, 2**63, 10**100)
     for x in values:
         WVPASSEQ(encode_and_decode_vint(x), x)
     for x in [-x for x in values]: